@@ -0,0 +1,149 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from thumbnail_cache import file_digest
+
+# アルバムへの一括取り込み
+# フォルダ内の画像をプロセスプールで並列に調べ (復号できるか、撮影日時、
+# 大きさ、内容のハッシュ、知覚ハッシュ)、既存の写真や取り込み中の写真との
+# 完全な重複・よく似た写真を見分ける。GUI からは別スレッドで呼び、
+# progress(済んだ数, 全体) で進み具合を受け取る。
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp")
+
+# 知覚ハッシュ (dHash 64ビット) のハミング距離がこれ以下なら「よく似た写真」
+NEAR_DUPLICATE_DISTANCE = 6
+
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 36867
+EXIF_DATETIME = 306
+
+
+def find_images(directory):
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(dirpath, filename))
+    return paths
+
+
+def dhash(img, hash_size=8):
+    # 横に隣り合う画素の明暗から 64 ビットの値を作る
+    img = img.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(img.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def inspect_image(path):
+    # ワーカープロセスで実行される
+    try:
+        digest = file_digest(path)
+        with Image.open(path) as img:
+            img.verify()
+        with Image.open(path) as img:
+            width, height = img.size
+            exif = img.getexif()
+            taken = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+            img.draft("L", (64, 64))
+            phash = dhash(img)
+    except Exception as e:
+        return {"path": path, "error": str(e)}
+    return {
+        "path": path,
+        "digest": digest,
+        "phash": phash,
+        "width": width,
+        "height": height,
+        "taken": str(taken) if taken else None,
+    }
+
+
+class _BKTree:
+    # ハミング距離で近いハッシュを探すための BK 木
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, path):
+        node = [value, path, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = bin(current[0] ^ value).count("1")
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def find(self, value, max_distance):
+        if self.root is None:
+            return None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = bin(node[0] ^ value).count("1")
+            if distance <= max_distance:
+                return node[1], distance
+            for d, child in node[2].items():
+                if distance - max_distance <= d <= distance + max_distance:
+                    stack.append(child)
+        return None
+
+
+class ImportResult:
+    def __init__(self):
+        self.accepted = []     # 取り込む写真の情報 (撮影日時順)
+        self.exact = []        # (パス, 同じ内容の写真)
+        self.near = []         # (情報, よく似た写真, 距離)
+        self.errors = []       # (パス, エラー内容)
+        self.cancelled = False
+
+
+def import_album(paths, existing=(), workers=None, progress=None, cancelled=None,
+                 max_distance=NEAR_DUPLICATE_DISTANCE):
+    existing = [p for p in existing if os.path.exists(p)]
+    existing_set = set(existing)
+    targets = existing + [p for p in paths if p not in existing_set]
+    result = ImportResult()
+    digests = {}
+    tree = _BKTree()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for done, info in enumerate(executor.map(inspect_image, targets, chunksize=8), 1):
+            if cancelled is not None and cancelled():
+                executor.shutdown(wait=False, cancel_futures=True)
+                result.cancelled = True
+                break
+            is_existing = done <= len(existing)
+            path = info["path"]
+            if "error" in info:
+                if not is_existing:
+                    result.errors.append((path, info["error"]))
+            elif info["digest"] in digests:
+                if not is_existing:
+                    result.exact.append((path, digests[info["digest"]]))
+            else:
+                match = None if is_existing else tree.find(info["phash"], max_distance)
+                if match is not None:
+                    result.near.append((info, match[0], match[1]))
+                else:
+                    digests[info["digest"]] = path
+                    tree.add(info["phash"], path)
+                    if not is_existing:
+                        result.accepted.append(info)
+            if progress is not None:
+                progress(done, len(targets))
+
+    result.accepted.sort(key=lambda info: (info["taken"] or "", info["path"]))
+    return result
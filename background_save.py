@@ -0,0 +1,106 @@
+import queue
+import threading
+
+import train_model
+
+# 保存をワーカースレッドで行う
+# Tk のスレッドでは系列・編成・車両リストの骨組みだけを写し (model.snapshot)、
+# 車両の変換・JSON 化・書き込みはワーカーで行うので、保存中も編集を続けられる。
+# 保存中にさらに保存を頼まれたら、今の保存が終わったときに一度だけ行う
+# (写しはそのときに取るので、それまでの変更がまとめて入る)。
+
+POLL_MS = 100
+
+
+class SaveJob:
+    def __init__(self, path, series_data, retired_data, generation=None, on_done=None):
+        self.path = path
+        self.series_data = series_data
+        self.retired_data = retired_data
+        self.generation = generation
+        self.on_done = on_done  # on_done(error) は Tk のスレッドで呼ばれる (成功なら None)
+
+
+class BackgroundSaver:
+    def __init__(self, root, on_progress=None):
+        self.root = root
+        self.on_progress = on_progress  # on_progress(done, total)。total が 0 なら終了
+        self.messages = queue.Queue()
+        self.job = None
+        self.thread = None
+        self.queued = None  # 次に行う保存の準備 (呼ぶと SaveJob を返す)
+        self.polling = False
+
+    def busy(self):
+        return self.job is not None
+
+    def request(self, prepare):
+        # prepare は書き出せるようになったときに Tk のスレッドで呼ばれる。
+        # 保存中なら前の依頼を置き換えて待たせる
+        if self.busy():
+            self.queued = prepare
+            return False
+        self._start(prepare())
+        return True
+
+    def _start(self, job):
+        if job is None:
+            return
+        self.job = job
+        self.thread = threading.Thread(target=self._run, args=(job,), daemon=True)
+        self.thread.start()
+        if not self.polling:
+            self.polling = True
+            self.root.after(POLL_MS, self._poll)
+
+    def _run(self, job):
+        # ワーカースレッド側
+        try:
+            train_model.save_json(job.path, job.series_data, job.retired_data, job.generation,
+                                  progress=lambda done, total: self.messages.put(("progress", done, total)))
+            self.messages.put(("done", None))
+        except Exception as e:
+            self.messages.put(("done", e))
+
+    def _poll(self):
+        if not self.busy():
+            # wait() で先に片付いた
+            self.polling = False
+            return
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                if self.on_progress is not None:
+                    self.on_progress(message[1], message[2])
+            else:
+                self._finish(message[1])
+                break
+        if self.busy():
+            self.root.after(POLL_MS, self._poll)
+        else:
+            self.polling = False
+
+    def _finish(self, error):
+        job, self.job, self.thread = self.job, None, None
+        if self.on_progress is not None:
+            self.on_progress(0, 0)
+        if job.on_done is not None:
+            job.on_done(error)
+        if self.queued is not None and not self.busy():
+            prepare, self.queued = self.queued, None
+            self._start(prepare())
+
+    def wait(self):
+        # 終了するときなどに、保存中と保存待ちのものを書き終えるまで待つ
+        while self.busy():
+            self.thread.join()
+            error = None
+            while True:
+                message = self.messages.get()
+                if message[0] == "done":
+                    error = message[1]
+                    break
+            self._finish(error)
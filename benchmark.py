@@ -0,0 +1,307 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import train_model
+from car_tags import TagIndex, car_mask
+from change_events import ChangeBus
+from search_index import SearchIndex
+from synthetic_project import generate_project, write_project
+
+# 主な操作のベンチマーク
+# synthetic_project で作ったプロジェクトに対して、読み込み・保存・一覧の更新・
+# コピー・タイプの編集・写真のプレビューの時間を画面を出さずに測り、結果を
+# JSON に書く。--compare で以前の結果と比べられる。
+#   python benchmark.py --series 200 --formations 50 --cars 10 -o results.json
+#   python benchmark.py --compare before.json after.json
+# 一覧 (系列・編成・車両) の全行の文字列と色を作る時間は画面無しで測る。
+# 実際のウィンドウでの描き直しは、画面があるとき (DISPLAY が設定されている
+# とき) だけ測る。
+
+DEFAULT_REPEAT = 5
+EDIT_COUNT = 1000
+
+
+class Benchmark:
+    def __init__(self, repeat=DEFAULT_REPEAT):
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name, func, setup=None, repeat=None):
+        # setup() の戻り値を func に渡す (setup の時間は含めない)
+        times = []
+        for _ in range(repeat or self.repeat):
+            arg = setup() if setup is not None else None
+            start = time.perf_counter()
+            if setup is not None:
+                func(arg)
+            else:
+                func()
+            times.append(time.perf_counter() - start)
+        self.results[name] = {"median": statistics.median(times), "min": min(times), "runs": len(times)}
+        print(f"{name:32s} {self.results[name]['median'] * 1000:10.1f} ms")
+
+    def skip(self, name, reason):
+        self.results[name] = {"skipped": reason}
+        print(f"{name:32s} {'-':>10s}    ({reason})")
+
+
+def _app_bus(series_data):
+    # アプリと同じ購読者 (検索・タイプ・統計) を付けた ChangeBus
+    changes = ChangeBus()
+    search_index = SearchIndex()
+    search_index.reset(series_data)
+    search_index.ensure_built()
+    tag_index = TagIndex()
+    tag_index.reset(series_data)
+    changes.subscribe(search_index.apply_change)
+    changes.subscribe(tag_index.apply_change)
+    try:
+        from fleet_stats import FleetStats
+    except ImportError:
+        return changes
+    fleet_stats = FleetStats()
+    fleet_stats.reset(series_data)
+    fleet_stats.ensure_built()
+    changes.subscribe(fleet_stats.apply_change)
+    return changes
+
+
+def run_core(bench, project_path, work_dir):
+    series_data, retired_data = train_model.load_json(project_path)
+    names = list(series_data)
+
+    bench.measure("load_json", lambda: train_model.load_json(project_path))
+    save_path = os.path.join(work_dir, "saved.json")
+    bench.measure("save_json", lambda: train_model.save_json(save_path, series_data, retired_data))
+    bench.measure("snapshot", lambda: train_model.snapshot(series_data, retired_data))
+
+    # 索引の組み立て
+    def build_search():
+        index = SearchIndex()
+        index.reset(series_data)
+        index.ensure_built()
+    bench.measure("search_index_build", build_search, repeat=min(bench.repeat, 3))
+    bench.measure("tag_index_build", lambda: TagIndex().reset(series_data))
+    try:
+        from fleet_stats import FleetStats
+    except ImportError:
+        bench.skip("fleet_stats_build", "NumPy がありません")
+    else:
+        def build_stats():
+            stats = FleetStats()
+            stats.reset(series_data)
+            stats.ensure_built()
+        bench.measure("fleet_stats_build", build_stats)
+
+    # 一覧に出す内容 (系列ごとの編成数・両数・タイプ別の両数)
+    bench.measure("series_counts", lambda: train_model.project_counts(series_data))
+    bench.measure("tag_mismatches", lambda: train_model.tag_mismatches(series_data))
+
+    # 一覧の全行の文字列と色 (VirtualListbox が表示する行ごとに作るもの)
+    def series_rows():
+        for name, series in series_data.items():
+            train_model.series_row(name, len(series.get("formations", [])))
+
+    tag_index = TagIndex()
+    tag_index.reset(series_data)
+
+    def formation_rows():
+        # タイプで絞り込んだ一覧 (先頭のタイプ) と絞り込み無しの一覧
+        for series in series_data.values():
+            formations = series.get("formations", [])
+            for i in tag_index.formations_with(formations, 1):
+                train_model.formation_row(formations[i])
+            for formation in formations:
+                train_model.formation_row(formation)
+
+    def car_rows():
+        for series in series_data.values():
+            for formation in series.get("formations", []):
+                for car in formation.get("cars", []):
+                    train_model.car_row(car)
+
+    bench.measure("series_list_rows", series_rows)
+    bench.measure("formation_list_rows", formation_rows)
+    bench.measure("car_list_rows", car_rows)
+
+    # 変更操作 (アプリと同じ購読者を付けた状態で EDIT_COUNT 回)
+    def fresh():
+        data, retired = train_model.load_json(project_path)
+        return data, _app_bus(data)
+
+    def copy_formations(state):
+        data, changes = state
+        for i in range(EDIT_COUNT):
+            name = names[i % len(names)]
+            train_model.copy_formation(changes, name, data[name], 0)
+
+    def copy_cars(state):
+        data, changes = state
+        for i in range(EDIT_COUNT):
+            name = names[i % len(names)]
+            train_model.copy_car(changes, name, data[name]["formations"][0], 0)
+
+    def edit_tags(state):
+        data, changes = state
+        for i in range(EDIT_COUNT):
+            name = names[i % len(names)]
+            formation = data[name]["formations"][i // len(names) % len(data[name]["formations"])]
+            car = formation["cars"][0].copy()
+            car["tags"] = car_mask(car) ^ 1
+            train_model.put_car(changes, name, formation, car, 0)
+
+    repeat = min(bench.repeat, 3)
+    bench.measure(f"copy_formation_x{EDIT_COUNT}", copy_formations, setup=fresh, repeat=repeat)
+    bench.measure(f"copy_car_x{EDIT_COUNT}", copy_cars, setup=fresh, repeat=repeat)
+    bench.measure(f"edit_tags_x{EDIT_COUNT}", edit_tags, setup=fresh, repeat=repeat)
+    return series_data
+
+
+def run_photos(bench, series_data, work_dir):
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        bench.skip("photo_preview_cold", "PIL がありません")
+        return
+    from thumbnail_cache import PREVIEW_SIZE, ThumbnailCache
+    paths = [photo["path"] for series in series_data.values() for formation in series.get("formations", [])
+             for photo in formation.get("photos", []) if os.path.exists(photo["path"])]
+    if not paths:
+        bench.skip("photo_preview_cold", "写真のファイルがありません")
+        return
+    counter = iter(range(1 << 30))
+
+    def cold_cache():
+        return ThumbnailCache(os.path.join(work_dir, f"thumbs{next(counter)}"))
+
+    bench.measure("photo_preview_cold", lambda cache: cache.load(paths[0], PREVIEW_SIZE), setup=cold_cache)
+    cache = cold_cache()
+    cache.load(paths[0], PREVIEW_SIZE)
+    bench.measure("photo_preview_warm", lambda: cache.load(paths[0], PREVIEW_SIZE))
+
+
+def run_gui(bench, project_path):
+    # 実際のウィンドウで一覧を描き直す時間を測る
+    if not os.environ.get("DISPLAY") and sys.platform.startswith("linux"):
+        for name in ("series_list_refresh", "series_window_open", "formation_window_open"):
+            bench.skip(name, "画面がありません")
+        return
+    import importlib.util
+    import tkinter as tk
+    here = os.path.dirname(os.path.abspath(__file__))
+    main_path = next(os.path.join(here, f) for f in sorted(os.listdir(here))
+                     if f.startswith("main") and f.endswith(".py"))
+    spec = importlib.util.spec_from_file_location("train_manager_main", main_path)
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+
+    root = tk.Tk()
+    root.withdraw()
+    app = main.TrainManagerApp(root)
+    app.series_data, app.retired_data = train_model.load_json(project_path)
+    app.rebuild_indexes()
+    name = next(iter(app.series_data))
+
+    def refresh():
+        app.update_series_list()
+        root.update()
+    bench.measure("series_list_refresh", refresh)
+
+    def open_series():
+        window = main.SeriesWindow(root, name, app.series_data[name], app.retired_data, app.retired_index,
+                                   app.changes, app.tag_index, app.fleet_stats)
+        root.update()
+        window.window.destroy()
+    bench.measure("series_window_open", open_series)
+
+    def open_formation():
+        formation = app.series_data[name]["formations"][0]
+        window = main.FormationWindow(root, name, formation, app.retired_data, app.retired_index,
+                                      app.changes)
+        root.update()
+        window.window.destroy()
+    bench.measure("formation_window_open", open_formation)
+    app.close_project(discard_untitled=True)
+    root.destroy()
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(before_path, after_path):
+    with open(before_path, "r", encoding="utf-8") as file:
+        before = json.load(file)["results"]
+    with open(after_path, "r", encoding="utf-8") as file:
+        after = json.load(file)["results"]
+    print(f"{'':32s} {'before':>10s} {'after':>10s} {'ratio':>7s}")
+    for name, result in after.items():
+        old = before.get(name, {})
+        if "median" not in result or "median" not in old:
+            continue
+        ratio = result["median"] / old["median"] if old["median"] else float("inf")
+        print(f"{name:32s} {old['median'] * 1000:8.1f}ms {result['median'] * 1000:8.1f}ms {ratio:6.2f}x")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark", description="主な操作の時間を測る")
+    parser.add_argument("--series", type=int, default=200)
+    parser.add_argument("--formations", type=int, default=50)
+    parser.add_argument("--cars", type=int, default=10)
+    parser.add_argument("--retired", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("-o", "--output", help="結果を書く JSON ファイル")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="2つの結果を比べる")
+    args = parser.parse_args(argv)
+    if args.compare:
+        return compare(*args.compare)
+
+    bench = Benchmark(args.repeat)
+    with tempfile.TemporaryDirectory(prefix="train_bench_") as work_dir:
+        # アプリのジャーナルやサムネイルが普段のフォルダに書かれないようにする
+        os.environ["HOME"] = os.environ["USERPROFILE"] = work_dir
+        project_path = os.path.join(work_dir, "project.json")
+        start = time.perf_counter()
+        project = generate_project(args.series, args.formations, args.cars, retired=args.retired, seed=args.seed,
+                                   photo_dir=os.path.join(work_dir, "photos"))
+        write_project(project_path, project)
+        del project
+        print(f"生成: {args.series}系列 × {args.formations}編成 × {args.cars}両 ({time.perf_counter() - start:.1f} s)")
+        series_data = run_core(bench, project_path, work_dir)
+        run_photos(bench, series_data, work_dir)
+        run_gui(bench, project_path)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "size": {"series": args.series, "formations": args.formations, "cars": args.cars,
+                     "retired": args.retired, "seed": args.seed},
+            "repeat": args.repeat,
+        },
+        "results": bench.results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f"{args.output} に書き出しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+import math
+import sys
+import threading
+from array import array
+from collections.abc import Mapping, MutableMapping
+
+from car_tags import UNKNOWN_TAGS, split_tags
+from cow_list import CowList
+
+# 列形式の車両ストア
+# 車両1両ごとに同じ8つのキーを持つ dict を作る代わりに、数値は array('d') の列、
+# タイプのビットマスクは array('H')、制御方式は文字列表への番号として行単位で持つ。
+# formation["cars"] には行を指す軽いビュー (Car) を入れ、Car は dict と同じ
+# car["name"] / car.get() / dict(car) で読み書きできる。Car が参照されなく
+# なると行は空き行として再利用される。列に無いキーや数値でない値は行ごとの
+# 予備の dict に入れる。
+
+NUMERIC_FIELDS = ("acceleration", "deceleration", "power_kw")
+CAR_FIELDS = ("name", "tags") + NUMERIC_FIELDS + ("control_method", "description")
+
+_MISSING = math.nan
+
+
+class CarStore:
+    def __init__(self):
+        self.lock = threading.RLock()  # Car.__del__ が GC から呼ばれても詰まらないように
+        self.names = []                 # 行 -> 車両名 (無ければ None)
+        self.tags = array("H")          # 行 -> 車両タイプのビットマスク
+        self.acceleration = array("d")  # 行 -> 加速度 (無ければ NaN)
+        self.deceleration = array("d")
+        self.power_kw = array("d")
+        self.control_methods = array("H")  # 行 -> 制御方式の番号 (0 は無し)
+        self.descriptions = []          # 行 -> 解説 (無ければ None)
+        self.extras = {}                # 行 -> 列に無いキーの dict
+        self.method_names = [None]      # 制御方式の番号 -> 文字列
+        self.method_ids = {}            # 制御方式の文字列 -> 番号
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.names) - len(self.free_rows)
+
+    def _allocate(self):
+        with self.lock:
+            if self.free_rows:
+                return self.free_rows.pop()
+            self.names.append(None)
+            self.tags.append(0)
+            self.acceleration.append(_MISSING)
+            self.deceleration.append(_MISSING)
+            self.power_kw.append(_MISSING)
+            self.control_methods.append(0)
+            self.descriptions.append(None)
+            return len(self.names) - 1
+
+    def release(self, row):
+        with self.lock:
+            self.names[row] = None
+            self.tags[row] = 0
+            self.acceleration[row] = _MISSING
+            self.deceleration[row] = _MISSING
+            self.power_kw[row] = _MISSING
+            self.control_methods[row] = 0
+            self.descriptions[row] = None
+            self.extras.pop(row, None)
+            self.free_rows.append(row)
+
+    def method_id(self, method):
+        method_id = self.method_ids.get(method)
+        if method_id is None:
+            method_id = len(self.method_names)
+            self.method_names.append(sys.intern(method))
+            self.method_ids[method] = method_id
+        return method_id
+
+    def new_car(self, values=()):
+        row = self._allocate()
+        if isinstance(values, Mapping):
+            values = values.items()
+        for key, value in values:
+            # 新しい行は空なので消さずに書くだけでよい
+            self._assign(row, key, value)
+        return Car(self, row)
+
+    def new_full_car(self, name, tags, acceleration, deceleration, power_kw, control_method, description):
+        # 全部の列が揃っていて型も確かめ済みの車両 (model.make_car・名簿の取り込み)
+        row = self._allocate()
+        self.names[row] = name
+        self.tags[row] = tags
+        self.acceleration[row] = acceleration
+        self.deceleration[row] = deceleration
+        self.power_kw[row] = power_kw
+        self.control_methods[row] = self.method_id(control_method)
+        self.descriptions[row] = sys.intern(description) if len(description) < 64 else description
+        return Car(self, row)
+
+    def _assign(self, row, key, value):
+        if key == "name" and isinstance(value, str):
+            self.names[row] = value
+        elif key == "tags" and isinstance(value, int) and not isinstance(value, bool):
+            self.tags[row] = value
+        elif key == "tags" and isinstance(value, (list, tuple)):
+            # 名前のリストは全部のタイプを表すので、知らない名前もここで置き換える
+            self.tags[row], unknown = split_tags(value)
+            extra = self.extras.get(row)
+            if unknown:
+                self.extras.setdefault(row, {})[UNKNOWN_TAGS] = unknown
+            elif extra is not None:
+                extra.pop(UNKNOWN_TAGS, None)
+                if not extra:
+                    del self.extras[row]
+        elif key in NUMERIC_FIELDS and isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.column(key)[row] = value
+        elif key == "control_method" and isinstance(value, str):
+            self.control_methods[row] = self.method_id(value)
+        elif key == "description" and isinstance(value, str):
+            self.descriptions[row] = sys.intern(value) if len(value) < 64 else value
+        else:
+            self.extras.setdefault(row, {})[key] = value
+
+    def column(self, field):
+        return getattr(self, field)
+
+
+class Car(MutableMapping):
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __del__(self):
+        try:
+            self.store.release(self.row)
+        except Exception:
+            pass  # 終了処理中
+
+    # ---- 読み出し ----
+
+    def _extra(self):
+        return self.store.extras.get(self.row, {})
+
+    def __getitem__(self, key):
+        store, row = self.store, self.row
+        if key == "name":
+            value = store.names[row]
+        elif key == "tags":
+            return store.tags[row]
+        elif key in NUMERIC_FIELDS:
+            value = store.column(key)[row]
+            if value == value:
+                return value
+            value = None
+        elif key == "control_method":
+            value = store.method_names[store.control_methods[row]]
+        elif key == "description":
+            value = store.descriptions[row]
+        else:
+            return self._extra()[key]
+        if value is None:
+            # 列に入らなかった値 (数値でない加速度など) は予備の dict にある
+            return self._extra()[key]
+        return value
+
+    def __iter__(self):
+        for key in CAR_FIELDS:
+            if key in self:
+                yield key
+        for key in self._extra():
+            if key not in CAR_FIELDS:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    # ---- 書き込み ----
+
+    def __setitem__(self, key, value):
+        if key in CAR_FIELDS:
+            self._clear_field(key)
+        self.store._assign(self.row, key, value)
+
+    def _clear_field(self, key):
+        store, row = self.store, self.row
+        if key == "name":
+            store.names[row] = None
+        elif key == "tags":
+            store.tags[row] = 0
+        elif key in NUMERIC_FIELDS:
+            store.column(key)[row] = _MISSING
+        elif key == "control_method":
+            store.control_methods[row] = 0
+        elif key == "description":
+            store.descriptions[row] = None
+        extra = store.extras.get(row)
+        if extra is not None:
+            extra.pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in CAR_FIELDS:
+            self._clear_field(key)
+        else:
+            extra = self.store.extras[self.row]
+            del extra[key]
+            if not extra:
+                del self.store.extras[self.row]
+
+    # ---- dict 互換 ----
+
+    def copy(self):
+        return self.store.new_car(self.items())
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce__(self):
+        # pickle では普通の dict として渡す
+        return (dict, (dict(self.items()),))
+
+    def __repr__(self):
+        return f"Car({dict(self.items())!r})"
+
+
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def shared_store():
+    global _shared_store
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = CarStore()
+        return _shared_store
+
+
+def new_car(values=()):
+    return shared_store().new_car(values)
+
+
+def new_full_car(name, tags, acceleration, deceleration, power_kw, control_method, description):
+    return shared_store().new_full_car(name, tags, acceleration, deceleration, power_kw, control_method,
+                                       description)
+
+
+def decode_series_data(series_data):
+    # 読み込んだ JSON の車両 (dict) を Car に置き換える。色はタイプから求めるので捨てる
+    store = shared_store()
+    for series in series_data.values():
+        for formation in series.get("formations", []):
+            formation["cars"] = CowList(
+                store.new_car((key, value) for key, value in car.items() if key != "color")
+                for car in formation.get("cars", [])
+            )
+    return series_data
+
+
+def car_rows(cars):
+    # cars がすべて共有ストアの Car なら行番号の列、そうでなければ None
+    store = shared_store()
+    rows = array("q")
+    for car in cars:
+        if car.__class__ is not Car or car.store is not store:
+            return None
+        rows.append(car.row)
+    return rows
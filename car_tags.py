@@ -0,0 +1,298 @@
+import re
+
+# 車両タイプ (タグ) のビットマスク
+# 車両のタグはメモリ上では CAR_TYPES の並び順に1ビットずつ割り当てた整数で持つ。
+# JSON・データベースには従来どおり名前のリストと色で書き、読み書きの境目で
+# 変換する。TagIndex は編成ごと・系列ごとにタイプ別の両数とビットの和を持ち、
+# 「食堂車を含む編成」や「系列ごとの電動車の両数」をビット演算で答える。
+
+# 車両形式の辞書
+CAR_TYPES = {
+    "ク": "制御車",
+    "モ": "電動車",
+    "ロ": "グリーン車",
+    "ハ": "普通車",
+    "ネ": "寝台車",
+    "シ": "食堂車",
+    "ユ": "郵便車",
+    "ニ": "荷物車",
+    "エ": "救援車",
+    "ヤ": "職用車",
+    "ル": "配給車",
+    "キ": "気動車"
+}
+
+# 車両タイプの色
+CAR_TYPE_COLORS = {
+    "制御車": "orange",
+    "電動車": "blue",
+    "グリーン車": "green",
+    "普通車": "grey",
+    "寝台車": "darkblue",
+    "食堂車": "brown",
+    "郵便車": "cyan",
+    "荷物車": "darkgreen",
+    "救援車": "red",
+    "職用車": "purple",
+    "配給車": "pink",
+    "気動車": "yellow"
+}
+
+TAG_NAMES = tuple(CAR_TYPES.values())
+TAG_BITS = {name: 1 << i for i, name in enumerate(TAG_NAMES)}
+
+# CAR_TYPES に無いタイプ名は捨てずに、車両のこのキーに名前のリストとして残し、
+# 書き出すときに tags へ戻す
+UNKNOWN_TAGS = "unknown_tags"
+
+# マスク -> 立っているビットの番号 (12ビットなので全部前もって作る)
+_MASK_BITS = tuple(tuple(i for i in range(len(TAG_NAMES)) if mask >> i & 1) for mask in range(1 << len(TAG_NAMES)))
+_MASK_TAGS = tuple(tuple(TAG_NAMES[i] for i in bits) for bits in _MASK_BITS)
+
+
+def tags_to_mask(tags):
+    # 知らないタイプ名は無視する (残すときは split_tags)
+    mask = 0
+    for tag in tags:
+        mask |= TAG_BITS.get(tag, 0)
+    return mask
+
+
+def split_tags(tags):
+    # (知っているタイプのマスク, 知らないタイプ名のリスト)
+    mask = 0
+    unknown = []
+    for tag in tags:
+        bit = TAG_BITS.get(tag)
+        if bit is not None:
+            mask |= bit
+        elif tag not in unknown:
+            unknown.append(tag)
+    return mask, unknown
+
+
+def mask_to_tags(mask):
+    return _MASK_TAGS[mask]
+
+
+def mask_color(mask):
+    # 一番前のタイプの色
+    bits = _MASK_BITS[mask]
+    return CAR_TYPE_COLORS[TAG_NAMES[bits[0]]] if bits else "black"
+
+
+def car_mask(car):
+    return car.get("tags", 0)
+
+
+def car_tag_names(car):
+    # 書き出すタイプ名 (知らないタイプ名も含める)
+    return list(mask_to_tags(car_mask(car))) + list(car.get(UNKNOWN_TAGS, ()))
+
+
+# ---- 車両名からの推定 ----
+# 「クハ205-1」「キハ40 2001」のように、車両名の先頭のカタカナは形式記号の
+# 並びになっている。記号 (CAR_TYPES と、タイプを持たない付随車「サ」・緩急車
+# 「フ」・客車の重量記号) のトライを前もって作り、先頭のカタカナ全体が記号だけで
+# 読めたときにタイプを決める。「ハイブリッド」のように読み切れない名前は推定しない。
+# 読んだ結果はカタカナの並びごとに覚えておくので、まとめて調べるときは名前1つに
+# つき正規表現と辞書引き1回で済む。
+
+NAME_CODES = {code: TAG_BITS[name] for code, name in CAR_TYPES.items()}
+NAME_CODES.update(dict.fromkeys(("サ", "フ", "コ", "ホ", "ナ", "オ", "ス", "マ", "カ"), 0))
+
+
+def _build_trie(codes):
+    # ノードは {文字: 子ノード}。記号の終わりのノードは None キーにビットを持つ
+    root = {}
+    for code, bit in codes.items():
+        node = root
+        for c in code:
+            node = node.setdefault(c, {})
+        node[None] = bit
+    return root
+
+
+_CODE_TRIE = _build_trie(NAME_CODES)
+_KATAKANA_PREFIX = re.compile(r"[\u30a1-\u30fa\u30fc]+")
+_prefix_masks = {}
+
+
+def _parse_codes(prefix):
+    # 記号の並びとして最長一致で読み、読み切れなければ None
+    mask = 0
+    position = 0
+    while position < len(prefix):
+        node = _CODE_TRIE
+        matched = None
+        i = position
+        while i < len(prefix) and prefix[i] in node:
+            node = node[prefix[i]]
+            i += 1
+            if None in node:
+                matched = (i, node[None])
+        if matched is None:
+            return None
+        position, bit = matched
+        mask |= bit
+    return mask or None
+
+
+def infer_mask(name):
+    # 車両名の先頭の形式記号からタイプのビットマスクを求める (分からなければ None)
+    match = _KATAKANA_PREFIX.match(name)
+    if match is None:
+        return None
+    prefix = match.group()
+    try:
+        return _prefix_masks[prefix]
+    except KeyError:
+        mask = _prefix_masks[prefix] = _parse_codes(prefix)
+        return mask
+
+
+# ---- 読み書きの境目での変換 ----
+
+def encode_car(car):
+    # 書き出し用の写し (タグの名前のリストと色を付ける)
+    mask = car_mask(car)
+    encoded = dict(car)
+    encoded["tags"] = car_tag_names(car)
+    encoded.pop(UNKNOWN_TAGS, None)
+    encoded["color"] = mask_color(mask)
+    return encoded
+
+
+def encode_series(series):
+    encoded = dict(series)
+    encoded["formations"] = [
+        dict(formation, cars=[encode_car(car) for car in formation.get("cars", [])])
+        for formation in series.get("formations", [])
+    ]
+    return encoded
+
+
+def encode_series_data(items):
+    return {name: encode_series(series) for name, series in items}
+
+
+# ---- 集計 ----
+
+def _add_counts(counts, cars):
+    for car in cars:
+        for bit in _MASK_BITS[car.get("tags", 0)]:
+            counts[bit] += 1
+
+
+def counts_mask(counts):
+    mask = 0
+    for bit, count in enumerate(counts):
+        if count:
+            mask |= 1 << bit
+    return mask
+
+
+class TagIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.formation_counts = {}  # id(編成) -> [タイプ別の両数]
+        self.formation_masks = {}   # id(編成) -> 含むタイプのマスク
+        self.series_counts = {}     # 系列名 -> [タイプ別の両数]
+        self.series_masks = {}      # 系列名 -> 含むタイプのマスク
+
+    def reset(self, series_data):
+        # series_data の値が None の系列 (未読み込み) は読み込まれたときに数える
+        self.clear()
+        for name, series in series_data.items():
+            self.add_series(name, series)
+
+    def add_series(self, name, series):
+        self.series_counts[name] = [0] * len(TAG_NAMES)
+        self.series_masks[name] = 0
+        if series is not None:
+            for formation in series.get("formations", []):
+                self.add_formation(name, formation)
+
+    def remove_series(self, name, series, keep_name=False):
+        if series is not None:
+            for formation in series.get("formations", []):
+                self.formation_counts.pop(id(formation), None)
+                self.formation_masks.pop(id(formation), None)
+        if keep_name:
+            self.series_counts[name] = [0] * len(TAG_NAMES)
+            self.series_masks[name] = 0
+        else:
+            self.series_counts.pop(name, None)
+            self.series_masks.pop(name, None)
+
+    def add_formation(self, series_name, formation):
+        counts = [0] * len(TAG_NAMES)
+        _add_counts(counts, formation.get("cars", []))
+        self._replace_formation(series_name, formation, counts)
+
+    def remove_formation(self, series_name, formation):
+        self._replace_formation(series_name, formation, None)
+
+    def _replace_formation(self, series_name, formation, counts):
+        # 編成の両数を差し替え、差分だけ系列の両数に足す
+        key = id(formation)
+        old = self.formation_counts.pop(key, None)
+        self.formation_masks.pop(key, None)
+        series_counts = self.series_counts.get(series_name)
+        if series_counts is None:
+            return
+        if old is not None:
+            for bit, count in enumerate(old):
+                series_counts[bit] -= count
+        if counts is not None:
+            self.formation_counts[key] = counts
+            self.formation_masks[key] = counts_mask(counts)
+            for bit, count in enumerate(counts):
+                series_counts[bit] += count
+        self.series_masks[series_name] = counts_mask(series_counts)
+
+    def apply_change(self, event):
+        if event.kind == "series":
+            if event.action == "insert":
+                self.add_series(event.series, event.value)
+            elif event.action == "remove":
+                self.remove_series(event.series, event.value)
+        elif event.kind == "formation":
+            if event.action == "insert":
+                self.add_formation(event.series, event.value)
+            elif event.action == "remove":
+                self.remove_formation(event.series, event.value)
+        elif event.kind == "car" and id(event.formation) in self.formation_counts:
+            # 更新前の車両はイベントに残らないので編成の分だけ数え直す
+            self.add_formation(event.series, event.formation)
+
+    def on_series_loaded(self, action, name, series):
+        # 遅延読み込みの系列が読み込まれた / メモリから外されたとき
+        if action == "load":
+            self.add_series(name, series)
+        else:
+            self.remove_series(name, series, keep_name=True)
+
+    # ---- 問い合わせ ----
+
+    def formation_mask(self, formation):
+        return self.formation_masks.get(id(formation), 0)
+
+    def series_mask(self, series_name):
+        return self.series_masks.get(series_name, 0)
+
+    def counts(self, series_name):
+        # {タイプ名: 両数} (0 両のタイプは含めない)
+        counts = self.series_counts.get(series_name, ())
+        return {TAG_NAMES[bit]: count for bit, count in enumerate(counts) if count}
+
+    def series_with(self, mask):
+        # mask のタイプをすべて含む系列名
+        return [name for name, series_mask in self.series_masks.items() if series_mask & mask == mask]
+
+    def formations_with(self, formations, mask):
+        # formations のうち mask のタイプをすべて含むものの位置
+        masks = self.formation_masks
+        return [i for i, formation in enumerate(formations) if masks.get(id(formation), 0) & mask == mask]
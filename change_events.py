@@ -0,0 +1,41 @@
+# データ変更の通知
+# 各ウィンドウはデータを書き換えた直後に ChangeBus.emit() を呼び、
+# 保存先などの購読者はイベント単位で差分を反映する。
+#
+# action: "insert" / "remove" / "update"
+# kind:   "series" / "formation" / "car" / "series_photo" / "formation_photo" / "retired"
+
+
+class ChangeEvent:
+    __slots__ = ("action", "kind", "series", "formation", "index", "value")
+
+    def __init__(self, action, kind, series=None, formation=None, index=None, value=None):
+        self.action = action
+        self.kind = kind
+        self.series = series          # 系列名
+        self.formation = formation    # 対象の編成 (dict)
+        self.index = index            # 親リスト内の位置
+        self.value = value            # 追加・更新後の値 / 削除された値
+
+    def __repr__(self):
+        return f"ChangeEvent({self.action!r}, {self.kind!r}, series={self.series!r}, index={self.index!r})"
+
+
+class ChangeBus:
+    def __init__(self):
+        self.listeners = []
+
+    def subscribe(self, listener):
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def emit(self, action, kind, **kwargs):
+        if not self.listeners:
+            return
+        event = ChangeEvent(action, kind, **kwargs)
+        for listener in list(self.listeners):
+            listener(event)
@@ -0,0 +1,43 @@
+# 写しと共有するリスト (copy-on-write)
+# 編成をコピーするときは車両・写真のリストを複製せずに同じ CowList を指させ、
+# owners に共有している編成の数を持つ。リストを書き換える操作は先に own() を
+# 呼び、共有中ならそのときに自分の分だけを複製する。リストの中身 (Car や
+# 写真の dict) は書き換えずに置き換える決まりなので、要素は複製しない。
+
+
+class CowList(list):
+    __slots__ = ("owners",)
+
+    def __init__(self, items=()):
+        super().__init__(items)
+        self.owners = 1
+
+
+def share(container, key):
+    # container[key] を写しと共有し、写しに入れるリストを返す
+    items = container.get(key)
+    if items is None:
+        items = container[key] = CowList()
+    elif items.__class__ is not CowList:
+        # 読み込んだままのリストは最初のコピーのときだけ置き換える
+        items = container[key] = CowList(items)
+    items.owners += 1
+    return items
+
+
+def own(container, key):
+    # 書き換える前に呼ぶ。共有中なら複製して差し替え、自分のリストを返す
+    items = container.get(key)
+    if items is None:
+        items = container[key] = CowList()
+    elif items.__class__ is CowList and items.owners > 1:
+        items.owners -= 1
+        items = container[key] = CowList(items)
+    return items
+
+
+def release(container, key):
+    # 編成を削除したときに呼び、共有している相手に持ち主を譲る
+    items = container.get(key)
+    if items.__class__ is CowList and items.owners > 1:
+        items.owners -= 1
@@ -0,0 +1,181 @@
+import bisect
+import functools
+import io
+import json
+import os
+import threading
+import time
+
+# 操作の時間の計測 (診断用)
+# @timed を付けたコマンドの処理時間と、after() の心拍で測る Tk のイベント
+# ループの遅れを、回数と対数目盛りのヒストグラムとして記録する。有効にしない
+# 限り @timed は enabled を1回見るだけで元の関数を呼ぶ。profile_next() を
+# 呼ぶと、次に計測する操作1回だけを cProfile で記録する。
+# 環境変数 TRAIN_MANAGER_DIAGNOSTICS=1 で起動時から有効にできる。
+
+# ヒストグラムの区切り (ミリ秒)。最後の区間はそれより長いもの
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+HEARTBEAT_MS = 100
+EVENT_LOOP_LAG = "(イベントループの遅れ)"
+PROFILE_LINES = 40
+
+
+class Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+
+    def percentile(self, p):
+        # 区間の上端で答える (最後の区間は最大値)
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                return min(BUCKETS_MS[i], self.max) if i < len(BUCKETS_MS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "max_ms": self.max,
+            "buckets": dict(zip([f"<={b}ms" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"], self.buckets)),
+        }
+
+
+class Diagnostics:
+    def __init__(self):
+        self.enabled = os.environ.get("TRAIN_MANAGER_DIAGNOSTICS") == "1"
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.profile_armed = False
+        self.profile_name = None
+        self.profile_text = ""
+        self.heartbeat_root = None
+        self.heartbeat_due = None
+
+    def record(self, name, ms):
+        # ワーカースレッドからも呼ばれる
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(ms)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def snapshot(self):
+        # 名前 -> 集計の dict (時間の合計が多い順)
+        with self.lock:
+            items = sorted(self.histograms.items(), key=lambda item: -item[1].total)
+            return {name: histogram.to_dict() for name, histogram in items}
+
+    # ---- 計測 ----
+
+    def call(self, name, func, args, kwargs):
+        if self.profile_armed:
+            return self._profile(name, func, args, kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def profile_next(self):
+        self.profile_armed = True
+
+    def _profile(self, name, func, args, kwargs):
+        import cProfile
+        import pstats
+        self.profile_armed = False
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.record(name, elapsed)
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            self.profile_name = name
+            self.profile_text = f"{name}: {elapsed:.1f} ms\n{out.getvalue()}"
+
+    # ---- イベントループの心拍 ----
+
+    def start_heartbeat(self, root):
+        # after() で予定した時刻からどれだけ遅れて呼ばれたかを記録する
+        self.heartbeat_root = root
+        if self.enabled and self.heartbeat_due is None:
+            self.heartbeat_due = time.perf_counter() + HEARTBEAT_MS / 1000
+            root.after(HEARTBEAT_MS, self._heartbeat)
+
+    def _heartbeat(self):
+        if not self.enabled:
+            self.heartbeat_due = None
+            return
+        now = time.perf_counter()
+        self.record(EVENT_LOOP_LAG, max(0.0, (now - self.heartbeat_due) * 1000))
+        self.heartbeat_due = now + HEARTBEAT_MS / 1000
+        self.heartbeat_root.after(HEARTBEAT_MS, self._heartbeat)
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if enabled and self.heartbeat_root is not None:
+            self.start_heartbeat(self.heartbeat_root)
+
+    # ---- 書き出し ----
+
+    def dump(self, path):
+        report = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "operations": self.snapshot(),
+            "profile": self.profile_text,
+        }
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+_shared_diagnostics = Diagnostics()
+
+
+def shared_diagnostics():
+    return _shared_diagnostics
+
+
+def timed(func=None, name=None):
+    # @timed / @timed(name="...") を付けた関数の時間を、有効なときだけ記録する
+    if func is None:
+        return functools.partial(timed, name=name)
+    label = name or func.__qualname__
+    diagnostics = _shared_diagnostics
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not diagnostics.enabled:
+            return func(*args, **kwargs)
+        return diagnostics.call(label, func, args, kwargs)
+    return wrapper
+
+
+def record(name, ms):
+    # 関数の外で測った時間 (ワーカーでの画像の復号など) を記録する
+    if _shared_diagnostics.enabled:
+        _shared_diagnostics.record(name, ms)
@@ -0,0 +1,297 @@
+import math
+
+import numpy as np
+
+from car_store import car_rows, shared_store
+from car_tags import TAG_BITS
+
+# 車両性能の統計
+# 全車両の加速度・減速度・出力を NumPy の列 (編成の並び順に連続) として持ち、
+# 編成ごとの先頭位置 (offsets) で区切って集計する。編成・系列・全体の集計は
+# 列に対するまとめての計算で一度に行い、車両の追加・削除・編集のときは
+# その編成の区間だけを差し替えて編成の集計を取り直す。系列と全体の集計は
+# 次に問い合わせがあったときにまとめて計算し直す。
+
+FIELDS = ("acceleration", "deceleration", "power_kw")
+MOTOR_BIT = TAG_BITS["電動車"]
+
+# 系列ごとの分布 (最小・四分位・最大) と全体のパーセンタイル
+QUANTILES = (0.0, 0.25, 0.5, 0.75, 1.0)
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _car_values(cars):
+    # (加速度, 減速度, 出力, 電動車か) の列
+    rows = car_rows(cars)
+    if rows is not None:
+        # 共有ストアの車両なら列から行番号でまとめて取り出す
+        store = shared_store()
+        rows = np.frombuffer(rows, dtype=np.int64)
+        with store.lock:
+            columns = [np.frombuffer(store.column(field), dtype=np.float64)[rows] for field in FIELDS]
+            columns.append((np.frombuffer(store.tags, dtype=np.uint16)[rows] & MOTOR_BIT) != 0)
+        return columns
+    columns = [np.array([_number(car.get(field)) for car in cars], dtype=np.float64) for field in FIELDS]
+    columns.append(np.array([bool(car.get("tags", 0) & MOTOR_BIT) for car in cars], dtype=bool))
+    return columns
+
+
+def _segment_sums(values, offsets):
+    sums = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+    return sums[offsets[1:]] - sums[offsets[:-1]]
+
+
+class FleetStats:
+    def __init__(self):
+        self.series_data = None
+        self.dirty = True
+
+    def reset(self, series_data):
+        # 値が None の系列 (未読み込み) は集計に含めない
+        self.series_data = series_data
+        self.dirty = True
+
+    # ---- 列の組み立て ----
+
+    def _build(self):
+        self.series_names = []
+        self.formation_slots = {}   # id(編成) -> 編成の番号
+        formation_series = []
+        cars = []
+        counts = []
+        for name, series in (self.series_data or {}).items():
+            if series is None:
+                continue
+            series_slot = len(self.series_names)
+            self.series_names.append(name)
+            for formation in series.get("formations", []):
+                self.formation_slots[id(formation)] = len(counts)
+                formation_series.append(series_slot)
+                formation_cars = formation.get("cars", [])
+                counts.append(len(formation_cars))
+                cars.extend(formation_cars)
+
+        self.acceleration, self.deceleration, self.power_kw, self.motor = _car_values(cars)
+        self.offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        self.formation_series = np.array(formation_series, dtype=np.int64)
+        self._aggregate_formations()
+        self.series_result = None
+        self.fleet_result = None
+        self.dirty = False
+
+    def _aggregate_formations(self):
+        offsets = self.offsets
+        self.car_counts = np.diff(offsets)
+        self.total_kw = _segment_sums(np.nan_to_num(self.power_kw), offsets)
+        self.motors = _segment_sums(self.motor, offsets).astype(np.int64)
+        valid = ~np.isnan(self.acceleration)
+        accel_counts = _segment_sums(valid, offsets)
+        accel_sums = _segment_sums(np.where(valid, self.acceleration, 0.0), offsets)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.mean_acceleration = accel_sums / accel_counts
+        self.min_acceleration = np.full(len(self.car_counts), np.nan)
+        starts = offsets[:-1][self.car_counts > 0]
+        if len(starts):
+            # 空の編成を除けば区間は隙間なく並ぶので reduceat がそのまま使える
+            self.min_acceleration[self.car_counts > 0] = np.fmin.reduceat(self.acceleration, starts)
+
+    def _splice_formation(self, slot, cars):
+        # 編成1つ分の区間を差し替え、その編成の集計だけ取り直す
+        start, end = self.offsets[slot], self.offsets[slot + 1]
+        acceleration, deceleration, power_kw, motor = _car_values(cars)
+        if len(cars) == end - start:
+            # 両数が同じ (車両の更新) なら区間をその場で書き換える
+            self.acceleration[start:end] = acceleration
+            self.deceleration[start:end] = deceleration
+            self.power_kw[start:end] = power_kw
+            self.motor[start:end] = motor
+        else:
+            self.acceleration = np.concatenate((self.acceleration[:start], acceleration, self.acceleration[end:]))
+            self.deceleration = np.concatenate((self.deceleration[:start], deceleration, self.deceleration[end:]))
+            self.power_kw = np.concatenate((self.power_kw[:start], power_kw, self.power_kw[end:]))
+            self.motor = np.concatenate((self.motor[:start], motor, self.motor[end:]))
+            self.offsets[slot + 1:] += len(cars) - (end - start)
+
+        end = start + len(cars)
+        accel = self.acceleration[start:end]
+        self.car_counts[slot] = len(cars)
+        self.total_kw[slot] = np.nansum(self.power_kw[start:end])
+        self.motors[slot] = np.count_nonzero(self.motor[start:end])
+        valid = accel[~np.isnan(accel)]
+        self.mean_acceleration[slot] = valid.mean() if len(valid) else np.nan
+        self.min_acceleration[slot] = valid.min() if len(valid) else np.nan
+        self.series_result = None
+        self.fleet_result = None
+
+    def ensure_built(self):
+        if self.dirty:
+            self._build()
+
+    # ---- 変更イベント ----
+
+    def apply_change(self, event):
+        if event.kind == "car":
+            if self.dirty:
+                return
+            slot = self.formation_slots.get(id(event.formation))
+            if slot is not None:
+                self._splice_formation(slot, event.formation.get("cars", []))
+        elif event.kind == "series":
+            # 遅延読み込みのときは series_data が系列名の写しなので合わせておく
+            if event.action == "insert":
+                self.series_data.setdefault(event.series, event.value)
+            elif event.action == "remove":
+                self.series_data.pop(event.series, None)
+            self.dirty = True
+        elif event.kind == "formation" and event.action != "update":
+            # 編成の並びが変わったときは次の問い合わせで組み立て直す
+            self.dirty = True
+
+    def on_series_loaded(self, action, name, series):
+        # 遅延読み込みの系列が読み込まれた / メモリから外されたとき
+        if isinstance(self.series_data, dict) and name in self.series_data:
+            self.series_data[name] = series if action == "load" else None
+            self.dirty = True
+
+    # ---- 集計 ----
+
+    def _aggregate_series(self):
+        n_series = len(self.series_names)
+        car_series = np.repeat(self.formation_series, self.car_counts)
+        result = {
+            "cars": np.bincount(car_series, minlength=n_series),
+            "formations": np.bincount(self.formation_series, minlength=n_series),
+            "total_kw": np.bincount(car_series, weights=np.nan_to_num(self.power_kw), minlength=n_series),
+            "motors": np.bincount(car_series, weights=self.motor, minlength=n_series).astype(np.int64),
+        }
+        for field in ("acceleration", "power_kw"):
+            result[field] = self._series_quantiles(getattr(self, field), car_series, n_series)
+        self.series_result = result
+
+    @staticmethod
+    def _series_quantiles(values, car_series, n_series):
+        # 系列番号・値の順に並べ替え、各系列の区間の中で分位点の位置を引く
+        valid = ~np.isnan(values)
+        values, car_series = values[valid], car_series[valid]
+        order = np.lexsort((values, car_series))
+        values = values[order]
+        counts = np.bincount(car_series, minlength=n_series)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        quantiles = np.full((n_series, len(QUANTILES)), np.nan)
+        has_values = counts > 0
+        for i, q in enumerate(QUANTILES):
+            positions = starts + np.rint(q * (counts - 1)).astype(np.int64)
+            quantiles[has_values, i] = values[positions[has_values]]
+        return quantiles
+
+    def _aggregate_fleet(self):
+        result = {
+            "cars": int(len(self.power_kw)),
+            "formations": int(len(self.car_counts)),
+            "series": len(self.series_names),
+            "total_kw": float(np.nansum(self.power_kw)),
+            "motors": int(np.count_nonzero(self.motor)),
+        }
+        for field in FIELDS:
+            values = getattr(self, field)
+            values = values[~np.isnan(values)]
+            result[field] = np.percentile(values, PERCENTILES) if len(values) else None
+        self.fleet_result = result
+
+    # ---- 問い合わせ ----
+
+    def formation_summary(self, formation):
+        self.ensure_built()
+        slot = self.formation_slots.get(id(formation))
+        if slot is None:
+            return None
+        cars = int(self.car_counts[slot])
+        motors = int(self.motors[slot])
+        return {
+            "cars": cars,
+            "motors": motors,
+            "trailers": cars - motors,
+            "total_kw": float(self.total_kw[slot]),
+            "min_acceleration": float(self.min_acceleration[slot]),
+            "mean_acceleration": float(self.mean_acceleration[slot]),
+        }
+
+    def series_summary(self, series_name):
+        self.ensure_built()
+        if series_name not in self.series_names:
+            return None
+        if self.series_result is None:
+            self._aggregate_series()
+        slot = self.series_names.index(series_name)
+        result = self.series_result
+        cars = int(result["cars"][slot])
+        motors = int(result["motors"][slot])
+        return {
+            "cars": cars,
+            "formations": int(result["formations"][slot]),
+            "motors": motors,
+            "trailers": cars - motors,
+            "total_kw": float(result["total_kw"][slot]),
+            "acceleration": result["acceleration"][slot],
+            "power_kw": result["power_kw"][slot],
+        }
+
+    def fleet_summary(self):
+        self.ensure_built()
+        if self.fleet_result is None:
+            self._aggregate_fleet()
+        result = dict(self.fleet_result)
+        result["trailers"] = result["cars"] - result["motors"]
+        return result
+
+
+# ---- 表示用の文字列 ----
+
+def _fmt(value, digits=2):
+    return "-" if value is None or math.isnan(value) else f"{value:.{digits}f}"
+
+
+def mt_ratio(motors, trailers):
+    return f"{motors}M{trailers}T"
+
+
+def format_formation_summary(summary):
+    if summary is None:
+        return ""
+    return (f"{summary['cars']}両 ({mt_ratio(summary['motors'], summary['trailers'])})  "
+            f"合計出力 {_fmt(summary['total_kw'], 0)} kW  "
+            f"加速度 最小 {_fmt(summary['min_acceleration'])} / 平均 {_fmt(summary['mean_acceleration'])}")
+
+
+def format_series_summary(summary):
+    if summary is None:
+        return "統計はありません。"
+    lines = [
+        f"{summary['formations']}編成 {summary['cars']}両 ({mt_ratio(summary['motors'], summary['trailers'])})",
+        f"合計出力: {_fmt(summary['total_kw'], 0)} kW",
+    ]
+    for label, key, digits in (("加速度", "acceleration", 2), ("出力", "power_kw", 0)):
+        q = summary[key]
+        lines.append(f"{label}: 最小 {_fmt(q[0], digits)} / 中央 {_fmt(q[2], digits)} / 最大 {_fmt(q[4], digits)}"
+                     f" (四分位 {_fmt(q[1], digits)}〜{_fmt(q[3], digits)})")
+    return "\n".join(lines)
+
+
+def format_fleet_summary(summary):
+    parts = [
+        f"全体: {summary['series']}系列 {summary['formations']}編成 {summary['cars']}両"
+        f" ({mt_ratio(summary['motors'], summary['trailers'])})",
+        f"合計出力 {_fmt(summary['total_kw'], 0)} kW",
+    ]
+    for label, key, digits in (("加速度", "acceleration", 2), ("減速度", "deceleration", 2), ("出力", "power_kw", 0)):
+        p = summary[key]
+        if p is not None:
+            parts.append(f"{label} p5/p50/p95: {_fmt(p[0], digits)}/{_fmt(p[2], digits)}/{_fmt(p[4], digits)}")
+    return "  ".join(parts)
@@ -0,0 +1,282 @@
+import tkinter as tk
+from tkinter import font as tkfont
+
+from car_tags import CAR_TYPE_COLORS, car_mask, mask_color
+
+# 編成図
+# 系列の全編成を1枚のキャンバスに、1行1編成・1両1ブロックで描く。キャンバスの
+# scrollregion は全編成分の大きさにしておき、見えている行と列の分だけ項目を
+# 置く。画面から外れた行の項目は次に見えた行で使い回すので、数千編成あっても
+# 作る項目は画面に入る分だけになる。スクロールは Tk に任せ、見える範囲が
+# 変わったときだけ行を描き足す。拡大・縮小は scale を変えて描き直す。
+# 車両の変更はその編成の行だけを描き直す (apply_change)。
+
+ROW_HEIGHT = 36
+CAR_WIDTH = 84
+CAR_HEIGHT = 26
+NAME_WIDTH = 200
+FONT_SIZE = 10
+MIN_SCALE = 0.2
+MAX_SCALE = 3.0
+TEXT_SCALE = 0.6   # これより小さくしたら文字は描かない
+SELECT_COLOR = "#cce4ff"
+
+
+def create_legend(master, width=15):
+    # 車両タイプの色の凡例 (メインウィンドウと編成図で使う)
+    frame = tk.Frame(master)
+    for label, color in CAR_TYPE_COLORS.items():
+        tk.Label(frame, text=label, bg=color, width=width, relief=tk.RIDGE).pack(side=tk.LEFT, padx=2, pady=2)
+    return frame
+
+
+class _Row:
+    # 1行分のキャンバス項目 (使い回す)
+    __slots__ = ("name", "blocks", "columns")
+
+    def __init__(self, name):
+        self.name = name
+        self.blocks = []      # (四角形, 文字) の並び
+        self.columns = None   # 描いている車両の範囲 (最初, 最後+1)
+
+
+class FormationDiagram(tk.Frame):
+    def __init__(self, master, formations, on_open=None, width=1000, height=600):
+        # formations() は編成のリストを返す。on_open(位置) はダブルクリックで呼ぶ
+        super().__init__(master)
+        self.formations = formations
+        self.on_open = on_open
+        self.scale = 1.0
+        self.max_cars = 0
+        self.selected = None
+        self.drawn = {}    # 行番号 -> _Row
+        self.spare = []    # 今は使っていない _Row
+        self.font = tkfont.Font(self, family="Helvetica", size=FONT_SIZE)
+        self.name_font = tkfont.Font(self, family="Helvetica", size=FONT_SIZE, weight="bold")
+
+        self.canvas = tk.Canvas(self, width=width, height=height, bg="white", highlightthickness=1,
+                                xscrollincrement=1, yscrollincrement=1)
+        self.ybar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.xbar = tk.Scrollbar(self, orient=tk.HORIZONTAL, command=self.canvas.xview)
+        self.canvas.config(xscrollcommand=self._on_xscroll, yscrollcommand=self._on_yscroll)
+        self.ybar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.xbar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.highlight = self.canvas.create_rectangle(0, 0, 0, 0, fill=SELECT_COLOR, outline="", state=tk.HIDDEN)
+
+        self.canvas.bind("<Configure>", lambda event: self.draw_visible())
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<Double-1>", self._on_double_click)
+        self.canvas.bind("<ButtonPress-2>", lambda event: self.canvas.scan_mark(event.x, event.y))
+        self.canvas.bind("<B2-Motion>", lambda event: self.canvas.scan_dragto(event.x, event.y, gain=1))
+        self.canvas.bind("<ButtonPress-3>", lambda event: self.canvas.scan_mark(event.x, event.y))
+        self.canvas.bind("<B3-Motion>", lambda event: self.canvas.scan_dragto(event.x, event.y, gain=1))
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Shift-MouseWheel>", self._on_shift_wheel)
+        self.canvas.bind("<Control-MouseWheel>", self._on_control_wheel)
+        self.canvas.bind("<Button-4>", lambda event: self.canvas.yview_scroll(-self._step(), "units"))
+        self.canvas.bind("<Button-5>", lambda event: self.canvas.yview_scroll(self._step(), "units"))
+        self.canvas.bind("<Shift-Button-4>", lambda event: self.canvas.xview_scroll(-self._step(), "units"))
+        self.canvas.bind("<Shift-Button-5>", lambda event: self.canvas.xview_scroll(self._step(), "units"))
+        self.canvas.bind("<Control-Button-4>", lambda event: self.zoom(1.25, event.x, event.y))
+        self.canvas.bind("<Control-Button-5>", lambda event: self.zoom(0.8, event.x, event.y))
+        self.canvas.bind("<plus>", lambda event: self.zoom(1.25))
+        self.canvas.bind("<minus>", lambda event: self.zoom(0.8))
+
+        self.refresh()
+
+    # ---- 大きさ ----
+
+    def row_height(self):
+        return ROW_HEIGHT * self.scale
+
+    def car_width(self):
+        return CAR_WIDTH * self.scale
+
+    def name_width(self):
+        return NAME_WIDTH * self.scale
+
+    def _step(self):
+        return max(1, int(self.row_height() * 3))
+
+    def _update_scrollregion(self):
+        width = self.name_width() + self.max_cars * self.car_width()
+        height = len(self.formations()) * self.row_height()
+        self.canvas.config(scrollregion=(0, 0, width, height))
+
+    # ---- 描画 ----
+
+    def refresh(self):
+        # 全体を描き直す (編成の追加・削除・拡大縮小のあと)
+        formations = self.formations()
+        self.max_cars = max((len(f.get("cars", [])) for f in formations), default=0)
+        if self.selected is not None and self.selected >= len(formations):
+            self.selected = None
+        for index in list(self.drawn):
+            self._release(index)
+        self._update_scrollregion()
+        self.draw_visible()
+
+    def draw_visible(self):
+        formations = self.formations()
+        row_height, car_width = self.row_height(), self.car_width()
+        top = self.canvas.canvasy(0)
+        left = self.canvas.canvasx(0)
+        first = max(0, int(top // row_height))
+        last = min(len(formations), int((top + self.canvas.winfo_height()) // row_height) + 1)
+        columns = (max(0, int((left - self.name_width()) // car_width)),
+                   max(0, int((left + self.canvas.winfo_width() - self.name_width()) // car_width) + 1))
+        for index in [i for i in self.drawn if not first <= i < last]:
+            self._release(index)
+        for index in range(first, last):
+            row = self.drawn.get(index)
+            if row is None:
+                row = self.drawn[index] = self.spare.pop() if self.spare else self._new_row()
+            if row.columns != columns:
+                self._fill(row, index, formations[index], columns)
+        self._place_highlight()
+
+    def _new_row(self):
+        return _Row(self.canvas.create_text(0, 0, anchor="w", font=self.name_font, text=""))
+
+    def _release(self, index):
+        row = self.drawn.pop(index)
+        self.canvas.itemconfigure(row.name, state=tk.HIDDEN)
+        for rect, text in row.blocks:
+            self.canvas.itemconfigure(rect, state=tk.HIDDEN)
+            self.canvas.itemconfigure(text, state=tk.HIDDEN)
+        row.columns = None
+        self.spare.append(row)
+
+    def _fill(self, row, index, formation, columns):
+        canvas = self.canvas
+        row_height, car_width, scale = self.row_height(), self.car_width(), self.scale
+        y = index * row_height + row_height / 2
+        text_state = tk.NORMAL if scale >= TEXT_SCALE else tk.HIDDEN
+        canvas.coords(row.name, 4 * scale, y)
+        canvas.itemconfigure(row.name, text=formation.get("name", ""), state=text_state)
+        cars = formation.get("cars", [])
+        start, end = columns[0], min(columns[1], len(cars))
+        while len(row.blocks) < end - start:
+            row.blocks.append((canvas.create_rectangle(0, 0, 0, 0, outline="white"),
+                               canvas.create_text(0, 0, font=self.font, fill="white", text="")))
+        top, bottom = y - CAR_HEIGHT * scale / 2, y + CAR_HEIGHT * scale / 2
+        for slot, position in enumerate(range(start, end)):
+            car = cars[position]
+            rect, text = row.blocks[slot]
+            x = self.name_width() + position * car_width
+            canvas.coords(rect, x + 1, top, x + car_width - 1, bottom)
+            canvas.itemconfigure(rect, fill=mask_color(car_mask(car)), state=tk.NORMAL)
+            canvas.coords(text, x + car_width / 2, y)
+            canvas.itemconfigure(text, text=car.get("name", ""), state=text_state)
+        for rect, text in row.blocks[max(0, end - start):]:
+            canvas.itemconfigure(rect, state=tk.HIDDEN)
+            canvas.itemconfigure(text, state=tk.HIDDEN)
+        row.columns = columns
+
+    def _place_highlight(self):
+        if self.selected is None or self.selected not in self.drawn:
+            self.canvas.itemconfigure(self.highlight, state=tk.HIDDEN)
+            return
+        row_height = self.row_height()
+        width = self.name_width() + self.max_cars * self.car_width()
+        self.canvas.coords(self.highlight, 0, self.selected * row_height, width, (self.selected + 1) * row_height)
+        self.canvas.itemconfigure(self.highlight, state=tk.NORMAL)
+        self.canvas.tag_lower(self.highlight)
+
+    # ---- 差分の反映 ----
+
+    def apply_change(self, event):
+        # 系列の ChangeBus イベント (この系列のものだけを渡す)
+        if event.kind == "formation" and event.action != "update":
+            if self.selected is not None and event.index is not None and self.selected >= event.index:
+                if event.action == "insert":
+                    self.selected += 1
+                elif self.selected == event.index:
+                    self.selected = None
+                else:
+                    self.selected -= 1
+            self.refresh()
+        elif event.kind in ("car", "formation"):
+            # 描いている行のうち、その編成の行だけを描き直す
+            formation = event.formation if event.kind == "car" else event.value
+            cars = len(formation.get("cars", []))
+            if cars > self.max_cars:
+                self.max_cars = cars
+                self._update_scrollregion()
+            for index, row in self.drawn.items():
+                if self.formations()[index] is formation:
+                    self._fill(row, index, formation, row.columns)
+                    break
+
+    # ---- 拡大・縮小 ----
+
+    def zoom(self, factor, x=None, y=None):
+        # (x, y) の位置 (画面座標) にあるものが動かないように拡大する
+        scale = max(MIN_SCALE, min(MAX_SCALE, self.scale * factor))
+        if scale == self.scale:
+            return
+        if x is None:
+            x, y = self.canvas.winfo_width() / 2, self.canvas.winfo_height() / 2
+        world_x = self.canvas.canvasx(x) / self.scale
+        world_y = self.canvas.canvasy(y) / self.scale
+        self.scale = scale
+        self.font.configure(size=max(1, round(FONT_SIZE * scale)))
+        self.name_font.configure(size=max(1, round(FONT_SIZE * scale)))
+        for index in list(self.drawn):
+            self._release(index)
+        self._update_scrollregion()
+        width = self.name_width() + self.max_cars * self.car_width()
+        height = len(self.formations()) * self.row_height()
+        if width > 0:
+            self.canvas.xview_moveto(max(0.0, world_x * scale - x) / width)
+        if height > 0:
+            self.canvas.yview_moveto(max(0.0, world_y * scale - y) / height)
+        self.draw_visible()
+
+    # ---- 操作 ----
+
+    def see(self, index):
+        row_height = self.row_height()
+        height = len(self.formations()) * row_height
+        if height > 0:
+            self.canvas.yview_moveto(max(0.0, index * row_height - self.canvas.winfo_height() / 2) / height)
+
+    def selection_set(self, index):
+        self.selected = index
+        self._place_highlight()
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def _row_at(self, event):
+        index = int(self.canvas.canvasy(event.y) // self.row_height())
+        return index if 0 <= index < len(self.formations()) else None
+
+    def _on_click(self, event):
+        self.canvas.focus_set()
+        index = self._row_at(event)
+        if index is not None:
+            self.selection_set(index)
+
+    def _on_double_click(self, event):
+        index = self._row_at(event)
+        if index is not None and self.on_open is not None:
+            self.on_open(index)
+
+    def _on_xscroll(self, first, last):
+        self.xbar.set(first, last)
+        self.draw_visible()
+
+    def _on_yscroll(self, first, last):
+        self.ybar.set(first, last)
+        self.draw_visible()
+
+    def _on_wheel(self, event):
+        self.canvas.yview_scroll(-self._step() if event.delta > 0 else self._step(), "units")
+
+    def _on_shift_wheel(self, event):
+        self.canvas.xview_scroll(-self._step() if event.delta > 0 else self._step(), "units")
+
+    def _on_control_wheel(self, event):
+        self.zoom(1.25 if event.delta > 0 else 0.8, event.x, event.y)
@@ -0,0 +1,105 @@
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from diagnostics import record
+from thumbnail_cache import shared_cache
+
+# 画像の非同期読み込み
+# 復号と縮小はワーカースレッドで行い、結果はキューに積む。Tk のスレッドは
+# 読み込み中のものがある間だけ after() でキューを見に行き、PhotoImage を
+# 作り、その ImageHandle をコールバックに渡す (使い終わったら release() する)。
+# ウィンドウを閉じたときは cancel() で取り消す。
+
+POLL_MS = 30
+
+
+class ImageJob:
+    def __init__(self, loader, path, size, on_done, on_error):
+        self.loader = loader
+        self.path = path
+        self.size = size
+        self.on_done = on_done
+        self.on_error = on_error
+        self.future = None
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        if self.cancelled or self.done:
+            return
+        self.cancelled = True
+        if self.future.cancel():
+            # まだ始まっていなければ結果は届かない
+            self.loader.pending -= 1
+
+
+class ImageLoader:
+    def __init__(self, root, workers=None):
+        self.root = root
+        self.cache = shared_cache()
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                           thread_name_prefix="image-loader")
+        self.results = queue.Queue()
+        self.pending = 0
+        self.polling = False
+
+    def submit(self, path, size, on_done, on_error=None):
+        job = ImageJob(self, path, size, on_done, on_error)
+        job.future = self.executor.submit(self._decode, job)
+        self.pending += 1
+        if not self.polling:
+            self.polling = True
+            self.root.after(POLL_MS, self._poll)
+        return job
+
+    def _decode(self, job):
+        # ワーカースレッド側
+        if job.cancelled:
+            self.results.put((job, None, None, None))
+            return
+        try:
+            start = time.perf_counter()
+            key, image = self.cache.load(job.path, job.size)
+            record("ImageLoader (復号と縮小)", (time.perf_counter() - start) * 1000)
+            self.results.put((job, key, image, None))
+        except Exception as e:
+            self.results.put((job, None, None, e))
+
+    def _poll(self):
+        while True:
+            try:
+                job, key, image, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if job.cancelled:
+                continue
+            job.done = True
+            if error is None:
+                try:
+                    start = time.perf_counter()
+                    handle = self.cache.photo_for(job.path, key, image)
+                    record("ImageLoader (PhotoImage 作成)", (time.perf_counter() - start) * 1000)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                if job.on_error is not None:
+                    job.on_error(error)
+                continue
+            job.on_done(handle)
+        if self.pending > 0:
+            self.root.after(POLL_MS, self._poll)
+        else:
+            self.polling = False
+
+
+_shared_loader = None
+
+
+def shared_loader(widget):
+    global _shared_loader
+    if _shared_loader is None:
+        _shared_loader = ImageLoader(widget.nametowidget("."))
+    return _shared_loader
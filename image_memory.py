@@ -0,0 +1,91 @@
+import os
+from collections import OrderedDict
+
+# 表示用画像 (PhotoImage) のメモリ管理
+# 作った PhotoImage はここだけが持ち、使う側には ImageHandle を渡す。画像の
+# 大きさ (幅 × 高さ × 4 バイト) の合計が budget を超えたら、使用中のハンドルが
+# 無いものを古く表示した順に手放す。使用中のものは手放さないので、合計が
+# budget を超えるのは同時に表示している分が budget より大きいときだけになる。
+# 使い終わったら release() を呼ぶ (ウィンドウを閉じたときなど)。
+# Tk のスレッドからだけ使う。環境変数 TRAIN_MANAGER_IMAGE_MEMORY_MB で上限を変えられる。
+
+DEFAULT_BUDGET = int(os.environ.get("TRAIN_MANAGER_IMAGE_MEMORY_MB", "64")) * 1024 * 1024
+BYTES_PER_PIXEL = 4
+
+
+class ImageHandle:
+    __slots__ = ("memory", "key", "photo", "released")
+
+    def __init__(self, memory, key, photo):
+        self.memory = memory
+        self.key = key
+        self.photo = photo
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.photo = None
+            self.memory.release(self.key)
+
+
+class ImageMemory:
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()   # key -> [PhotoImage, バイト数, 使用中のハンドル数] (古く表示した順)
+        self.used = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def acquire(self, key):
+        # 持っていればハンドルを返す (表示したものとして新しい側へ動かす)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        entry[2] += 1
+        return ImageHandle(self, key, entry[0])
+
+    def add(self, key, photo):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.used -= old[1]
+        size = photo.width() * photo.height() * BYTES_PER_PIXEL
+        self.entries[key] = [photo, size, 0]
+        self.used += size
+        handle = self.acquire(key)
+        self._evict()
+        return handle
+
+    def release(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] > 0:
+            entry[2] -= 1
+            self._evict()
+
+    def set_budget(self, budget):
+        self.budget = budget
+        self._evict()
+
+    def _evict(self):
+        if self.used <= self.budget:
+            return
+        for key, entry in list(self.entries.items()):
+            if self.used <= self.budget:
+                break
+            if entry[2]:
+                continue
+            del self.entries[key]
+            self.used -= entry[1]
+            self.evictions += 1
+
+    def usage(self):
+        return {
+            "used": self.used,
+            "budget": self.budget,
+            "images": len(self.entries),
+            "in_use": sum(1 for entry in self.entries.values() if entry[2]),
+            "evictions": self.evictions,
+        }
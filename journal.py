@@ -0,0 +1,246 @@
+import json
+import os
+
+from car_store import new_car
+from car_tags import encode_car, encode_series
+from cow_list import CowList, own, release
+
+# 変更の追記ジャーナル
+# JSON 形式のプロジェクトでは、ChangeBus の変更イベントを1件1行の JSON として
+# 「プロジェクト名.journal」に追記する。書き込むのは変わった部分だけなので、
+# 自動保存の手間はプロジェクトの大きさに関係しない。ときどき本体のファイルを
+# 書き直して (compaction) ジャーナルを空にする。
+#
+# ジャーナルの1行目には世代番号を書き、本体の "journal_generation" と同じ
+# ときだけ読み直す。本体を書き直したあとジャーナルを空にする前に落ちても、
+# 古いジャーナルを二重に適用することはない。
+#
+# 本体の書き直しをワーカーで行う間は、それまでのジャーナルを「.prev」に移して
+# 新しい世代のジャーナルに書き続ける (rotate)。書き直しの途中で落ちたときは
+# 本体の世代が古いままなので、.prev と新しいジャーナルの両方を当てはめる。
+#
+# 記録の形: {"a": 操作, "k": 種類, "s": 系列名, "f": 編成の位置, "i": 位置, "v": 値}
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".train_manager")
+UNTITLED_JOURNAL = os.path.join(DEFAULT_DIR, "untitled.journal")
+
+
+def journal_path(project_path):
+    return project_path + ".journal" if project_path else UNTITLED_JOURNAL
+
+
+def _decode_car(car):
+    return new_car((k, v) for k, v in car.items() if k != "color")
+
+
+def _encode_formation(formation):
+    return dict(formation, cars=[encode_car(car) for car in formation.get("cars", [])])
+
+
+def _decode_formation(formation):
+    formation["cars"] = CowList(_decode_car(car) for car in formation.get("cars", []))
+    return formation
+
+
+def _decode_series(series):
+    for formation in series.get("formations", []):
+        _decode_formation(formation)
+    return series
+
+
+class Journal:
+    def __init__(self, path, series_data, retired_data, generation=0):
+        self.path = path
+        self.series_data = series_data
+        self.retired_data = retired_data
+        self.generation = generation
+        self.records = 0
+        self.file = None
+        self.remove_previous()
+        self.reset(generation)
+
+    def reset(self, generation):
+        # 本体を書き直した直後に呼ぶ (ジャーナルを空にして世代を進める)
+        self.close()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.generation = generation
+        self.records = 0
+        self.file = open(self.path, "w", encoding="utf-8")
+        self.file.write(json.dumps({"generation": generation}) + "\n")
+        self.file.flush()
+
+    def rotate(self, generation):
+        # 本体の書き直しを始めるときに呼ぶ。終わったら remove_previous() で消す
+        self.close()
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path + ".prev")
+        self.reset(generation)
+
+    def rollback(self, generation):
+        # 本体の書き直しに失敗したとき、.prev と今の記録を1つの世代に戻す
+        records = read_journal(self.path, generation)
+        self.reset(generation)
+        for record in records:
+            self.write(record)
+        self.remove_previous()
+
+    def remove_previous(self):
+        if os.path.exists(self.path + ".prev"):
+            os.remove(self.path + ".prev")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        self.close()
+        self.remove_previous()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def sync(self):
+        # 定期的に呼んでディスクまで書き出す (1件ごとの fsync はしない)
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    # ---- 記録 ----
+
+    def _formation_index(self, series_name, formation):
+        series = self.series_data.get(series_name)
+        if series is None:
+            return None
+        for index, f in enumerate(series.get("formations", [])):
+            if f is formation:
+                return index
+        return None
+
+    def apply_change(self, event):
+        record = {"a": event.action, "k": event.kind}
+        if event.series is not None:
+            record["s"] = event.series
+        if event.index is not None:
+            record["i"] = event.index
+        kind, action, value = event.kind, event.action, event.value
+
+        if kind in ("car", "formation_photo") or (kind == "formation" and action == "update"):
+            # 編成は位置で記録する (削除済みの編成への変更は記録しない)
+            index = self._formation_index(event.series, event.formation or value)
+            if index is None:
+                return
+            record["f"] = index
+
+        if action != "remove":
+            if kind == "series":
+                record["v"] = encode_series(value) if action == "insert" else {"description": value.get("description", "")}
+            elif kind == "formation":
+                if action == "insert":
+                    record["v"] = _encode_formation(value)
+                else:
+                    record["v"] = {"name": value.get("name", ""), "description": value.get("description", "")}
+            elif kind == "car":
+                record["v"] = encode_car(value)
+            else:
+                record["v"] = value
+        self.write(record)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.records += 1
+
+
+def _read(path, generation):
+    # 世代が合わなければ None
+    if not os.path.exists(path):
+        return None
+    records = []
+    with open(path, "r", encoding="utf-8") as file:
+        try:
+            header = json.loads(file.readline() or "{}")
+        except ValueError:
+            return None
+        if header.get("generation") != generation:
+            return None
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # 壊れた最後の行 (書きかけ) は捨てる
+                break
+    return records
+
+
+def read_journal(path, generation):
+    # 世代 generation の本体にまだ入っていない記録を返す
+    previous = _read(path + ".prev", generation)
+    if previous is not None:
+        # 本体の書き直しが終わる前に落ちていた
+        return previous + (_read(path, generation + 1) or [])
+    return _read(path, generation) or []
+
+
+def replay(series_data, retired_data, records):
+    # 記録を順にデータへ当てはめる (イベントは出さない)
+    applied = 0
+    for record in records:
+        try:
+            _apply(series_data, retired_data, record)
+        except (KeyError, IndexError, TypeError):
+            continue
+        applied += 1
+    return applied
+
+
+def _apply(series_data, retired_data, record):
+    action, kind, value = record["a"], record["k"], record.get("v")
+    if kind == "retired":
+        if action == "remove":
+            del retired_data[record["i"]]
+        else:
+            retired_data.insert(record["i"], value)
+        return
+    name = record["s"]
+    if kind == "series":
+        if action == "insert":
+            series_data[name] = _decode_series(value)
+        elif action == "remove":
+            del series_data[name]
+        else:
+            series_data[name]["description"] = value["description"]
+        return
+
+    series = series_data[name]
+    if kind == "series_photo":
+        if action == "insert":
+            series["photos"].insert(record["i"], value)
+        else:
+            del series["photos"][record["i"]]
+        return
+    formations = series["formations"]
+    if kind == "formation":
+        if action == "insert":
+            formations.insert(record["i"], _decode_formation(value))
+        elif action == "remove":
+            formation = formations.pop(record["i"])
+            release(formation, "cars")
+            release(formation, "photos")
+        else:
+            formations[record["f"]].update(value)
+        return
+
+    formation = formations[record["f"]]
+    if kind == "formation_photo":
+        if action == "remove":
+            del own(formation, "photos")[record["i"]]
+        else:
+            own(formation, "photos").insert(record["i"], value)
+    elif kind == "car":
+        cars = own(formation, "cars")
+        if action == "insert":
+            cars.insert(record["i"], _decode_car(value))
+        elif action == "remove":
+            del cars[record["i"]]
+        else:
+            cars[record["i"]] = _decode_car(value)
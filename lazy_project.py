@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+# 系列データの遅延読み込み
+# 開いた時点では系列名と編成数だけを読み、編成・車両は系列に初めて
+# アクセスされたときに SQLiteStore から読み込む。max_loaded を指定すると、
+# 開いているウィンドウが無く、しばらく使われていない系列をメモリから外す。
+# 変更はすべて行単位でデータベースに書き込まれているので、外しても失われない。
+
+
+class LazySeriesData(MutableMapping):
+    def __init__(self, store, max_loaded=None):
+        self.store = store
+        self.max_loaded = max_loaded
+        self._counts = OrderedDict(store.load_series_index())  # 系列名 -> 編成数 (表示順)
+        self._loaded = OrderedDict()  # 読み込み済みの系列 (古く使われた順)
+        self._pinned = {}             # 系列名 -> 開いているウィンドウ数
+        self.listeners = []           # listener("load" / "evict", 系列名, 系列)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __iter__(self):
+        return iter(self._counts)
+
+    def __contains__(self, name):
+        return name in self._counts
+
+    def __getitem__(self, name):
+        series = self._loaded.get(name)
+        if series is not None:
+            self._loaded.move_to_end(name)
+            return series
+        if name not in self._counts:
+            raise KeyError(name)
+        series = self.store.load_series(name)
+        self._loaded[name] = series
+        for listener in self.listeners:
+            listener("load", name, series)
+        self._evict()
+        return series
+
+    def __setitem__(self, name, series):
+        if name not in self._counts:
+            self._counts[name] = 0
+        self._loaded[name] = series
+        self._loaded.move_to_end(name)
+        self._evict()
+
+    def __delitem__(self, name):
+        del self._counts[name]
+        self._loaded.pop(name, None)
+        self._pinned.pop(name, None)
+
+    def pop(self, name, *default):
+        # 削除のためだけに読み込まないよう、未読み込みの系列は None を返す
+        if name not in self._counts:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        series = self._loaded.get(name)
+        del self[name]
+        return series
+
+    def is_loaded(self, name):
+        return name in self._loaded
+
+    def formation_count(self, name):
+        series = self._loaded.get(name)
+        if series is not None:
+            return len(series.get("formations", []))
+        return self._counts[name]
+
+    def pin(self, name):
+        self._pinned[name] = self._pinned.get(name, 0) + 1
+
+    def unpin(self, name):
+        count = self._pinned.get(name, 0) - 1
+        if count > 0:
+            self._pinned[name] = count
+        else:
+            self._pinned.pop(name, None)
+            self._evict()
+
+    def _evict(self):
+        if self.max_loaded is None:
+            return
+        excess = len(self._loaded) - self.max_loaded
+        # 直前に使われた系列は呼び出し元が参照中なので外さない
+        for name in list(self._loaded)[:-1]:
+            if excess <= 0:
+                break
+            if name in self._pinned:
+                continue
+            series = self._loaded.pop(name)
+            self._counts[name] = len(series.get("formations", []))
+            self.store.forget_series(series)
+            for listener in self.listeners:
+                listener("evict", name, series)
+            excess -= 1
+
+
+@contextmanager
+def pinned(series_data, names=None):
+    # 間の処理で系列をメモリから外さない (names を省けば全系列)。外した系列の
+    # dict への変更はデータベースに書かれないので、系列の dict を持ったまま
+    # 変更操作をする処理 (比較・結合、名簿の取り込みなど) はこの中で行う。
+    # 普通の dict なら何もしない
+    if not isinstance(series_data, LazySeriesData):
+        yield
+        return
+    names = list(series_data) if names is None else list(names)
+    for name in names:
+        series_data.pin(name)
+    try:
+        yield
+    finally:
+        for name in names:
+            series_data.unpin(name)
@@ -1,41 +1,41 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, simpledialog, messagebox
-import json
-from tkinter import filedialog
-from PIL import Image, ImageTk
 import os
+import queue
+import threading
+import time
+from datetime import date
+
+import train_model as model
+from car_tags import (CAR_TYPES, CAR_TYPE_COLORS, TAG_BITS, TAG_NAMES, UNKNOWN_TAGS, TagIndex, car_mask, infer_mask,
+                      mask_to_tags)
+from change_events import ChangeBus
+from diagnostics import shared_diagnostics, timed
+from formation_diagram import FormationDiagram, create_legend
+from image_loader import shared_loader
+from background_save import BackgroundSaver, SaveJob
+from journal import UNTITLED_JOURNAL, Journal, journal_path, read_journal, replay
+from lazy_project import LazySeriesData
+from project_diff import ACTION_LABELS, KIND_LABELS, diff, hash_project, merge3
+from photo_bundle import (BUNDLE_SUFFIX, PhotoBundle, bundle_paths, current_bundle, display_name, find_bundle,
+                          import_paths, rebase_photos, resolve_photo, set_current_bundle, store_photo)
+from retired_registry import RetiredIndex
+from search_index import SearchIndex
+from sqlite_store import SQLiteStore
+from thumbnail_cache import FORMATION_PHOTO_SIZE, PREVIEW_SIZE, shared_cache
+from virtual_list import VirtualListbox
+from window_registry import raise_window, shared_windows, window_exists
+
+# 起動を速くするため、PIL (写真の一括取り込み) と NumPy (統計) は
+# 使うときになってから読み込む。
+
+# データベースを開いたとき、メモリに残しておく系列数の上限 (None なら外さない)
+MAX_LOADED_SERIES = 20
+
+# ジャーナルをディスクへ書き出す間隔と、本体へまとめる記録数
+AUTOSAVE_INTERVAL_MS = 5000
+COMPACT_RECORDS = 2000
 
-# 車両形式の辞書
-CAR_TYPES = {
-    "ク": "制御車",
-    "モ": "電動車",
-    "ロ": "グリーン車",
-    "ハ": "普通車",
-    "ネ": "寝台車",
-    "シ": "食堂車",
-    "ユ": "郵便車",
-    "ニ": "荷物車",
-    "エ": "救援車",
-    "ヤ": "職用車",
-    "ル": "配給車",
-    "キ": "気動車"
-}
-
-# 車両タイプの色
-CAR_TYPE_COLORS = {
-    "制御車": "orange",
-    "電動車": "blue",
-    "グリーン車": "green",
-    "普通車": "grey",
-    "寝台車": "darkblue",
-    "食堂車": "brown",
-    "郵便車": "cyan",
-    "荷物車": "darkgreen",
-    "救援車": "red",
-    "職用車": "purple",
-    "配給車": "pink",
-    "気動車": "yellow"
-}
 
 class TrainManagerApp:
     def __init__(self, root):
@@ -44,9 +44,44 @@ class TrainManagerApp:
         self.root.geometry("1600x900")
         self.series_data = {}
         self.retired_data = []
+        self.changes = ChangeBus()
+        self.store = None  # SQLiteプロジェクトを開いている間だけ設定される
+        self.project_path = None  # JSON 形式で保存・読み込みしたファイル
+        self.generation = 0       # 本体ファイルのジャーナル世代番号
+        self.journal = None
+        self.bundle = None        # 写真を中に持つプロジェクト (バンドル) を開いている間だけ設定される
+        self.saver = BackgroundSaver(root, self.show_save_progress)
+        self.series_names = []  # 系列リストボックスの行 -> 系列名
+        self.search_index = SearchIndex()
+        self.tag_index = TagIndex()
+        self.retired_index = RetiredIndex()
+        self.fleet_stats = None  # 画面を出したあとで start_fleet_stats() が作る
+        self.stats_pending = None
 
         self.create_menu()
         self.create_main_ui()
+        self.changes.subscribe(self.on_change)
+        self.changes.subscribe(self.search_index.apply_change)
+        self.changes.subscribe(self.tag_index.apply_change)
+        self.changes.subscribe(self.retired_index.apply_change)
+        self.root.after_idle(self.start_fleet_stats)
+        self.root.protocol("WM_DELETE_WINDOW", self.quit)
+        self.recover_untitled()
+        self.root.after(AUTOSAVE_INTERVAL_MS, self.autosave_tick)
+        shared_diagnostics().start_heartbeat(self.root)
+
+    def start_fleet_stats(self):
+        try:
+            from fleet_stats import FleetStats
+        except ImportError:
+            # NumPy が無い環境では統計を出さない
+            self.fleet_label.config(text="NumPy がインストールされていないため、統計は表示できません。")
+            return
+        self.fleet_stats = FleetStats()
+        self.changes.subscribe(self.fleet_stats.apply_change)
+        if isinstance(self.series_data, LazySeriesData):
+            self.series_data.listeners.append(self.fleet_stats.on_series_loaded)
+        self.reset_fleet_stats()
 
     def create_menu(self):
         menubar = tk.Menu(self.root)
@@ -55,8 +90,19 @@ class TrainManagerApp:
         file_menu.add_command(label="保存", command=self.save_data)
         file_menu.add_command(label="読み込み", command=self.load_data)
         file_menu.add_separator()
-        file_menu.add_command(label="終了", command=self.root.quit)
+        file_menu.add_command(label="データベースを開く", command=self.open_database)
+        file_menu.add_command(label="データベースとして保存", command=self.save_database)
+        file_menu.add_command(label="バンドルとして保存 (写真を含める)", command=self.save_bundle)
+        file_menu.add_separator()
+        file_menu.add_command(label="名簿を取り込み", command=self.import_roster)
+        file_menu.add_command(label="名簿を書き出し", command=self.export_roster)
+        file_menu.add_separator()
+        file_menu.add_command(label="終了", command=self.quit)
         menubar.add_cascade(label="ファイル", menu=file_menu)
+        tool_menu = tk.Menu(menubar, tearoff=0)
+        tool_menu.add_command(label="比較・結合", command=self.show_project_diff)
+        tool_menu.add_command(label="診断", command=self.show_diagnostics)
+        menubar.add_cascade(label="ツール", menu=tool_menu)
         self.root.config(menu=menubar)
 
     def create_main_ui(self):
@@ -64,7 +110,8 @@ class TrainManagerApp:
         main_frame.pack(fill=tk.BOTH, expand=True)
 
         # 系列リストボックス
-        self.series_listbox = tk.Listbox(main_frame, height=35, width=40, font=("Helvetica", 12))
+        self.series_listbox = VirtualListbox(main_frame, lambda: len(self.series_names), self.series_row,
+                                             height=35, width=40, font=("Helvetica", 12))
         self.series_listbox.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=5)
         self.series_listbox.bind("<Double-1>", self.open_series_window)
 
@@ -75,83 +122,528 @@ class TrainManagerApp:
         tk.Button(series_btn_frame, text="系列追加", command=self.add_series).pack(fill=tk.X, pady=5)
         tk.Button(series_btn_frame, text="系列削除", command=self.delete_series).pack(fill=tk.X, pady=5)
         tk.Button(series_btn_frame, text="廃車リスト", command=self.show_retired_list).pack(fill=tk.X, pady=5)
+        tk.Button(series_btn_frame, text="検索", command=self.show_search).pack(fill=tk.X, pady=5)
 
         # 凡例
-        legend_frame = tk.Frame(self.root)
-        legend_frame.pack(fill=tk.X, padx=5, pady=5)
-        for label, color in CAR_TYPE_COLORS.items():
-            tk.Label(legend_frame, text=label, bg=color, width=15, relief=tk.RIDGE).pack(side=tk.LEFT, padx=2, pady=2)
+        create_legend(self.root).pack(fill=tk.X, padx=5, pady=5)
+
+        # 車両性能の統計
+        self.fleet_label = tk.Label(self.root, text="", anchor="w", justify=tk.LEFT)
+        self.fleet_label.pack(fill=tk.X, padx=5, pady=5)
+
+        # ステータスバー (保存の進み具合)
+        status_frame = tk.Frame(self.root, relief=tk.SUNKEN, bd=1)
+        status_frame.pack(side=tk.BOTTOM, fill=tk.X)
+        self.status_label = tk.Label(status_frame, text="", anchor="w")
+        self.status_label.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.save_progress = ttk.Progressbar(status_frame, length=200, mode="determinate")
+        self.save_progress.pack(side=tk.RIGHT, padx=5, pady=2)
 
+    @timed
     def new_project(self):
         if messagebox.askyesno("確認", "現在のデータを破棄して新規作成しますか？"):
+            self.close_project(discard_untitled=True)
             self.series_data = {}
             self.retired_data = []
+            self.attach_journal()
+            self.rebuild_indexes()
             self.update_series_list()
 
+    @timed
     def save_data(self):
+        if self.bundle is not None:
+            # バンドルの写真の参照はバンドルの中でしか読めないので、同じ場所に保存する
+            self.request_save(self.bundle.project_path)
+            return True
         file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON Files", "*.json")])
-        if file_path:
-            data = {"series": self.series_data, "retired": self.retired_data}
-            with open(file_path, "w", encoding="utf-8") as file:
-                json.dump(data, file, ensure_ascii=False, indent=4)
-            messagebox.showinfo("保存完了", "データを保存しました。")
-
+        if not file_path:
+            return False
+        if self.store is not None:
+            # データベースから JSON に切り替える (全系列をここで読み込む)
+            self.series_data = dict(self.series_data.items())
+            self.detach_store()
+            self.rebuild_indexes()
+        self.request_save(file_path)
+        return True
+
+    @timed
     def load_data(self):
         file_path = filedialog.askopenfilename(filetypes=[("JSON Files", "*.json")])
         if file_path:
-            with open(file_path, "r", encoding="utf-8") as file:
-                data = json.load(file)
-            self.series_data = data.get("series", {})
-            self.retired_data = data.get("retired", [])
+            self.close_project(discard_untitled=True)
+            series_data, retired_data, generation = model.load_json_document(file_path)
+            # 前回まとめる前に終わっていれば、残っているジャーナルを当てはめる
+            restored = replay(series_data, retired_data, read_journal(journal_path(file_path), generation))
+            if restored:
+                generation += 1
+                model.save_json(file_path, series_data, retired_data, generation)
+            self.series_data = series_data
+            self.retired_data = retired_data
+            self.project_path = file_path
+            self.generation = generation
+            self.attach_journal()
+            self.attach_bundle(find_bundle(file_path))
+            self.rebuild_indexes()
             self.update_series_list()
-            messagebox.showinfo("読み込み完了", "データを読み込みました。")
+            if restored:
+                messagebox.showinfo("読み込み完了", f"データを読み込みました。保存されていなかった変更 {restored} 件を復元しました。")
+            else:
+                messagebox.showinfo("読み込み完了", "データを読み込みました。")
+            self.check_car_tags()
+
+    @timed
+    def check_car_tags(self):
+        # 車両名の形式記号とタイプが合わない車両をまとめて調べる
+        mismatches = model.tag_mismatches(self.series_data)
+        if not mismatches:
+            return
+        lines = [f"車両名とタイプが合わない車両が {len(mismatches)} 両あります。"]
+        for series_name, formation, index, inferred in mismatches[:5]:
+            car = formation["cars"][index]
+            lines.append(f"  {series_name} / {formation.get('name', '')} / {car.get('name', '')}:"
+                         f" {'・'.join(mask_to_tags(car_mask(car)))} → {'・'.join(mask_to_tags(inferred))}")
+        lines.append("車両名から推定したタイプに直しますか？")
+        if messagebox.askyesno("車両タイプの確認", "\n".join(lines)):
+            model.fix_tags(self.changes, mismatches)
+
+    # ---- 保存 (ワーカースレッドで書き出す) ----
+
+    def request_save(self, file_path):
+        if not self.saver.request(lambda: self.prepare_save(file_path)):
+            self.status_label.config(text="保存中… (終わったあと、もう一度保存します)")
+
+    @timed
+    def prepare_save(self, file_path):
+        # 書き出せるようになったときに Tk のスレッドで呼ばれる
+        series_data, retired_data = model.snapshot(self.series_data, self.retired_data)
+        self.generation += 1
+        if file_path == self.project_path and self.journal is not None:
+            # 写しより後の変更は新しい世代のジャーナルに書く
+            self.journal.rotate(self.generation)
+            generation = self.generation
+            on_done = lambda error: self.finish_save(file_path, error, rotated=generation)
+        else:
+            # 別名で保存 (名前の無いジャーナルは書き終わってから消す)
+            untitled = self.project_path is None
+            self.detach_journal()
+            self.project_path = file_path
+            self.attach_journal()
+            on_done = lambda error: self.finish_save(file_path, error, untitled=untitled)
+        self.status_label.config(text=f"保存中: {os.path.basename(file_path)}")
+        return SaveJob(file_path, series_data, retired_data, self.generation, on_done)
+
+    @timed
+    def finish_save(self, file_path, error, rotated=None, untitled=False):
+        if error is not None:
+            if rotated is not None and self.journal is not None and self.journal.generation == rotated:
+                self.generation = rotated - 1
+                self.journal.rollback(self.generation)
+            self.status_label.config(text="保存できませんでした。")
+            messagebox.showerror("エラー", f"保存中にエラーが発生しました: {error}")
+            return
+        if rotated is not None and self.journal is not None:
+            self.journal.remove_previous()
+        if untitled and os.path.exists(UNTITLED_JOURNAL):
+            os.remove(UNTITLED_JOURNAL)
+        if self.bundle is not None and file_path == self.bundle.project_path:
+            # 保存したデータから参照されなくなった写真を消す
+            self.bundle.collect_garbage()
+        self.status_label.config(text=f"保存しました: {os.path.basename(file_path)} ({time.strftime('%H:%M:%S')})")
+
+    def show_save_progress(self, done, total):
+        if total:
+            self.save_progress.config(maximum=total, value=done)
+        else:
+            self.save_progress.config(value=0)
+
+    # ---- バンドル (写真を中に持つプロジェクト) ----
+
+    def attach_bundle(self, bundle):
+        self.detach_bundle()
+        self.bundle = bundle
+        set_current_bundle(bundle)
+        if bundle is not None:
+            bundle.reset_counts(self.series_data)
+            self.changes.subscribe(bundle.apply_change)
+
+    def detach_bundle(self):
+        if self.bundle is not None:
+            self.changes.unsubscribe(self.bundle.apply_change)
+            self.bundle = None
+        set_current_bundle(None)
+
+    @timed
+    def save_bundle(self):
+        root = filedialog.asksaveasfilename(defaultextension=BUNDLE_SUFFIX, filetypes=[("バンドル", f"*{BUNDLE_SUFFIX}")])
+        if not root:
+            return
+        if os.path.exists(root) and not os.path.isdir(root):
+            messagebox.showerror("エラー", "同じ名前のファイルがあるため、バンドルを作れません。")
+            return
+        if self.store is not None:
+            self.series_data = dict(self.series_data.items())
+            self.detach_store()
+            self.rebuild_indexes()
+        bundle = PhotoBundle.create(root)
+        paths = bundle_paths(self.series_data)
+        messages = queue.Queue()
+
+        # 写真の読み書きは別スレッドで行い、データの参照は取り込みが終わってから置き換える
+        def run():
+            try:
+                mapping, missing = import_paths(bundle, paths,
+                                                progress=lambda done, total: messages.put(("progress", done, total)))
+                messages.put(("done", mapping, missing))
+            except Exception as e:
+                messages.put(("error", e))
+        threading.Thread(target=run, daemon=True).start()
+        self.status_label.config(text=f"写真をバンドルに取り込んでいます ({len(paths)} 枚)…")
+        self.root.after(100, lambda: self.poll_bundle(bundle, messages))
+
+    def poll_bundle(self, bundle, messages):
+        while True:
+            try:
+                message = messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                self.show_save_progress(message[1], message[2])
+            elif message[0] == "done":
+                self.finish_bundle(bundle, message[1], message[2])
+                return
+            else:
+                self.show_save_progress(0, 0)
+                self.status_label.config(text="バンドルを作れませんでした。")
+                messagebox.showerror("エラー", f"バンドルの作成中にエラーが発生しました: {message[1]}")
+                return
+        self.root.after(100, lambda: self.poll_bundle(bundle, messages))
+
+    @timed
+    def finish_bundle(self, bundle, mapping, missing):
+        rebase_photos(self.series_data, mapping)
+        self.attach_bundle(bundle)
+        self.request_save(bundle.project_path)
+        if missing:
+            lines = [f"見つからない写真が {len(missing)} 枚あります (元のパスのまま残しました)。"]
+            lines.extend(f"  {path}" for path in missing[:10])
+            messagebox.showwarning("バンドル", "\n".join(lines))
+
+    # ---- ジャーナル (JSON 形式での自動保存) ----
+
+    def attach_journal(self):
+        self.detach_journal()
+        self.journal = Journal(journal_path(self.project_path), self.series_data, self.retired_data, self.generation)
+        self.changes.subscribe(self.journal.apply_change)
+
+    def detach_journal(self, discard=False):
+        if self.journal is not None:
+            self.changes.unsubscribe(self.journal.apply_change)
+            if discard:
+                self.journal.discard()
+            else:
+                self.journal.close()
+            self.journal = None
+
+    def compact_journal(self):
+        # 本体を書き直してジャーナルを空にする
+        if self.journal is not None and self.project_path is not None and self.journal.records:
+            self.request_save(self.project_path)
+
+    @timed
+    def close_project(self, discard_untitled=False):
+        # 保存先のあるプロジェクトはまとめてから閉じる
+        self.saver.wait()
+        shared_windows().close_all()
+        CarWindow.lazy_data = None
+        if self.project_path is not None:
+            self.compact_journal()
+            self.saver.wait()
+            self.detach_journal(discard=True)
+        else:
+            self.detach_journal(discard=discard_untitled)
+        self.detach_store()
+        self.detach_bundle()
+        self.project_path = None
+        self.generation = 0
+
+    def autosave_tick(self):
+        if self.journal is not None:
+            self.journal.sync()
+            if self.journal.records >= COMPACT_RECORDS and not self.saver.busy():
+                self.compact_journal()
+        self.root.after(AUTOSAVE_INTERVAL_MS, self.autosave_tick)
+
+    def recover_untitled(self):
+        # 名前を付けずに作業したまま終わっていたら復元する
+        records = read_journal(UNTITLED_JOURNAL, 0)
+        if records and messagebox.askyesno("復元", f"保存されずに終了した作業 ({len(records)} 件の変更) があります。復元しますか？"):
+            replay(self.series_data, self.retired_data, records)
+            self.attach_journal()
+            for record in records:
+                self.journal.write(record)
+            self.rebuild_indexes()
+            self.update_series_list()
+        else:
+            self.attach_journal()
+
+    def quit(self):
+        if self.project_path is None and self.journal is not None and self.journal.records:
+            answer = messagebox.askyesnocancel("終了", "保存されていない変更があります。保存してから終了しますか？")
+            if answer is None or (answer and not self.save_data()):
+                return
+        self.status_label.config(text="保存しています…")
+        self.close_project(discard_untitled=True)
+        self.root.quit()
+
+    def attach_store(self, store):
+        self.detach_store()
+        self.store = store
+        self.changes.subscribe(store.apply_change)
+
+    def detach_store(self):
+        if self.store is not None:
+            self.changes.unsubscribe(self.store.apply_change)
+            self.store.close()
+            self.store = None
+
+    @timed
+    def open_database(self):
+        file_path = filedialog.askopenfilename(filetypes=[("SQLite Database", "*.db")])
+        if file_path:
+            store = SQLiteStore(file_path)
+            # データベースは変更を行ごとに書き込むのでジャーナルは使わない
+            self.close_project(discard_untitled=True)
+            # 系列名と編成数だけを読み、中身は系列ウィンドウを開いたときに読む
+            self.series_data = LazySeriesData(store, MAX_LOADED_SERIES)
+            CarWindow.lazy_data = self.series_data
+            self.series_data.listeners.append(self.search_index.on_series_loaded)
+            self.series_data.listeners.append(self.tag_index.on_series_loaded)
+            if self.fleet_stats is not None:
+                self.series_data.listeners.append(self.fleet_stats.on_series_loaded)
+            self.retired_data = store.load_retired()
+            self.attach_store(store)
+            self.rebuild_indexes()
+            self.update_series_list()
+            messagebox.showinfo("読み込み完了", "データベースを読み込みました。")
+
+    @timed
+    def save_database(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".db", filetypes=[("SQLite Database", "*.db")])
+        if file_path:
+            series_data = dict(self.series_data.items())
+            store = SQLiteStore(file_path)
+            store.import_data(series_data, self.retired_data)
+            self.close_project(discard_untitled=True)
+            self.attach_store(store)
+            self.series_data = series_data
+            self.rebuild_indexes()
+            messagebox.showinfo("保存完了", "データベースに保存しました。以降の変更は自動的に書き込まれます。")
+
+    @timed
+    def import_roster(self):
+        file_path = filedialog.askopenfilename(filetypes=[("CSV Files", "*.csv"), ("Parquet Files", "*.parquet")])
+        if file_path:
+            try:
+                RosterImportWindow(self.root, file_path, self.series_data, self.changes)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("エラー", f"名簿を読み込めませんでした: {e}")
+
+    @timed
+    def export_roster(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".csv",
+                                                 filetypes=[("CSV Files", "*.csv"), ("Parquet Files", "*.parquet")])
+        if file_path:
+            RosterExportWindow(self.root, file_path, self.series_data, self.retired_data)
 
+    def formation_count(self, series_name):
+        if isinstance(self.series_data, LazySeriesData):
+            return self.series_data.formation_count(series_name)
+        return len(self.series_data[series_name].get("formations", []))
+
+    def series_row(self, index):
+        series_name = self.series_names[index]
+        return model.series_row(series_name, self.formation_count(series_name))
+
+    @timed
     def update_series_list(self):
-        self.series_listbox.delete(0, tk.END)
-        for series_name in self.series_data.keys():
-            self.series_listbox.insert(tk.END, series_name)
+        self.series_names = list(self.series_data.keys())
+        self.series_listbox.refresh()
+
+    def on_change(self, event):
+        if event.kind == "series":
+            if event.action == "insert":
+                self.series_names.insert(event.index, event.series)
+            elif event.action == "remove":
+                del self.series_names[event.index]
+            self.series_listbox.apply_change(event.action, event.index)
+        elif event.kind == "formation" and event.action != "update":
+            # 編成数の表示だけが変わるので、見えている行を描き直す
+            self.series_listbox.refresh()
+        if event.kind in ("series", "formation", "car"):
+            self.schedule_stats_update()
+
+    def schedule_stats_update(self):
+        # 続けて変更されたときにまとめて集計し直す
+        if self.fleet_stats is not None and self.stats_pending is None:
+            self.stats_pending = self.root.after(300, self.update_fleet_stats)
+
+    @timed
+    def update_fleet_stats(self):
+        self.stats_pending = None
+        if self.fleet_stats is not None:
+            from fleet_stats import format_fleet_summary
+            self.fleet_label.config(text=format_fleet_summary(self.fleet_stats.fleet_summary()))
+
+    def reset_fleet_stats(self):
+        if isinstance(self.series_data, LazySeriesData):
+            # 遅延読み込みの系列は読み込まれたときに加える (写しを渡す)
+            self.fleet_stats.reset({name: None for name in self.series_data})
+        else:
+            self.fleet_stats.reset(dict(self.series_data))
+        self.update_fleet_stats()
 
+    @timed
     def add_series(self):
         series_name = simpledialog.askstring("系列追加", "系列名を入力してください:")
-        if series_name and series_name not in self.series_data:
-            self.series_data[series_name] = {"formations": [], "description": "", "photos": []}
-            self.update_series_list()
+        model.add_series(self.series_data, self.changes, series_name)
 
+    @timed
     def delete_series(self):
         selected = self.series_listbox.curselection()
         if selected:
-            series_name = self.series_listbox.get(selected[0])
+            series_name = self.series_names[selected[0]]
             if messagebox.askyesno("確認", f"系列「{series_name}」を削除しますか？"):
-                del self.series_data[series_name]
-                self.update_series_list()
+                model.remove_series(self.series_data, self.changes, series_name, selected[0])
+                shared_windows().close(("series", series_name))
 
+    @timed
     def open_series_window(self, event):
         selected = self.series_listbox.curselection()
         if selected:
-            series_name = self.series_listbox.get(selected[0])
-            series_data = self.series_data[series_name]
-            SeriesWindow(self.root, series_name, series_data, self.retired_data)
+            self.open_series(self.series_names[selected[0]])
+
+    def open_series(self, series_name):
+        # 開いていればそのウィンドウを前に出す
+        series_data = self.series_data[series_name]
+        return shared_windows().show(("series", series_name),
+                                     lambda: self.create_series_window(series_name, series_data), series_data)
+
+    def create_series_window(self, series_name, series_data):
+        window = SeriesWindow(self.root, series_name, series_data, self.retired_data, self.retired_index,
+                              self.changes, self.tag_index, self.fleet_stats)
+        if isinstance(self.series_data, LazySeriesData):
+            # 開いている間は系列をメモリから外さない
+            lazy_data = self.series_data
+            lazy_data.pin(series_name)
+
+            def unpin(event):
+                if event.widget is window.window:
+                    lazy_data.unpin(series_name)
+            window.window.bind("<Destroy>", unpin, add="+")
+        return window
+
+    @timed
+    def open_search_result(self, result):
+        window = self.open_series(result.series)
+        formations = self.series_data[result.series]["formations"]
+        if result.formation is not None and any(f is result.formation for f in formations):
+            formation_window = FormationWindow.show(window.window, result.series, result.formation,
+                                                    self.retired_data, self.retired_index, self.changes)
+            if result.car is not None:
+                cars = result.formation["cars"]
+                index = next((i for i, car in enumerate(cars) if car is result.car), None)
+                if index is not None:
+                    formation_window.car_listbox.selection_set(index)
+                    formation_window.car_listbox.see(index)
+
+    @timed
+    def rebuild_indexes(self):
+        if isinstance(self.series_data, LazySeriesData):
+            # 読み込み済みでない系列は名前だけ (中身は読み込まれたときに追加される)
+            series_data = {name: None for name in self.series_data}
+        else:
+            series_data = self.series_data
+        self.search_index.reset(series_data)
+        self.tag_index.reset(series_data)
+        self.retired_index.reset(self.retired_data)
+        if self.fleet_stats is not None:
+            self.reset_fleet_stats()
 
     def show_retired_list(self):
-        RetiredWindow(self.root, self.retired_data)
+        shared_windows().show(("retired",), lambda: RetiredWindow(self.root, self.retired_data, self.retired_index,
+                                                                  self.changes), self.retired_data)
+
+    def show_project_diff(self):
+        shared_windows().show(("diff",), lambda: ProjectDiffWindow(self.root, self.series_data, self.retired_data,
+                                                                   self.changes))
+
+    def show_diagnostics(self):
+        shared_windows().show(("diagnostics",), lambda: DiagnosticsWindow(self.root))
+
+    @timed
+    def show_search(self):
+        shared_windows().show(("search",), lambda: SearchWindow(self.root, self.search_index, self.open_search_result))
 
 class SeriesWindow:
-    def __init__(self, parent, series_name, series_data, retired_data):
+    @timed
+    def __init__(self, parent, series_name, series_data, retired_data, retired_index, changes, tag_index, fleet_stats):
         self.series_name = series_name
         self.series_data = series_data
         self.retired_data = retired_data
+        self.retired_index = retired_index
+        self.changes = changes
+        self.tag_index = tag_index
+        self.fleet_stats = fleet_stats  # NumPy が無ければ None
+        self.filter_mask = 0      # 車両タイプでの絞り込み (0 なら全編成)
+        self.visible = None       # 絞り込み中に表示している編成の位置
 
         self.window = tk.Toplevel(parent)
         self.window.title(f"系列: {series_name}")
         self.window.geometry("1400x900")
 
         self.create_ui()
+        self.changes.subscribe(self.on_change)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+
+    def on_change(self, event):
+        if event.series == self.series_name and event.kind == "series" and event.action == "update":
+            # 結合などで解説がほかから変わったときは表示を合わせる
+            description = self.series_data.get("description", "")
+            if self.series_description.get("1.0", tk.END).strip() != description:
+                self.series_description.delete("1.0", tk.END)
+                self.series_description.insert(tk.END, description)
+            return
+        if event.series != self.series_name or event.kind not in ("formation", "car"):
+            return
+        if self.filter_mask:
+            self.apply_filter()
+        elif event.kind == "formation":
+            self.formation_listbox.apply_change(event.action, event.index)
+        self.update_type_summary()
+        self.update_stats()
+
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.changes.unsubscribe(self.on_change)
 
     def create_ui(self):
+        # 車両タイプでの絞り込み
+        filter_frame = tk.Frame(self.window)
+        filter_frame.pack(side=tk.TOP, fill=tk.X, padx=5, pady=5)
+        tk.Label(filter_frame, text="車両タイプで絞り込み:").pack(side=tk.LEFT)
+        self.filter_combo = ttk.Combobox(filter_frame, values=["すべて"] + list(TAG_NAMES), state="readonly", width=12)
+        self.filter_combo.current(0)
+        self.filter_combo.pack(side=tk.LEFT, padx=5)
+        self.filter_combo.bind("<<ComboboxSelected>>", self.change_filter)
+        self.type_summary_label = tk.Label(filter_frame, text="", anchor="w")
+        self.type_summary_label.pack(side=tk.LEFT, padx=10)
+
         # 編成リストボックス
-        self.formation_listbox = tk.Listbox(self.window, height=25, width=50, font=("Helvetica", 12))
+        self.formation_listbox = VirtualListbox(self.window, self.formation_row_count,
+                                                self.formation_row, height=25, width=50, font=("Helvetica", 12))
         self.formation_listbox.pack(side=tk.LEFT, fill=tk.BOTH, padx=5, pady=5)
         self.formation_listbox.bind("<Double-1>", self.open_formation_window)
+        self.formation_listbox.bind("<ButtonRelease-1>", lambda event: self.update_stats(), add="+")
 
         # 編成操作ボタン
         btn_frame = tk.Frame(self.window)
@@ -161,6 +653,7 @@ class SeriesWindow:
         tk.Button(btn_frame, text="編成削除", command=self.delete_formation).pack(fill=tk.X, pady=5)
         tk.Button(btn_frame, text="編成コピー", command=self.copy_formation).pack(fill=tk.X, pady=5)
         tk.Button(btn_frame, text="アルバム編集", command=self.edit_album).pack(fill=tk.X, pady=5)
+        tk.Button(btn_frame, text="編成図", command=self.show_diagram).pack(fill=tk.X, pady=5)
 
         # 解説テキスト
         tk.Label(btn_frame, text="解説:").pack(anchor="w", pady=5)
@@ -169,391 +662,503 @@ class SeriesWindow:
         self.series_description.insert(tk.END, self.series_data.get("description", ""))
         self.series_description.bind("<FocusOut>", self.save_description)
 
+        # 統計 (集計に時間がかかるので、表示したときに作る)
+        self.stats_button = tk.Button(btn_frame, text="統計を表示", command=self.toggle_stats)
+        self.stats_button.pack(fill=tk.X, pady=5)
+        self.stats_label = None
+
         self.update_formation_list()
+        self.update_type_summary()
+
+    def formation_row_count(self):
+        if self.visible is not None:
+            return len(self.visible)
+        return len(self.series_data.get("formations", []))
+
+    def formation_row(self, index):
+        return model.formation_row(self.series_data["formations"][self.formation_index(index)])
+
+    def formation_index(self, row):
+        # 表示行 -> 編成リスト内の位置
+        return row if self.visible is None else self.visible[row]
 
+    def selected_formation_index(self):
+        selected = self.formation_listbox.curselection()
+        return self.formation_index(selected[0]) if selected else None
+
+    @timed
     def update_formation_list(self):
-        self.formation_listbox.delete(0, tk.END)
-        for formation in self.series_data.get("formations", []):
-            self.formation_listbox.insert(tk.END, formation["name"])
+        self.formation_listbox.refresh()
+
+    def change_filter(self, event):
+        name = self.filter_combo.get()
+        self.filter_mask = TAG_BITS.get(name, 0)
+        self.formation_listbox.selection_clear()
+        self.apply_filter()
+
+    @timed
+    def apply_filter(self):
+        if self.filter_mask:
+            self.visible = self.tag_index.formations_with(self.series_data.get("formations", []), self.filter_mask)
+        else:
+            self.visible = None
+        self.update_formation_list()
 
+    def toggle_stats(self):
+        if self.stats_label is None:
+            self.stats_label = tk.Label(self.stats_button.master, text="", anchor="w", justify=tk.LEFT,
+                                        wraplength=400)
+        if self.stats_label.winfo_manager():
+            self.stats_label.pack_forget()
+            self.stats_button.config(text="統計を表示")
+        else:
+            self.stats_label.pack(fill=tk.X, pady=5, after=self.stats_button)
+            self.stats_button.config(text="統計を隠す")
+            self.update_stats()
+
+    @timed
+    def update_stats(self):
+        if self.stats_label is None or not self.stats_label.winfo_manager():
+            return
+        if self.fleet_stats is None:
+            self.stats_label.config(text="NumPy がインストールされていないため、統計は表示できません。")
+            return
+        from fleet_stats import format_formation_summary, format_series_summary
+        text = format_series_summary(self.fleet_stats.series_summary(self.series_name))
+        index = self.selected_formation_index()
+        if index is not None:
+            formation = self.series_data["formations"][index]
+            text += f"\n\n{formation['name']}:\n" + format_formation_summary(self.fleet_stats.formation_summary(formation))
+        self.stats_label.config(text=text)
+
+    def update_type_summary(self):
+        counts = self.tag_index.counts(self.series_name)
+        self.type_summary_label.config(text="  ".join(f"{name} {count}両" for name, count in counts.items()))
+
+    @timed
     def add_formation(self):
         formation_name = simpledialog.askstring("編成追加", "編成名を入力してください:")
         if formation_name:
-            self.series_data["formations"].append({
-                "name": formation_name,
-                "cars": [],
-                "photos": [],
-                "description": ""
-            })
-            self.update_formation_list()
+            model.add_formation(self.changes, self.series_name, self.series_data, formation_name)
 
+    @timed
     def delete_formation(self):
-        selected = self.formation_listbox.curselection()
-        if selected:
-            formation_name = self.formation_listbox.get(selected[0])
+        index = self.selected_formation_index()
+        if index is not None:
+            formation_name = self.series_data["formations"][index]["name"]
             if messagebox.askyesno("確認", f"編成「{formation_name}」を削除しますか？"):
-                del self.series_data["formations"][selected[0]]
-                self.update_formation_list()
+                formation = model.remove_formation(self.changes, self.series_name, self.series_data, index)
+                shared_windows().close(("formation", id(formation)))
 
+    @timed
     def copy_formation(self):
-        selected = self.formation_listbox.curselection()
-        if selected:
-            formation = self.series_data["formations"][selected[0]]
-            new_formation = formation.copy()
-            new_formation["name"] += " (コピー)"
-            self.series_data["formations"].append(new_formation)
-            self.update_formation_list()
+        index = self.selected_formation_index()
+        if index is not None:
+            model.copy_formation(self.changes, self.series_name, self.series_data, index)
 
+    @timed
     def open_formation_window(self, event):
-        selected = self.formation_listbox.curselection()
-        if selected:
-            formation = self.series_data["formations"][selected[0]]
-            FormationWindow(self.window, formation, self.retired_data)
+        index = self.selected_formation_index()
+        if index is not None:
+            formation = self.series_data["formations"][index]
+            FormationWindow.show(self.window, self.series_name, formation, self.retired_data, self.retired_index,
+                                 self.changes)
+
+    def show_diagram(self):
+        shared_windows().show(("diagram", self.series_name),
+                              lambda: FormationDiagramWindow(self.window, self.series_name, self.series_data,
+                                                             self.retired_data, self.retired_index, self.changes),
+                              self.series_data)
 
     def edit_album(self):
-        AlbumWindow(self.window, self.series_data)
+        shared_windows().show(("album", self.series_name),
+                              lambda: AlbumWindow(self.window, self.series_name, self.series_data, self.changes),
+                              self.series_data)
 
     def save_description(self, event):
-        self.series_data["description"] = self.series_description.get("1.0", tk.END).strip()
+        description = self.series_description.get("1.0", tk.END).strip()
+        model.set_series_description(self.changes, self.series_name, self.series_data, description)
 
 class AlbumWindow:
-    def __init__(self, parent, series_data):
+    @timed
+    def __init__(self, parent, series_name, series_data, changes):
+        self.series_name = series_name
         self.series_data = series_data
+        self.changes = changes
 
         self.window = tk.Toplevel(parent)
         self.window.title(f"アルバム: {self.series_data.get('name', '')}")
         self.window.geometry("800x600")
 
         self.create_ui()
+        self.changes.subscribe(self.on_change)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+
+    def on_change(self, event):
+        if event.kind == "series_photo" and event.series == self.series_name:
+            if event.action == "insert":
+                self.photo_listbox.insert(event.index, display_name(event.value))
+            elif event.action == "remove":
+                self.photo_listbox.delete(event.index)
+
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.changes.unsubscribe(self.on_change)
 
     def create_ui(self):
         # 写真リストボックス
         self.photo_listbox = tk.Listbox(self.window, height=30, width=50, font=("Helvetica", 12))
         self.photo_listbox.pack(side=tk.LEFT, fill=tk.BOTH, padx=5, pady=5)
+        self.photo_listbox.bind("<<ListboxSelect>>", self.browse_photo)
 
         # 写真操作ボタン
         btn_frame = tk.Frame(self.window)
         btn_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
 
         tk.Button(btn_frame, text="写真追加", command=self.add_photo).pack(fill=tk.X, pady=5)
+        tk.Button(btn_frame, text="フォルダから一括取り込み", command=self.import_folder).pack(fill=tk.X, pady=5)
         tk.Button(btn_frame, text="写真削除", command=self.delete_photo).pack(fill=tk.X, pady=5)
         tk.Button(btn_frame, text="写真プレビュー", command=self.preview_photo).pack(fill=tk.X, pady=5)
 
         self.update_photo_list()
 
+    @timed
     def update_photo_list(self):
         self.photo_listbox.delete(0, tk.END)
         for photo in self.series_data.get("photos", []):
-            self.photo_listbox.insert(tk.END, photo)
+            self.photo_listbox.insert(tk.END, display_name(photo))
 
     def add_photo(self):
         file_paths = filedialog.askopenfilenames(title="写真を選択", filetypes=[("画像ファイル", "*.png;*.jpg;*.jpeg;*.gif")])
-        if file_paths:
-            self.series_data["photos"].extend(file_paths)
-            self.update_photo_list()
+        for path in file_paths:
+            try:
+                photo = store_photo(path)
+            except OSError as e:
+                messagebox.showerror("エラー", f"写真を取り込めませんでした: {e}")
+                return
+            model.add_series_photo(self.changes, self.series_name, self.series_data, photo)
+
+    def import_folder(self):
+        directory = filedialog.askdirectory(title="取り込むフォルダを選択")
+        if not directory:
+            return
+        from album_import import find_images
+        paths = find_images(directory)
+        if not paths:
+            messagebox.showinfo("一括取り込み", "画像ファイルが見つかりませんでした。")
+            return
+        AlbumImportWindow(self.window, self.series_name, self.series_data, self.changes, paths)
 
     def delete_photo(self):
         selected = self.photo_listbox.curselection()
         if selected:
-            photo = self.photo_listbox.get(selected[0])
-            self.series_data["photos"].remove(photo)
-            self.update_photo_list()
+            model.remove_series_photo(self.changes, self.series_name, self.series_data, selected[0])
 
+    @timed
     def preview_photo(self):
         selected = self.photo_listbox.curselection()
         if selected:
-            photo_path = self.photo_listbox.get(selected[0])
-            if os.path.exists(photo_path):
-                PreviewWindow(self.window, photo_path)
+            photo_path = self.series_data["photos"][selected[0]]
+            if os.path.exists(resolve_photo(photo_path)):
+                PreviewWindow.show(self.window, photo_path)
             else:
                 messagebox.showerror("エラー", "選択された写真が見つかりません。")
 
-class PreviewWindow:
-    def __init__(self, parent, photo_path):
-        self.photo_path = photo_path
+    def browse_photo(self, event):
+        # プレビューを開いていれば、選んだ写真に切り替える
+        preview = shared_windows().find(("preview",))
+        selected = self.photo_listbox.curselection()
+        if preview is not None and selected:
+            preview.load(self.series_data["photos"][selected[0]])
 
-        self.window = tk.Toplevel(parent)
-        self.window.title("写真プレビュー")
-        self.window.geometry("600x600")
+class AlbumImportWindow:
+    def __init__(self, parent, series_name, series_data, changes, paths):
+        self.series_name = series_name
+        self.series_data = series_data
+        self.changes = changes
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
+        self.bundle = current_bundle()
+        self.refs = {}   # 取り込んだパス -> バンドルの参照
 
-        # 画像表示
+        self.window = tk.Toplevel(parent)
+        self.window.title("写真の一括取り込み")
+        self.window.geometry("420x120")
+
+        self.status_label = tk.Label(self.window, text=f"{len(paths)} 枚の写真を確認しています…")
+        self.status_label.pack(anchor="w", padx=10, pady=5)
+        self.progress = ttk.Progressbar(self.window, length=400, mode="determinate")
+        self.progress.pack(padx=10, pady=5)
+        tk.Button(self.window, text="中止", command=self.window.destroy).pack(pady=5)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+
+        # 取り込みは別スレッドで行い、進み具合はキュー経由で受け取る
+        existing = [resolve_photo(photo) for photo in self.series_data.get("photos", [])]
+        threading.Thread(target=self.run, args=(paths, existing), daemon=True).start()
+        self.window.after(100, self.poll)
+
+    def run(self, paths, existing):
         try:
-            img = Image.open(photo_path)
-            img.thumbnail((600, 600))
-            self.photo = ImageTk.PhotoImage(img)
-            label = tk.Label(self.window, image=self.photo)
-            label.pack()
+            from album_import import import_album
+            result = import_album(paths, existing,
+                                  progress=lambda done, total: self.messages.put(("progress", done, total)),
+                                  cancelled=self.cancelled.is_set)
+            if self.bundle is not None and not result.cancelled:
+                # バンドルへの書き込みもここで済ませる (選ばれなかった写真は保存後に消える)
+                for info in result.accepted + [near[0] for near in result.near]:
+                    self.refs[info["path"]] = self.bundle.import_file(info["path"])
+            self.messages.put(("done", result))
         except Exception as e:
-            messagebox.showerror("エラー", f"画像を開く際にエラーが発生しました: {e}")
-            self.window.destroy()
-
-class FormationWindow:
-    def __init__(self, parent, formation, retired_data):
-        self.formation = formation
-        self.retired_data = retired_data
-
-        self.window = tk.Toplevel(parent)
-        self.window.title(f"編成: {formation['name']}")
-        self.window.geometry("1000x800")
+            self.messages.put(("error", e))
 
-        self.create_ui()
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.cancelled.set()
 
-    def create_ui(self):
-        self.car_listbox = tk.Listbox(self.window, height=25, width=50, font=("Helvetica", 12))
-        self.car_listbox.pack(side=tk.LEFT, fill=tk.BOTH, padx=5, pady=5)
-        self.car_listbox.bind("<Double-1>", self.edit_car)
-
-        btn_frame = tk.Frame(self.window)
-        btn_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=5, pady=5)
-
-        tk.Button(btn_frame, text="車両追加", command=self.add_car).pack(fill=tk.X, pady=5)
-        tk.Button(btn_frame, text="車両削除", command=self.delete_car).pack(fill=tk.X, pady=5)
-        tk.Button(btn_frame, text="写真を読み込む", command=self.attach_photo).pack(fill=tk.X, pady=5)
-
-        # 写真リストボックス
-        self.photo_listbox = tk.Listbox(self.window, height=10, width=50, font=("Helvetica", 12))
-        self.photo_listbox.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=5)
-        self.photo_listbox.image_refs = []  # 画像の参照を保持するリスト
-
-        tk.Label(btn_frame, text="解説:").pack(anchor="w", pady=5)
-        self.formation_description = tk.Text(btn_frame, height=15, width=40, font=("Helvetica", 12))
-        self.formation_description.pack(fill=tk.X, pady=5)
-        self.formation_description.insert(tk.END, self.formation["description"])
-        self.formation_description.bind("<FocusOut>", self.save_formation_description)
-
-        self.update_car_list()
-
-def attach_photo(self):
-    try:
-        print("写真追加ボタンが押されました。")
-        file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.gif")])
-        if not file_path:
-            print("ファイルが選択されませんでした。")
+    def poll(self):
+        if self.cancelled.is_set():
             return
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                done, total = message[1], message[2]
+                self.progress.config(maximum=total, value=done)
+                self.status_label.config(text=f"確認中: {done} / {total}")
+            elif message[0] == "done":
+                self.finish(message[1])
+                return
+            else:
+                messagebox.showerror("エラー", f"取り込み中にエラーが発生しました: {message[1]}")
+                self.window.destroy()
+                return
+        self.window.after(100, self.poll)
+
+    def finish(self, result):
+        accepted = [info["path"] for info in result.accepted]
+        if result.near and messagebox.askyesno(
+                "確認", f"既存の写真によく似た写真が {len(result.near)} 枚あります。これらも取り込みますか？"):
+            accepted.extend(info["path"] for info, original, distance in result.near)
+
+        # まとめてアルバムに加える
+        for path in accepted:
+            model.add_series_photo(self.changes, self.series_name, self.series_data, self.refs.get(path, path))
+
+        lines = [f"取り込み: {len(accepted)} 枚", f"重複のため除外: {len(result.exact)} 枚"]
+        if result.near:
+            lines.append(f"よく似た写真: {len(result.near)} 枚")
+        if result.errors:
+            lines.append(f"読み込めないファイル: {len(result.errors)} 枚")
+            lines.extend(f"  {path}: {error}" for path, error in result.errors[:10])
+        messagebox.showinfo("一括取り込み完了", "\n".join(lines))
+        self.window.destroy()
 
-        print(f"選択されたファイルパス: {file_path}")
-        img = Image.open(file_path)
-        img.thumbnail((400, 300))
-        photo = ImageTk.PhotoImage(img)
-
-        if "photos" not in self.formation:
-            self.formation["photos"] = []
-
-        self.formation["photos"].append({"path": file_path, "image": photo})
-        index = len(self.formation["photos"]) - 1
-        self.photo_listbox.insert(tk.END, f"写真 {index + 1}")
-        self.photo_listbox.image_refs.append(photo)
-        print("写真が正常に追加されました。")
-
-    except Exception as e:
-        print(f"エラーが発生しました: {e}")
-        messagebox.showerror("エラー", f"写真を追加中にエラーが発生しました: {e}")
-
+class RosterImportWindow:
+    def __init__(self, parent, path, series_data, changes):
+        from roster_io import RosterImport
+        # 取り込みは Tk のスレッドで少しずつ行う (変更イベントを各ウィンドウに送るため)
+        self.importer = RosterImport(path, series_data, changes)
+        self.path = path
+        self.cancelled = False
 
+        self.window = tk.Toplevel(parent)
+        self.window.title("名簿の取り込み")
+        self.window.geometry("420x120")
+        self.window.grab_set()  # 取り込み中に同じ編成を編集しないように
+
+        self.status_label = tk.Label(self.window, text=f"{os.path.basename(path)} を取り込んでいます…")
+        self.status_label.pack(anchor="w", padx=10, pady=5)
+        self.progress = ttk.Progressbar(self.window, length=400, mode="determinate")
+        self.progress.pack(padx=10, pady=5)
+        tk.Button(self.window, text="中止", command=self.window.destroy).pack(pady=5)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+        self.window.after_idle(self.step)
+
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.cancelled = True
+            self.importer.close()
+
+    @timed
+    def step(self):
+        if self.cancelled:
+            return
         try:
-            img = Image.open(file_path)
-            img.thumbnail((400, 300))
-            photo = ImageTk.PhotoImage(img)
-
-            self.formation["photos"].append({"path": file_path, "image": photo})
-            index = len(self.formation["photos"]) - 1
-            self.photo_listbox.insert(tk.END, f"写真 {index + 1}")
-            self.photo_listbox.image_refs.append(photo)
-
-        except Exception as e:
-            messagebox.showerror("エラー", f"画像を読み込めませんでした: {e}")
+            more = self.importer.step()
+        except (OSError, ValueError) as e:
+            messagebox.showerror("エラー", f"取り込み中にエラーが発生しました: {e}")
+            self.window.destroy()
+            return
+        done, total = self.importer.progress()
+        self.progress.config(maximum=max(total, 1), value=done)
+        self.status_label.config(text=f"取り込み中: {self.importer.cars} 両")
+        if more:
+            self.window.after(1, self.step)
+        else:
+            self.finish()
+
+    def finish(self):
+        importer = self.importer
+        lines = [f"取り込み: {importer.cars} 両",
+                 f"新しい系列: {importer.new_series}  新しい編成: {importer.new_formations}"]
+        if importer.error_count:
+            lines.append(f"誤りのため飛ばした行: {importer.error_count} 行")
+            lines.extend(f"  {line} 行目: {message}" for line, message in importer.errors[:10])
+        messagebox.showinfo("名簿の取り込み完了", "\n".join(lines))
+        self.window.destroy()
 
-class CarWindow:
-    def __init__(self, parent, formation, update_callback, car=None, index=None):
-        self.formation = formation
-        self.update_callback = update_callback
-        self.car = car
-        self.index = index
+class RosterExportWindow:
+    def __init__(self, parent, path, series_data, retired_data):
+        self.path = path
+        self.messages = queue.Queue()
+        self.cancelled = threading.Event()
 
         self.window = tk.Toplevel(parent)
-        self.window.title("車両編集" if car else "車両追加")
-        self.window.geometry("500x700")
-
-        self.create_ui()
-
-    def create_ui(self):
-        frame = tk.Frame(self.window)
-        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-
-        # 車両名
-        tk.Label(frame, text="車両名:").pack(anchor="w", pady=5)
-        self.name_entry = tk.Entry(frame, font=("Helvetica", 12))
-        self.name_entry.pack(fill=tk.X, pady=5)
-        if self.car:
-            self.name_entry.insert(tk.END, self.car.get("name", ""))
-
-        # 車両タイプ（タグ）
-        tk.Label(frame, text="車両タイプ (1〜6個):").pack(anchor="w", pady=5)
-        self.type_frame = tk.Frame(frame)
-        self.type_frame.pack(fill=tk.X, pady=5)
-
-        self.selected_types = self.car.get("tags", []) if self.car else []
-        self.type_vars = []
-        self.update_type_buttons()
-
-        tk.Button(frame, text="タグ編集", command=self.edit_tags).pack(pady=5)
-
-        # ステータス項目
-        status_fields = [
-            ("加速度 (m/s²)", "acceleration"),
-            ("減速度 (m/s²)", "deceleration"),
-            ("出力 (kW)", "power_kw"),
-            ("制御方式", "control_method")
-        ]
-
-        self.status_entries = {}
-        for label_text, key in status_fields:
-            tk.Label(frame, text=label_text + ":").pack(anchor="w", pady=5)
-            entry = tk.Entry(frame, font=("Helvetica", 12))
-            entry.pack(fill=tk.X, pady=5)
-            if self.car:
-                entry.insert(tk.END, str(self.car.get(key, "")))
-            self.status_entries[key] = entry
-
-        # 車両解説
-        tk.Label(frame, text="車両解説:").pack(anchor="w", pady=5)
-        self.description_text = tk.Text(frame, height=5, font=("Helvetica", 12))
-        self.description_text.pack(fill=tk.BOTH, pady=5)
-        if self.car:
-            self.description_text.insert(tk.END, self.car.get("description", ""))
-
-        # 保存ボタン
-        tk.Button(frame, text="保存", command=self.save_car).pack(pady=10)
-
-    def update_type_buttons(self):
-        for widget in self.type_frame.winfo_children():
-            widget.destroy()
-        for t in self.selected_types:
-            tk.Label(self.type_frame, text=t, bg=CAR_TYPE_COLORS.get(t, "grey"), fg="white", padx=5, pady=2, relief=tk.RIDGE).pack(side=tk.LEFT, padx=2, pady=2)
-
-    def edit_tags(self):
-        edit_window = tk.Toplevel(self.window)
-        edit_window.title("車両タイプ選択")
-        edit_window.geometry("300x400")
-
-        tk.Label(edit_window, text="車両タイプを選択してください (最大6個):").pack(anchor="w", pady=5)
-
-        # 選択可能なタイプをリストボックスで表示
-        listbox = tk.Listbox(edit_window, selectmode=tk.MULTIPLE, font=("Helvetica", 12))
-        for code, name in CAR_TYPES.items():
-            listbox.insert(tk.END, f"{code}: {name}")
-        listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
-
-        # 既に選択されているタイプを選択
-        existing_indices = [list(CAR_TYPES.values()).index(t) for t in self.selected_types if t in CAR_TYPES.values()]
-        for idx in existing_indices:
-            listbox.selection_set(idx)
-
-        def save_tags():
-            selected_indices = listbox.curselection()
-            selected = [list(CAR_TYPES.values())[i] for i in selected_indices]
-            if len(selected) > 6:
-                messagebox.showerror("エラー", "車両タイプは最大6個まで選択できます。")
-                return
-            self.selected_types = selected
-            self.update_type_buttons()
-            edit_window.destroy()
-
-        tk.Button(edit_window, text="保存", command=save_tags).pack(pady=5)
+        self.window.title("名簿の書き出し")
+        self.window.geometry("420x120")
+
+        self.status_label = tk.Label(self.window, text=f"{os.path.basename(path)} に書き出しています…")
+        self.status_label.pack(anchor="w", padx=10, pady=5)
+        self.progress = ttk.Progressbar(self.window, length=400, mode="determinate")
+        self.progress.pack(padx=10, pady=5)
+        tk.Button(self.window, text="中止", command=self.window.destroy).pack(pady=5)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+
+        # 写しを取ってから別スレッドで書き出すので、その間も編集できる
+        series_data, retired_data = model.snapshot(series_data, retired_data)
+        threading.Thread(target=self.run, args=(series_data,), daemon=True).start()
+        self.window.after(100, self.poll)
+
+    def run(self, series_data):
+        try:
+            from roster_io import export_roster
+            count = export_roster(self.path, series_data,
+                                  progress=lambda done, total: self.messages.put(("progress", done, total)),
+                                  cancelled=self.cancelled.is_set)
+            self.messages.put(("done", count))
+        except Exception as e:
+            self.messages.put(("error", e))
 
-    def save_car(self):
-        name = self.name_entry.get().strip()
-        if not name:
-            messagebox.showerror("エラー", "車両名を入力してください。")
-            return
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.cancelled.set()
 
-        tags = self.selected_types
-        if len(tags) == 0:
-            messagebox.showerror("エラー", "少なくとも1つの車両タイプを選択してください。")
+    def poll(self):
+        if self.cancelled.is_set():
             return
-        elif len(tags) > 6:
-            messagebox.showerror("エラー", "車両タイプは最大6個まで選択できます。")
-            return
-
-        # ステータス項目の取得
-        try:
-            acceleration = float(self.status_entries["acceleration"].get())
-            deceleration = float(self.status_entries["deceleration"].get())
-            power_kw = float(self.status_entries["power_kw"].get())
-            control_method = self.status_entries["control_method"].get().strip()
-        except ValueError:
-            messagebox.showerror("エラー", "ステータス項目には数値を入力してください。")
-            return
-
-        description = self.description_text.get("1.0", tk.END).strip()
-
-        # 色の設定（最初のタグの色を使用）
-        color = CAR_TYPE_COLORS.get(tags[0], "black")
-
-        car_data = {
-            "name": name,
-            "tags": tags,
-            "color": color,
-            "acceleration": acceleration,
-            "deceleration": deceleration,
-            "power_kw": power_kw,
-            "control_method": control_method,
-            "description": description
-        }
-
-        if self.car and self.index is not None:
-            # 編集の場合
-            self.formation["cars"][self.index] = car_data
-        else:
-            # 追加の場合
-            self.formation["cars"].append(car_data)
-
-        self.update_callback()
-        self.window.destroy()
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message[0] == "progress":
+                done, total = message[1], message[2]
+                self.progress.config(maximum=total, value=done)
+                self.status_label.config(text=f"書き出し中: {done} / {total} 系列")
+            elif message[0] == "done":
+                messagebox.showinfo("名簿の書き出し完了", f"{message[1]} 両を書き出しました。")
+                self.window.destroy()
+                return
+            else:
+                messagebox.showerror("エラー", f"書き出し中にエラーが発生しました: {message[1]}")
+                self.window.destroy()
+                return
+        self.window.after(100, self.poll)
 
-class RetiredWindow:
-    def __init__(self, parent, retired_data):
+class FormationDiagramWindow:
+    @timed
+    def __init__(self, parent, series_name, series_data, retired_data, retired_index, changes):
+        self.series_name = series_name
+        self.series_data = series_data
         self.retired_data = retired_data
+        self.retired_index = retired_index
+        self.changes = changes
 
         self.window = tk.Toplevel(parent)
-        self.window.title("廃車リスト")
-        self.window.geometry("500x400")
+        self.window.title(f"編成図: {series_name}")
+        self.window.geometry("1400x800")
 
         self.create_ui()
+        self.changes.subscribe(self.on_change)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
 
-    def create_ui(self):
-        tk.Label(self.window, text="廃車一覧").pack(anchor="w", padx=5, pady=5)
-        self.retired_listbox = tk.Listbox(self.window, height=20, width=50, font=("Helvetica", 12))
-        self.retired_listbox.pack(fill=tk.BOTH, padx=5, pady=5)
+    def on_change(self, event):
+        if event.series == self.series_name and event.kind in ("formation", "car"):
+            self.diagram.apply_change(event)
 
-        for retired_car in self.retired_data:
-            self.retired_listbox.insert(tk.END, retired_car["name"])
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.changes.unsubscribe(self.on_change)
 
-        btn_frame = tk.Frame(self.window)
-        btn_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=5)
-
-        tk.Button(btn_frame, text="廃車追加", command=self.add_retired_car).pack(fill=tk.X, pady=5)
-
-    def add_retired_car(self):
-        car_name = simpledialog.askstring("廃車追加", "廃車車両名を入力してください:")
-        if car_name:
-            self.retired_data.append({"name": car_name})
-            self.retired_listbox.insert(tk.END, car_name)
+    def create_ui(self):
+        create_legend(self.window, width=10).pack(fill=tk.X, padx=5, pady=5)
+        tk.Label(self.window, text="ホイールで上下、Shift+ホイールで左右、Ctrl+ホイールで拡大・縮小、右ドラッグで移動。"
+                                   "ダブルクリックで編成を開きます。", anchor="w").pack(fill=tk.X, padx=5)
+        self.diagram = FormationDiagram(self.window, lambda: self.series_data.get("formations", []),
+                                        self.open_formation)
+        self.diagram.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+    def open_formation(self, index):
+        formation = self.series_data["formations"][index]
+        FormationWindow.show(self.window, self.series_name, formation, self.retired_data, self.retired_index,
+                             self.changes)
 
 class FormationWindow:
-    def __init__(self, parent, formation, retired_data):
+    @classmethod
+    def show(cls, parent, series_name, formation, retired_data, retired_index, changes):
+        # 同じ編成のウィンドウが開いていれば前に出す
+        return shared_windows().show(
+            ("formation", id(formation)),
+            lambda: cls(parent, series_name, formation, retired_data, retired_index, changes), formation)
+
+    @timed
+    def __init__(self, parent, series_name, formation, retired_data, retired_index, changes):
+        self.series_name = series_name
         self.formation = formation
         self.retired_data = retired_data
+        self.retired_index = retired_index
+        self.changes = changes
+        self.photo_jobs = []
 
         self.window = tk.Toplevel(parent)
         self.window.title(f"編成: {formation['name']}")
         self.window.geometry("1200x800")
 
         self.create_ui()
+        self.changes.subscribe(self.on_change)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+
+    def on_change(self, event):
+        if event.formation is not self.formation:
+            return
+        if event.kind == "car":
+            self.car_listbox.apply_change(event.action, event.index)
+        elif event.kind == "formation_photo" and event.action == "insert":
+            self.photo_listbox.insert(event.index, f"写真 {event.index + 1}")
+        elif event.kind == "formation_photo" and event.action == "remove":
+            # 後ろの写真の番号が変わるので並べ直す
+            self.photo_listbox.delete(0, tk.END)
+            for index in range(len(self.formation.get("photos", []))):
+                self.photo_listbox.insert(tk.END, f"写真 {index + 1}")
+        elif event.kind == "formation" and event.action == "update":
+            description = self.formation.get("description", "")
+            if self.formation_description.get("1.0", tk.END).strip() != description:
+                self.formation_description.delete("1.0", tk.END)
+                self.formation_description.insert(tk.END, description)
+
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.changes.unsubscribe(self.on_change)
+            # 読み込み中の写真は取り消す
+            for job in self.photo_jobs:
+                job.cancel()
 
     def create_ui(self):
         # 車両リストボックス
-        self.car_listbox = tk.Listbox(self.window, height=30, width=60, font=("Helvetica", 12))
+        self.car_listbox = VirtualListbox(self.window, lambda: len(self.formation.get("cars", [])), self.car_row,
+                                          height=30, width=60, font=("Helvetica", 12))
         self.car_listbox.pack(side=tk.LEFT, fill=tk.BOTH, padx=5, pady=5)
         self.car_listbox.bind("<Double-1>", self.edit_car)
 
@@ -564,6 +1169,14 @@ class FormationWindow:
         tk.Button(btn_frame, text="車両追加", command=self.add_car).pack(fill=tk.X, pady=5)
         tk.Button(btn_frame, text="車両削除", command=self.delete_car).pack(fill=tk.X, pady=5)
         tk.Button(btn_frame, text="車両コピー", command=self.copy_car).pack(fill=tk.X, pady=5)
+        tk.Button(btn_frame, text="廃車にする", command=self.retire_car).pack(fill=tk.X, pady=5)
+        tk.Button(btn_frame, text="写真を読み込む", command=self.attach_photo).pack(fill=tk.X, pady=5)
+
+        # 写真リストボックス
+        self.photo_listbox = tk.Listbox(btn_frame, height=10, width=40, font=("Helvetica", 12))
+        self.photo_listbox.pack(fill=tk.X, pady=5)
+        for index, photo in enumerate(self.formation.get("photos", [])):
+            self.photo_listbox.insert(tk.END, f"写真 {index + 1}")
 
         # 解説テキスト
         tk.Label(btn_frame, text="解説:").pack(anchor="w", pady=5)
@@ -574,53 +1187,201 @@ class FormationWindow:
 
         self.update_car_list()
 
+    def car_row(self, index):
+        return model.car_row(self.formation["cars"][index])
+
+    @timed
     def update_car_list(self):
-        self.car_listbox.delete(0, tk.END)
-        for car in self.formation.get("cars", []):
-            display_name = f"{car['name']} ({', '.join(car.get('tags', []))})"
-            self.car_listbox.insert(tk.END, display_name)
-            self.car_listbox.itemconfig(tk.END, {'fg': car.get("color", "black")})
+        self.car_listbox.refresh()
 
     def add_car(self):
-        CarWindow(self.window, self.formation, self.update_car_list)
+        CarWindow.show(self.window, self.series_name, self.formation, self.changes)
 
+    @timed
     def delete_car(self):
         selected = self.car_listbox.curselection()
         if selected:
             if messagebox.askyesno("確認", "選択された車両を削除しますか？"):
-                del self.formation["cars"][selected[0]]
-                self.update_car_list()
+                model.remove_car(self.changes, self.series_name, self.formation, selected[0])
 
+    @timed
     def copy_car(self):
         selected = self.car_listbox.curselection()
         if selected:
-            car = self.formation["cars"][selected[0]]
-            new_car = car.copy()
-            new_car["name"] += " (コピー)"
-            self.formation["cars"].append(new_car)
-            self.update_car_list()
+            model.copy_car(self.changes, self.series_name, self.formation, selected[0])
 
+    @timed
+    def retire_car(self):
+        selected = self.car_listbox.curselection()
+        if not selected:
+            return
+        car_name = self.formation["cars"][selected[0]].get("name", "")
+        if self.retired_index.contains(car_name):
+            messagebox.showerror("エラー", f"{car_name} はすでに廃車リストにあります。")
+            return
+        text = simpledialog.askstring("廃車", f"{car_name} の廃車日 (YYYY-MM-DD):", parent=self.window,
+                                      initialvalue=date.today().isoformat())
+        if text is None:
+            return
+        try:
+            retired_on = model.retired_date(text)
+        except model.ModelError as e:
+            messagebox.showerror("エラー", str(e))
+            return
+        model.retire_car(self.changes, self.retired_data, self.series_name, self.formation, selected[0], retired_on)
+
+    @timed
     def edit_car(self, event):
         selected = self.car_listbox.curselection()
         if selected:
             car = self.formation["cars"][selected[0]]
-            CarWindow(self.window, self.formation, self.update_car_list, car, selected[0])
+            CarWindow.show(self.window, self.series_name, self.formation, self.changes, car, selected[0])
+
+    @timed
+    def attach_photo(self):
+        file_path = filedialog.askopenfilename(filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.bmp;*.gif")])
+        if not file_path:
+            return
+
+        # 読み込めることを確かめてから編成に加える (復号は別スレッド)
+        self.photo_jobs = [job for job in self.photo_jobs if not job.done]
+        self.photo_jobs.append(shared_loader(self.window).submit(
+            file_path, FORMATION_PHOTO_SIZE,
+            lambda handle: self.add_photo(file_path, handle),
+            lambda e: messagebox.showerror("エラー", f"画像を読み込めませんでした: {e}"),
+        ))
+
+    def add_photo(self, file_path, handle):
+        # 画像は読み込めるかの確認に使うだけで、編成にはパス (参照) だけを残す
+        handle.release()
+        try:
+            file_path = store_photo(file_path)
+        except OSError as e:
+            messagebox.showerror("エラー", f"写真を取り込めませんでした: {e}")
+            return
+        model.add_formation_photo(self.changes, self.series_name, self.formation, file_path)
 
     def save_formation_description(self, event):
-        self.formation["description"] = self.formation_description.get("1.0", tk.END).strip()
+        description = self.formation_description.get("1.0", tk.END).strip()
+        model.set_formation_description(self.changes, self.series_name, self.formation, description)
 
 class CarWindow:
-    def __init__(self, parent, formation, update_callback, car=None, index=None):
-        self.formation = formation
-        self.update_callback = update_callback
-        self.car = car
-        self.index = index
+    # 車両の入力フォームは1つを使い回す (閉じても隠すだけで、次の編集で中身を入れ替える)
+    # 遅延読み込みのデータベースを開いている間は TrainManagerApp が LazySeriesData を入れる。
+    # フォームは編成を持っている間その系列をメモリから外させない (系列のウィンドウを
+    # 閉じたあとに保存しても、外された dict への変更は書かれないため)
+    lazy_data = None
+
+    @classmethod
+    def show(cls, parent, series_name, formation, changes, car=None, index=None):
+        registry = shared_windows()
+        form = registry.find(("car_form",))
+        if form is None:
+            # 開いた編成のウィンドウを閉じても残るように、親はメインウィンドウにする
+            form = cls(parent.winfo_toplevel().nametowidget("."), series_name, formation, changes, car, index)
+            registry.register(("car_form",), form)
+        else:
+            form.load(series_name, formation, changes, car, index)
+        raise_window(form.window)
+        return form
+
+    @timed
+    def __init__(self, parent, series_name, formation, changes, car=None, index=None):
+        self.tag_window = None  # タイプの選択は初めて使うときに作る
+        self.changes = None
+        self.pinned = None      # (LazySeriesData, 系列名)
 
         self.window = tk.Toplevel(parent)
-        self.window.title("車両編集" if car else "車両追加")
         self.window.geometry("500x700")
+        self.window.protocol("WM_DELETE_WINDOW", self.hide)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
 
         self.create_ui()
+        self.load(series_name, formation, changes, car, index)
+
+    def load(self, series_name, formation, changes, car=None, index=None):
+        if self.changes is not changes:
+            if self.changes is not None:
+                self.changes.unsubscribe(self.on_change)
+            changes.subscribe(self.on_change)
+        self.pin_series(series_name)
+        self.series_name = series_name
+        self.formation = formation
+        self.changes = changes
+        self.car = car
+        self.index = index
+        self.window.title("車両編集" if car else "車両追加")
+
+        self.name_entry.delete(0, tk.END)
+        self.selected_mask = car_mask(car) if car else 0
+        # 名前と違うタイプがすでに選ばれていれば、名前を直してもタイプは変えない
+        self.tags_edited = bool(car) and infer_mask(car.get("name", "")) not in (None, self.selected_mask)
+        self.update_type_buttons()
+        for key, entry in self.status_entries.items():
+            entry.delete(0, tk.END)
+        self.description_text.delete("1.0", tk.END)
+        if car:
+            self.name_entry.insert(tk.END, car.get("name", ""))
+            for key, entry in self.status_entries.items():
+                entry.insert(tk.END, str(car.get(key, "")))
+            self.description_text.insert(tk.END, car.get("description", ""))
+        if self.tag_window is not None:
+            self.tag_window.withdraw()
+        self.name_entry.focus_set()
+
+    def hide(self):
+        # 隠している間は編成や車両を持ち続けない。変更イベントの中から呼ばれるので、
+        # ウィンドウが壊されたあとでも例外を出さない (出すとあとの購読者に届かない)
+        if window_exists(self.window):
+            if self.tag_window is not None:
+                self.tag_window.withdraw()
+            self.window.withdraw()
+        self.release()
+
+    def on_destroy(self, event):
+        # プロジェクトを閉じたとき (close_all) など
+        if event.widget is self.window:
+            self.tag_window = None
+            self.release()
+
+    def release(self):
+        if self.changes is not None:
+            self.changes.unsubscribe(self.on_change)
+        self.formation = self.car = self.changes = None
+        self.unpin_series()
+
+    def pin_series(self, series_name):
+        # 新しい系列を固定してから前の系列を外す (同じ系列なら外されないように)
+        previous = self.pinned
+        self.pinned = None
+        if CarWindow.lazy_data is not None:
+            CarWindow.lazy_data.pin(series_name)
+            self.pinned = (CarWindow.lazy_data, series_name)
+        if previous is not None:
+            previous[0].unpin(previous[1])
+
+    def unpin_series(self):
+        if self.pinned is not None:
+            lazy_data, series_name = self.pinned
+            self.pinned = None
+            lazy_data.unpin(series_name)
+
+    def on_change(self, event):
+        # 編集中の編成・車両が消えたらフォームを隠し、前の車両が増減したら位置を合わせる
+        if self.formation is None:
+            return
+        if event.action == "remove" and (
+                (event.kind == "formation" and event.value is self.formation) or
+                (event.kind == "series" and event.value is not None and
+                 any(f is self.formation for f in event.value.get("formations", [])))):
+            self.hide()
+        elif event.kind == "car" and event.formation is self.formation and self.car is not None:
+            if event.action == "remove" and event.index == self.index:
+                self.hide()
+            elif event.action == "remove" and event.index < self.index:
+                self.index -= 1
+            elif event.action == "insert" and event.index <= self.index:
+                self.index += 1
 
     def create_ui(self):
         frame = tk.Frame(self.window)
@@ -630,18 +1391,13 @@ class CarWindow:
         tk.Label(frame, text="車両名:").pack(anchor="w", pady=5)
         self.name_entry = tk.Entry(frame, font=("Helvetica", 12))
         self.name_entry.pack(fill=tk.X, pady=5)
-        if self.car:
-            self.name_entry.insert(tk.END, self.car.get("name", ""))
+        self.name_entry.bind("<KeyRelease>", self.infer_tags)
 
         # 車両タイプ（タグ）
         tk.Label(frame, text="車両タイプ (1〜6個):").pack(anchor="w", pady=5)
         self.type_frame = tk.Frame(frame)
         self.type_frame.pack(fill=tk.X, pady=5)
 
-        self.selected_types = self.car.get("tags", []) if self.car else []
-        self.type_vars = []
-        self.update_type_buttons()
-
         tk.Button(frame, text="タグ編集", command=self.edit_tags).pack(pady=5)
 
         # ステータス項目
@@ -657,16 +1413,12 @@ class CarWindow:
             tk.Label(frame, text=label_text + ":").pack(anchor="w", pady=5)
             entry = tk.Entry(frame, font=("Helvetica", 12))
             entry.pack(fill=tk.X, pady=5)
-            if self.car:
-                entry.insert(tk.END, str(self.car.get(key, "")))
             self.status_entries[key] = entry
 
         # 車両解説
         tk.Label(frame, text="車両解説:").pack(anchor="w", pady=5)
         self.description_text = tk.Text(frame, height=5, font=("Helvetica", 12))
         self.description_text.pack(fill=tk.BOTH, pady=5)
-        if self.car:
-            self.description_text.insert(tk.END, self.car.get("description", ""))
 
         # 保存ボタン
         tk.Button(frame, text="保存", command=self.save_car).pack(pady=10)
@@ -674,137 +1426,543 @@ class CarWindow:
     def update_type_buttons(self):
         for widget in self.type_frame.winfo_children():
             widget.destroy()
-        for t in self.selected_types:
+        for t in mask_to_tags(self.selected_mask):
             tk.Label(self.type_frame, text=t, bg=CAR_TYPE_COLORS.get(t, "grey"), fg="white", padx=5, pady=2, relief=tk.RIDGE).pack(side=tk.LEFT, padx=2, pady=2)
 
+    def infer_tags(self, event=None):
+        # 車両名の形式記号 (クハ・モハ など) からタイプを選ぶ
+        if self.tags_edited:
+            return
+        mask = infer_mask(self.name_entry.get().strip())
+        if mask is not None and mask != self.selected_mask:
+            self.selected_mask = mask
+            self.update_type_buttons()
+
     def edit_tags(self):
-        edit_window = tk.Toplevel(self.window)
-        edit_window.title("車両タイプ選択")
-        edit_window.geometry("300x400")
+        if self.tag_window is None:
+            self.create_tag_window()
+        # 既に選択されているタイプを選択
+        # リストボックスの行番号がそのままビットの位置になる
+        self.tag_listbox.selection_clear(0, tk.END)
+        for idx in range(len(TAG_NAMES)):
+            if self.selected_mask >> idx & 1:
+                self.tag_listbox.selection_set(idx)
+        raise_window(self.tag_window)
+
+    def create_tag_window(self):
+        self.tag_window = tk.Toplevel(self.window)
+        self.tag_window.title("車両タイプ選択")
+        self.tag_window.geometry("300x400")
+        self.tag_window.protocol("WM_DELETE_WINDOW", self.tag_window.withdraw)
 
-        tk.Label(edit_window, text="車両タイプを選択してください (最大6個):").pack(anchor="w", pady=5)
+        tk.Label(self.tag_window, text="車両タイプを選択してください (最大6個):").pack(anchor="w", pady=5)
 
         # 選択可能なタイプをリストボックスで表示
-        listbox = tk.Listbox(edit_window, selectmode=tk.MULTIPLE, font=("Helvetica", 12))
+        self.tag_listbox = tk.Listbox(self.tag_window, selectmode=tk.MULTIPLE, font=("Helvetica", 12))
         for code, name in CAR_TYPES.items():
-            listbox.insert(tk.END, f"{code}: {name}")
-        listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+            self.tag_listbox.insert(tk.END, f"{code}: {name}")
+        self.tag_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
 
-        # 既に選択されているタイプを選択
-        existing_indices = [i for i, (k, v) in enumerate(CAR_TYPES.items()) if v in self.selected_types]
-        for idx in existing_indices:
-            listbox.selection_set(idx)
-
-        def save_tags():
-            selected_indices = listbox.curselection()
-            selected = [list(CAR_TYPES.values())[i] for i in selected_indices]
-            if len(selected) > 6:
-                messagebox.showerror("エラー", "車両タイプは最大6個まで選択できます。")
-                return
-            self.selected_types = selected
-            self.update_type_buttons()
-            edit_window.destroy()
+        tk.Button(self.tag_window, text="保存", command=self.save_tags).pack(pady=5)
 
-        tk.Button(edit_window, text="保存", command=save_tags).pack(pady=5)
+    def save_tags(self):
+        mask = 0
+        for idx in self.tag_listbox.curselection():
+            mask |= 1 << idx
+        if mask.bit_count() > model.MAX_CAR_TAGS:
+            messagebox.showerror("エラー", f"車両タイプは最大{model.MAX_CAR_TAGS}個まで選択できます。")
+            return
+        self.selected_mask = mask
+        self.tags_edited = True
+        self.update_type_buttons()
+        self.tag_window.withdraw()
 
+    @timed
     def save_car(self):
-        name = self.name_entry.get().strip()
-        if not name:
-            messagebox.showerror("エラー", "車両名を入力してください。")
+        mask = self.selected_mask
+        inferred = infer_mask(self.name_entry.get().strip())
+        if inferred is not None and inferred != mask:
+            answer = messagebox.askyesnocancel(
+                "確認", f"車両名から推定したタイプは「{'・'.join(mask_to_tags(inferred))}」ですが、"
+                        f"選択したタイプは「{'・'.join(mask_to_tags(mask))}」です。推定したタイプにしますか？")
+            if answer is None:
+                return
+            if answer:
+                mask = inferred
+        try:
+            car_data = model.make_car(
+                self.name_entry.get(),
+                mask,
+                self.status_entries["acceleration"].get(),
+                self.status_entries["deceleration"].get(),
+                self.status_entries["power_kw"].get(),
+                self.status_entries["control_method"].get(),
+                self.description_text.get("1.0", tk.END),
+            )
+        except model.ModelError as e:
+            messagebox.showerror("エラー", str(e))
             return
 
-        tags = self.selected_types
-        if len(tags) == 0:
-            messagebox.showerror("エラー", "少なくとも1つの車両タイプを選択してください。")
-            return
-        elif len(tags) > 6:
-            messagebox.showerror("エラー", "車両タイプは最大6個まで選択できます。")
-            return
+        if self.car and self.car.get(UNKNOWN_TAGS):
+            # 知らないタイプ名はフォームに出ないので、そのまま引き継ぐ
+            car_data[UNKNOWN_TAGS] = list(self.car[UNKNOWN_TAGS])
 
-        # ステータス項目の取得
-        try:
-            acceleration = float(self.status_entries["acceleration"].get())
-            deceleration = float(self.status_entries["deceleration"].get())
-            power_kw = float(self.status_entries["power_kw"].get())
-            control_method = self.status_entries["control_method"].get().strip()
-        except ValueError:
-            messagebox.showerror("エラー", "ステータス項目には数値を入力してください。")
-            return
-
-        description = self.description_text.get("1.0", tk.END).strip()
-
-        # 色の設定（最初のタグの色を使用）
-        color = CAR_TYPE_COLORS.get(tags[0], "black")
-
-        car_data = {
-            "name": name,
-            "tags": tags,
-            "color": color,
-            "acceleration": acceleration,
-            "deceleration": deceleration,
-            "power_kw": power_kw,
-            "control_method": control_method,
-            "description": description
-        }
-
-        if self.car and self.index is not None:
-            # 編集の場合
-            self.formation["cars"][self.index] = car_data
-        else:
-            # 追加の場合
-            self.formation["cars"].append(car_data)
+        # 編集なら置き換え、追加なら末尾に加える
+        index = self.index if self.car else None
+        model.put_car(self.changes, self.series_name, self.formation, car_data, index)
+        self.hide()
 
-        self.update_callback()
-        self.window.destroy()
+class SearchWindow:
+    def __init__(self, parent, search_index, open_result):
+        self.search_index = search_index
+        self.open_result = open_result
+        self.results = []
+        self.pending = None
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("検索")
+        self.window.geometry("700x600")
+
+        self.create_ui()
+
+    def create_ui(self):
+        self.query_entry = tk.Entry(self.window, font=("Helvetica", 12))
+        self.query_entry.pack(fill=tk.X, padx=5, pady=5)
+        self.query_entry.bind("<KeyRelease>", self.schedule_search)
+        self.query_entry.focus_set()
+
+        self.status_label = tk.Label(self.window, text="系列名・編成名・車両名・制御方式・解説から検索します。")
+        self.status_label.pack(anchor="w", padx=5)
+
+        self.result_listbox = VirtualListbox(self.window, lambda: len(self.results),
+                                             lambda index: (self.results[index].label(), None),
+                                             height=25, width=60, font=("Helvetica", 12))
+        self.result_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.result_listbox.bind("<Double-1>", self.open_selected)
+
+    def schedule_search(self, event):
+        # 入力が落ち着いてから検索する
+        if self.pending is not None:
+            self.window.after_cancel(self.pending)
+        self.pending = self.window.after(150, self.run_search)
+
+    @timed
+    def run_search(self):
+        self.pending = None
+        start = time.perf_counter()
+        self.results, total = self.search_index.search(self.query_entry.get())
+        elapsed = (time.perf_counter() - start) * 1000
+        self.status_label.config(text=f"{total} 件 ({elapsed:.1f} ms)")
+        self.result_listbox.selection_clear()
+        self.result_listbox.see(0)
+
+    def open_selected(self, event):
+        selected = self.result_listbox.curselection()
+        if selected:
+            self.open_result(self.results[selected[0]])
 
 class RetiredWindow:
-    def __init__(self, parent, retired_data):
+    def __init__(self, parent, retired_data, retired_index, changes):
         self.retired_data = retired_data
+        self.retired_index = retired_index
+        self.changes = changes
+        self.rows = retired_data  # 絞り込んでいなければ retired_data そのもの
+        self.pending = None
 
         self.window = tk.Toplevel(parent)
         self.window.title("廃車リスト")
-        self.window.geometry("500x400")
+        self.window.geometry("700x600")
 
         self.create_ui()
+        self.changes.subscribe(self.on_change)
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
 
-    def create_ui(self):
-        tk.Label(self.window, text="廃車一覧").pack(anchor="w", padx=5, pady=5)
-        self.retired_listbox = tk.Listbox(self.window, height=20, width=50, font=("Helvetica", 12))
-        self.retired_listbox.pack(fill=tk.BOTH, padx=5, pady=5)
+    def on_change(self, event):
+        if event.kind != "retired":
+            return
+        if self.rows is self.retired_data:
+            self.retired_listbox.apply_change(event.action, event.index)
+            self.update_count()
+        else:
+            self.schedule_filter()
 
-        for retired_car in self.retired_data:
-            self.retired_listbox.insert(tk.END, retired_car["name"])
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.changes.unsubscribe(self.on_change)
+
+    def create_ui(self):
+        filter_frame = tk.Frame(self.window)
+        filter_frame.pack(fill=tk.X, padx=5, pady=5)
+        tk.Label(filter_frame, text="車両名・番号:").pack(side=tk.LEFT)
+        self.query_entry = tk.Entry(filter_frame, width=20, font=("Helvetica", 12))
+        self.query_entry.pack(side=tk.LEFT, padx=5)
+        tk.Label(filter_frame, text="廃車日:").pack(side=tk.LEFT)
+        self.start_entry = tk.Entry(filter_frame, width=11, font=("Helvetica", 12))
+        self.start_entry.pack(side=tk.LEFT)
+        tk.Label(filter_frame, text="〜").pack(side=tk.LEFT)
+        self.end_entry = tk.Entry(filter_frame, width=11, font=("Helvetica", 12))
+        self.end_entry.pack(side=tk.LEFT)
+        for entry in (self.query_entry, self.start_entry, self.end_entry):
+            entry.bind("<KeyRelease>", self.schedule_filter)
+
+        self.count_label = tk.Label(self.window, text="")
+        self.count_label.pack(anchor="w", padx=5)
 
         btn_frame = tk.Frame(self.window)
         btn_frame.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=5)
-
         tk.Button(btn_frame, text="廃車追加", command=self.add_retired_car).pack(fill=tk.X, pady=5)
 
+        self.retired_listbox = VirtualListbox(self.window, lambda: len(self.rows), self.retired_row,
+                                              height=20, width=70, font=("Helvetica", 12))
+        self.retired_listbox.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.retired_listbox.bind("<Double-1>", self.show_details)
+        self.update_count()
+
+    def retired_row(self, index):
+        retired = self.rows[index]
+        text = retired.get("name", "")
+        if retired.get("date"):
+            text += f"  {retired['date']}"
+        if retired.get("series"):
+            text += f"  ({retired['series']} / {retired.get('formation', '')})"
+        return text, None
+
+    def update_count(self):
+        if self.rows is self.retired_data:
+            self.count_label.config(text=f"{len(self.retired_data)} 両")
+        else:
+            self.count_label.config(text=f"{len(self.rows)} 両 / {len(self.retired_data)} 両")
+
+    def schedule_filter(self, event=None):
+        # 入力が落ち着いてから絞り込む
+        if self.pending is not None:
+            self.window.after_cancel(self.pending)
+        self.pending = self.window.after(150, self.apply_filter)
+
+    @timed
+    def apply_filter(self):
+        self.pending = None
+        query = self.query_entry.get().strip()
+        start = self.start_entry.get().strip()
+        end = self.end_entry.get().strip()
+        rows = self.retired_data
+        try:
+            if start or end:
+                rows = self.retired_index.between(model.retired_date(start) if start else None,
+                                                  model.retired_date(end) if end else None)
+        except model.ModelError:
+            # 日付を入力している途中
+            return
+        if query:
+            matches = self.retired_index.lookup(query)
+            if not matches:
+                # 名前や番号と一致しなければ名前の一部で探す
+                matches = [r for r in self.retired_data if query in r.get("name", "")]
+            if rows is not self.retired_data:
+                in_range = {id(r) for r in rows}
+                matches = [r for r in matches if id(r) in in_range]
+            rows = matches
+        self.rows = rows
+        self.retired_listbox.refresh()
+        self.retired_listbox.selection_clear()
+        self.retired_listbox.see(0)
+        self.update_count()
+
+    def show_details(self, event):
+        selected = self.retired_listbox.curselection()
+        if not selected:
+            return
+        retired = self.rows[selected[0]]
+        lines = [f"車両名: {retired.get('name', '')}"]
+        if retired.get("date"):
+            lines.append(f"廃車日: {retired['date']}")
+        if retired.get("series"):
+            lines.append(f"元の編成: {retired['series']} / {retired.get('formation', '')}")
+        car = retired.get("car")
+        if car:
+            lines.append(f"タイプ: {', '.join(car.get('tags', []))}")
+            lines.append(f"加速度: {car.get('acceleration', '')}  減速度: {car.get('deceleration', '')}  "
+                         f"出力: {car.get('power_kw', '')} kW")
+            if car.get("control_method"):
+                lines.append(f"制御方式: {car['control_method']}")
+            if car.get("description"):
+                lines.append(f"解説: {car['description']}")
+        messagebox.showinfo("廃車", "\n".join(lines), parent=self.window)
+
     def add_retired_car(self):
-        car_name = simpledialog.askstring("廃車追加", "廃車車両名を入力してください:")
-        if car_name:
-            self.retired_data.append({"name": car_name})
-            self.retired_listbox.insert(tk.END, car_name)
+        car_name = simpledialog.askstring("廃車追加", "廃車車両名を入力してください:", parent=self.window)
+        if not car_name or not car_name.strip():
+            return
+        if self.retired_index.contains(car_name):
+            messagebox.showerror("エラー", f"{car_name.strip()} はすでに廃車リストにあります。")
+            return
+        model.add_retired(self.changes, self.retired_data, car_name.strip())
 
 class PreviewWindow:
-    def __init__(self, parent, photo_path):
-        self.photo_path = photo_path
+    # プレビューは1つを使い回し、アルバムで選んだ写真に表示を切り替える。
+    # 画像は表示している1枚の ImageHandle だけを持つ
+    @classmethod
+    def show(cls, parent, photo_path):
+        registry = shared_windows()
+        preview = registry.find(("preview",))
+        if preview is None:
+            preview = cls(parent.winfo_toplevel().nametowidget("."), photo_path)
+            registry.register(("preview",), preview)
+        else:
+            preview.load(photo_path)
+        raise_window(preview.window)
+        return preview
 
+    @timed
+    def __init__(self, parent, photo_path):
         self.window = tk.Toplevel(parent)
         self.window.title("写真プレビュー")
         self.window.geometry("600x600")
 
-        # 画像表示
+        self.handle = None
+        self.job = None
+        self.label = tk.Label(self.window, font=("Helvetica", 12))
+        self.label.pack()
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+        self.load(photo_path)
+
+    def load(self, photo_path):
+        # 読み込みが終わるまでは仮の表示
+        self.photo_path = photo_path
+        self.window.title(f"写真プレビュー: {display_name(photo_path)}")
+        self.release()
+        self.label.config(image="", text="読み込み中…")
+        self.job = shared_loader(self.window).submit(photo_path, PREVIEW_SIZE, self.show_photo, self.show_error)
+
+    @timed
+    def show_photo(self, handle):
+        self.handle = handle
+        self.label.config(image=handle.photo, text="")
+
+    def show_error(self, e):
+        self.label.config(image="", text=f"画像を開く際にエラーが発生しました: {e}")
+
+    def release(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+        if self.handle is not None:
+            self.handle.release()
+            self.handle = None
+
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.release()
+
+class ProjectDiffWindow:
+    # 開いているプロジェクトとファイルの比較、3方向の結合。ファイルの読み込みと
+    # ハッシュの木は別スレッドで作り、開いているプロジェクトの木と結合は Tk の
+    # スレッドで作る (結合は変更操作を通すので、ほかのウィンドウもそのまま追従する)
+    MAX_ROWS = 2000
+
+    def __init__(self, parent, series_data, retired_data, changes):
+        self.series_data = series_data
+        self.retired_data = retired_data
+        self.changes = changes
+        self.messages = queue.Queue()
+        self.closed = False
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("比較・結合")
+        self.window.geometry("900x600")
+        self.create_ui()
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+
+    def create_ui(self):
+        form = tk.Frame(self.window)
+        form.pack(fill=tk.X, padx=5, pady=5)
+        self.other_var = tk.StringVar()
+        self.base_var = tk.StringVar()
+        for row, (label, var) in enumerate((("比較・結合するファイル:", self.other_var),
+                                            ("共通の元のファイル (結合のみ):", self.base_var))):
+            tk.Label(form, text=label).grid(row=row, column=0, sticky="w")
+            tk.Entry(form, textvariable=var, width=70).grid(row=row, column=1, padx=5, pady=2)
+            tk.Button(form, text="選択…", command=lambda var=var: self.choose(var)).grid(row=row, column=2)
+
+        buttons = tk.Frame(self.window)
+        buttons.pack(fill=tk.X, padx=5)
+        self.compare_button = tk.Button(buttons, text="比較", command=self.compare)
+        self.compare_button.pack(side=tk.LEFT, padx=5)
+        self.merge_button = tk.Button(buttons, text="結合 (元からの変更をこのプロジェクトに当てはめる)",
+                                      command=self.merge)
+        self.merge_button.pack(side=tk.LEFT, padx=5)
+
+        self.status_label = tk.Label(self.window, text="", anchor="w")
+        self.status_label.pack(fill=tk.X, padx=5, pady=5)
+
+        columns = ("action", "kind", "detail")
+        self.tree = ttk.Treeview(self.window, columns=columns, height=20)
+        self.tree.heading("#0", text="場所")
+        self.tree.column("#0", width=420)
+        for column, label, width in zip(columns, ("内容", "種類", "詳細"), (60, 60, 340)):
+            self.tree.heading(column, text=label)
+            self.tree.column(column, width=width)
+        self.tree.tag_configure("conflict", foreground="red")
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+    def choose(self, var):
+        file_path = filedialog.askopenfilename(parent=self.window,
+                                               filetypes=[("JSON Files", "*.json"), ("Database Files", "*.db")])
+        if file_path:
+            var.set(file_path)
+
+    def compare(self):
+        other = self.other_var.get().strip()
+        if not other:
+            messagebox.showerror("エラー", "比較するファイルを選択してください。", parent=self.window)
+            return
+        self.start("compare", [other])
+
+    def merge(self):
+        other, base = self.other_var.get().strip(), self.base_var.get().strip()
+        if not other or not base:
+            messagebox.showerror("エラー", "結合するファイルと共通の元のファイルを選択してください。", parent=self.window)
+            return
+        if messagebox.askyesno("確認", f"{os.path.basename(base)} から {os.path.basename(other)} への変更を"
+                                     "このプロジェクトに当てはめますか？", parent=self.window):
+            self.start("merge", [base, other])
+
+    def start(self, action, paths):
+        self.compare_button.config(state=tk.DISABLED)
+        self.merge_button.config(state=tk.DISABLED)
+        self.status_label.config(text="ファイルを読み込んでいます…")
+        threading.Thread(target=self.run, args=(action, paths), daemon=True).start()
+        self.window.after(100, self.poll)
+
+    def run(self, action, paths):
         try:
-            img = Image.open(photo_path)
-            img.thumbnail((600, 600))
-            self.photo = ImageTk.PhotoImage(img)
-            label = tk.Label(self.window, image=self.photo)
-            label.pack()
+            trees = [hash_project(*model.load_project(path)) for path in paths]
+            self.messages.put(("done", action, trees))
         except Exception as e:
-            messagebox.showerror("エラー", f"画像を開く際にエラーが発生しました: {e}")
-            self.window.destroy()
-    
+            self.messages.put(("error", e))
+
+    def on_destroy(self, event):
+        if event.widget is self.window:
+            self.closed = True
+
+    def poll(self):
+        if self.closed:
+            return
+        try:
+            message = self.messages.get_nowait()
+        except queue.Empty:
+            self.window.after(100, self.poll)
+            return
+        self.compare_button.config(state=tk.NORMAL)
+        self.merge_button.config(state=tk.NORMAL)
+        if message[0] == "error":
+            self.status_label.config(text="")
+            messagebox.showerror("エラー", f"ファイルを読み込めませんでした: {message[1]}", parent=self.window)
+            return
+        self.finish(message[1], message[2])
+
+    @timed
+    def finish(self, action, trees):
+        if action == "compare":
+            differences = diff(hash_project(self.series_data, self.retired_data), trees[0])
+            self.show_rows([(difference, False) for difference in differences])
+            self.status_label.config(text=f"このプロジェクトから {os.path.basename(self.other_var.get())} への違い: "
+                                          f"{len(differences)} 件" if differences else "違いはありません。")
+            return
+        # こちらの木は結合の中で作る (作ってから結合し終わるまで系列をメモリから外さない)
+        applied, conflicts = merge3(self.changes, self.series_data, self.retired_data, trees[0], trees[1])
+        self.show_rows([(difference, True) for difference in conflicts] +
+                       [(difference, False) for difference in applied])
+        self.status_label.config(text=f"当てはめた変更 {len(applied)} 件、競合 {len(conflicts)} 件 "
+                                      "(競合したものはこのプロジェクトの内容を残しました)")
+
+    def show_rows(self, rows):
+        self.tree.delete(*self.tree.get_children())
+        for difference, conflict in rows[:self.MAX_ROWS]:
+            action = "競合" if conflict else ACTION_LABELS[difference.action]
+            self.tree.insert("", tk.END, text=" / ".join(difference.where), values=(
+                action, KIND_LABELS[difference.kind], difference.detail), tags=("conflict",) if conflict else ())
+        if len(rows) > self.MAX_ROWS:
+            self.tree.insert("", tk.END, text=f"ほか {len(rows) - self.MAX_ROWS} 件")
+
+class DiagnosticsWindow:
+    def __init__(self, parent):
+        self.diagnostics = shared_diagnostics()
+        self.pending = None
+
+        self.window = tk.Toplevel(parent)
+        self.window.title("診断")
+        self.window.geometry("800x600")
+        self.create_ui()
+        self.window.bind("<Destroy>", self.on_destroy, add="+")
+        self.refresh()
+
+    def create_ui(self):
+        top = tk.Frame(self.window)
+        top.pack(fill=tk.X, padx=5, pady=5)
+        self.enabled_var = tk.BooleanVar(value=self.diagnostics.enabled)
+        tk.Checkbutton(top, text="計測を有効にする", variable=self.enabled_var,
+                       command=self.toggle).pack(side=tk.LEFT)
+        tk.Button(top, text="次の操作をプロファイル", command=self.profile_next).pack(side=tk.LEFT, padx=5)
+        tk.Button(top, text="消去", command=self.clear).pack(side=tk.LEFT, padx=5)
+        tk.Button(top, text="ファイルに保存", command=self.dump).pack(side=tk.LEFT, padx=5)
+        self.memory_label = tk.Label(self.window, anchor="w")
+        self.memory_label.pack(fill=tk.X, padx=5)
+
+        columns = ("count", "mean", "p50", "p95", "max")
+        self.tree = ttk.Treeview(self.window, columns=columns, height=12)
+        self.tree.heading("#0", text="操作")
+        self.tree.column("#0", width=320)
+        for column, label in zip(columns, ("回数", "平均 (ms)", "p50 (ms)", "p95 (ms)", "最大 (ms)")):
+            self.tree.heading(column, text=label)
+            self.tree.column(column, width=80, anchor="e")
+        self.tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+        tk.Label(self.window, text="プロファイル:").pack(anchor="w", padx=5)
+        self.profile_text = tk.Text(self.window, height=12, font=("Courier", 9))
+        self.profile_text.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+
+    def refresh(self):
+        self.pending = None
+        usage = shared_cache().memory.usage()
+        self.memory_label.config(text=(
+            f"画像メモリ: {usage['used'] / 1048576:.1f} / {usage['budget'] / 1048576:.0f} MB "
+            f"({usage['images']} 枚、表示中 {usage['in_use']} 枚、解放 {usage['evictions']} 回)"))
+        self.tree.delete(*self.tree.get_children())
+        for name, summary in self.diagnostics.snapshot().items():
+            self.tree.insert("", tk.END, text=name, values=(
+                summary["count"], f"{summary['mean_ms']:.1f}", f"{summary['p50_ms']:.0f}",
+                f"{summary['p95_ms']:.0f}", f"{summary['max_ms']:.1f}"))
+        text = self.diagnostics.profile_text or ("次の操作を記録します…" if self.diagnostics.profile_armed else "")
+        if self.profile_text.get("1.0", tk.END).strip() != text.strip():
+            self.profile_text.delete("1.0", tk.END)
+            self.profile_text.insert(tk.END, text)
+        self.pending = self.window.after(1000, self.refresh)
+
+    def on_destroy(self, event):
+        if event.widget is self.window and self.pending is not None:
+            self.window.after_cancel(self.pending)
+            self.pending = None
+
+    def toggle(self):
+        self.diagnostics.set_enabled(self.enabled_var.get())
+
+    def profile_next(self):
+        if not self.diagnostics.enabled:
+            self.enabled_var.set(True)
+            self.toggle()
+        self.diagnostics.profile_text = ""
+        self.diagnostics.profile_next()
+
+    def clear(self):
+        self.diagnostics.reset()
+
+    def dump(self):
+        file_path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON Files", "*.json")])
+        if file_path:
+            self.diagnostics.dump(file_path)
+            messagebox.showinfo("保存完了", "診断結果を保存しました。")
+
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import threading
+
+# 写真を中に持つプロジェクト (バンドル)
+# バンドルは project.json と blobs/ を持つフォルダで、フォルダごと別のマシンへ
+# 移せる。写真は内容のハッシュを名前にして blobs/ab/<ハッシュ> に1回だけ置き、
+# データからは "bundle:<ハッシュ>/<元のファイル名>" という参照で指す (同じ写真を
+# 何度取り込んでも blob は1つ)。サムネイルは blob の隣に <ハッシュ>_<幅>x<高さ>.png
+# として置く。写真は読み込むときも取り込むときも一定の大きさずつ読む。
+# blob ごとの参照数は ChangeBus のイベントで数え、参照が無くなった blob は
+# 保存が終わったあとの collect_garbage() で消す (保存前に消すと、ジャーナルから
+# 戻したデータが指している写真を失うことがあるため)。
+
+BUNDLE_PREFIX = "bundle:"
+BUNDLE_SUFFIX = ".trainbundle"
+PROJECT_FILE = "project.json"
+BLOB_DIR = "blobs"
+CHUNK_SIZE = 1 << 20
+
+
+def is_bundle_ref(path):
+    return isinstance(path, str) and path.startswith(BUNDLE_PREFIX)
+
+
+def make_ref(digest, name=""):
+    return f"{BUNDLE_PREFIX}{digest}/{name}"
+
+
+def ref_digest(ref):
+    return ref[len(BUNDLE_PREFIX):].split("/", 1)[0]
+
+
+def ref_name(ref):
+    # 表示用の元のファイル名
+    return ref[len(BUNDLE_PREFIX):].split("/", 1)[-1] or ref_digest(ref)
+
+
+def _photo_path(photo):
+    return photo["path"] if isinstance(photo, dict) else photo
+
+
+def iter_photo_paths(series):
+    # 系列と、その編成の写真の参照 (パスか "bundle:..." の文字列)
+    for photo in series.get("photos", []):
+        yield _photo_path(photo)
+    for formation in series.get("formations", []):
+        for photo in formation.get("photos", []):
+            yield _photo_path(photo)
+
+
+class PhotoBundle:
+    def __init__(self, root):
+        self.root = root
+        self.blob_root = os.path.join(root, BLOB_DIR)
+        self.counts = {}   # ハッシュ -> 参照数
+        self.pending = set()   # 取り込んだが、まだデータから参照されていないハッシュ
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, root):
+        os.makedirs(os.path.join(root, BLOB_DIR), exist_ok=True)
+        return cls(root)
+
+    @property
+    def project_path(self):
+        return os.path.join(self.root, PROJECT_FILE)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_root, digest[:2], digest)
+
+    def thumbnail_path(self, digest, size):
+        return os.path.join(self.blob_root, digest[:2], f"{digest}_{size[0]}x{size[1]}.png")
+
+    def has(self, digest):
+        return os.path.exists(self.blob_path(digest))
+
+    def resolve(self, ref):
+        return self.blob_path(ref_digest(ref))
+
+    # ---- 取り込み ----
+
+    def import_file(self, path):
+        # ハッシュを取りながら一時ファイルへ写し、同じ内容が無ければ blob にする。
+        # ワーカースレッドから呼べる。参照 "bundle:..." を返す。別のバンドルの参照なら
+        # 今開いているバンドル (current_bundle) から写す
+        if is_bundle_ref(path):
+            if self.has(ref_digest(path)):
+                return path
+            source, name = resolve_photo(path), ref_name(path)
+        else:
+            source, name = path, os.path.basename(path)
+        h = hashlib.blake2b(digest_size=16)
+        tmp_path = os.path.join(self.blob_root, f"import.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(source, "rb") as reader, open(tmp_path, "wb") as target:
+                for chunk in iter(lambda: reader.read(CHUNK_SIZE), b""):
+                    h.update(chunk)
+                    target.write(chunk)
+            digest = h.hexdigest()
+            with self.lock:
+                self.pending.add(digest)
+                if not self.has(digest):
+                    os.makedirs(os.path.dirname(self.blob_path(digest)), exist_ok=True)
+                    os.replace(tmp_path, self.blob_path(digest))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return make_ref(digest, name)
+
+    # ---- 参照数 ----
+
+    def reset_counts(self, series_data):
+        counts = {}
+        for series in series_data.values():
+            for path in iter_photo_paths(series):
+                if is_bundle_ref(path):
+                    digest = ref_digest(path)
+                    counts[digest] = counts.get(digest, 0) + 1
+        self.counts = counts
+
+    def _count(self, paths, step):
+        for path in paths:
+            if is_bundle_ref(path):
+                digest = ref_digest(path)
+                self.counts[digest] = self.counts.get(digest, 0) + step
+                if step > 0:
+                    self.pending.discard(digest)
+
+    def apply_change(self, event):
+        kind, action, value = event.kind, event.action, event.value
+        step = 1 if action == "insert" else -1 if action == "remove" else 0
+        if not step:
+            return
+        if kind in ("series_photo", "formation_photo"):
+            self._count((_photo_path(value),), step)
+        elif kind == "series":
+            self._count(iter_photo_paths(value), step)
+        elif kind == "formation":
+            self._count((_photo_path(photo) for photo in value.get("photos", [])), step)
+
+    def unreferenced(self):
+        # blobs/ にあって、どこからも参照されていないハッシュ (取り込み中のものは除く)
+        found = []
+        if not os.path.isdir(self.blob_root):
+            return found
+        for entry in os.scandir(self.blob_root):
+            if not entry.is_dir():
+                continue
+            for blob in os.scandir(entry.path):
+                name = blob.name
+                if "_" not in name and "." not in name and not self.counts.get(name) and name not in self.pending:
+                    found.append(name)
+        return found
+
+    def collect_garbage(self):
+        # 参照の無い blob とそのサムネイルを消し、消した数を返す
+        removed = 0
+        with self.lock:
+            for digest in self.unreferenced():
+                directory = os.path.dirname(self.blob_path(digest))
+                for name in os.listdir(directory):
+                    if name == digest or name.startswith(f"{digest}_"):
+                        os.remove(os.path.join(directory, name))
+                removed += 1
+        return removed
+
+
+def find_bundle(project_path):
+    # project_path がバンドルの project.json ならそのバンドル
+    if project_path is None or os.path.basename(project_path) != PROJECT_FILE:
+        return None
+    root = os.path.dirname(os.path.abspath(project_path))
+    if not os.path.isdir(os.path.join(root, BLOB_DIR)):
+        return None
+    return PhotoBundle(root)
+
+
+def bundle_paths(series_data):
+    # バンドルに取り込む写真のパスと参照 (重複なし)
+    paths = {}
+    for series in series_data.values():
+        for path in iter_photo_paths(series):
+            paths[path] = None
+    return list(paths)
+
+
+def import_paths(bundle, paths, progress=None, cancelled=None):
+    # パス -> 参照 と、見つからなかったパスのリスト
+    mapping = {}
+    missing = []
+    for done, path in enumerate(paths, 1):
+        if cancelled is not None and cancelled():
+            break
+        try:
+            mapping[path] = bundle.import_file(path)
+        except OSError:
+            missing.append(path)
+        if progress is not None:
+            progress(done, len(paths))
+    return mapping, missing
+
+
+def rebase_photos(series_data, mapping):
+    # mapping どおりに写真の参照を置き換える (イベントは出さない)。写真の要素は
+    # 書き換えずに置き換える (保存中の写しと共有しているため)
+    seen = set()
+    for series in series_data.values():
+        photos = series.get("photos", [])
+        photos[:] = [mapping.get(path, path) for path in photos]
+        for formation in series.get("formations", []):
+            photos = formation.get("photos", [])
+            if id(photos) in seen:
+                continue
+            seen.add(id(photos))
+            photos[:] = [{**photo, "path": mapping[_photo_path(photo)]}
+                         if isinstance(photo, dict) and _photo_path(photo) in mapping else photo
+                         for photo in photos]
+
+
+_current_bundle = None
+
+
+def current_bundle():
+    return _current_bundle
+
+
+def set_current_bundle(bundle):
+    global _current_bundle
+    _current_bundle = bundle
+
+
+def resolve_photo(path):
+    # 写真の参照から読み込めるファイルのパスへ (バンドルの参照でなければそのまま)
+    if is_bundle_ref(path) and _current_bundle is not None:
+        return _current_bundle.resolve(path)
+    return path
+
+
+def display_name(path):
+    # 一覧に出す写真の名前
+    return ref_name(path) if is_bundle_ref(path) else path
+
+
+def store_photo(path):
+    # バンドルを開いていれば写真を取り込んで参照を返す
+    if _current_bundle is None:
+        return path
+    return _current_bundle.import_file(path)
@@ -0,0 +1,357 @@
+import hashlib
+import json
+from collections import namedtuple
+
+import train_model as model
+from car_store import CAR_FIELDS, car_rows, shared_store
+from car_tags import car_mask
+from lazy_project import pinned
+
+# プロジェクトの比較と3方向の結合
+# プロジェクト → 系列 → 編成 → 車両の順にハッシュの木を作り、ハッシュが同じ
+# 部分木はその場で飛ばす。車両1両ごとのハッシュは1回しか計算しないので、
+# 10万両のうち数両だけが違う2つのプロジェクトでも、比べるのは違う車両を含む
+# 系列・編成の中だけになる。
+# 編成・車両・廃車は名前で対応させる (同じ名前が複数あれば何番目か)。名前を
+# 変えたものは「削除」と「追加」になる。
+# 3方向の結合は、共通の元 (base) から相手 (theirs) への変更を、こちらのデータへ
+# train_model の変更操作で当てはめる (ChangeBus のイベントが出るので、開いている
+# ウィンドウ・索引・ジャーナルもそのまま追従する)。同じものを両方で違うように
+# 変えていれば競合として報告し、こちらの内容を残す。
+
+ACTION_LABELS = {"added": "追加", "removed": "削除", "changed": "変更"}
+KIND_LABELS = {"series": "系列", "formation": "編成", "car": "車両", "retired": "廃車"}
+
+# action: "added" / "removed" / "changed"、where: 系列名・編成名・車両名のタプル
+Difference = namedtuple("Difference", "action kind where detail")
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _meta_digest(obj, children):
+    # 子 (編成・車両) 以外の項目 (解説・写真など)
+    meta = {key: value for key, value in obj.items() if key != children}
+    return _digest(json.dumps(meta, sort_keys=True, ensure_ascii=False, default=str).encode())
+
+
+def _car_key(car):
+    extra = sorted((key, value) for key, value in car.items() if key not in CAR_FIELDS and key != "color")
+    return (car.get("name"), car_mask(car), car.get("acceleration"), car.get("deceleration"), car.get("power_kw"),
+            car.get("control_method"), car.get("description"), extra)
+
+
+def _car_digests(cars):
+    # (車両名, ハッシュ) の並び。共有ストアの車両なら列を直接読む (値は _car_key と同じ並び)
+    rows = car_rows(cars)
+    if rows is None:
+        return [(key[0], _digest(repr(key).encode())) for key in map(_car_key, cars)]
+    store = shared_store()
+    names, tags, extras = store.names, store.tags, store.extras
+    acceleration, deceleration, power_kw = store.acceleration, store.deceleration, store.power_kw
+    methods, method_names, descriptions = store.control_methods, store.method_names, store.descriptions
+    digests = []
+    for car, row in zip(cars, rows):
+        if row in extras:
+            key = _car_key(car)
+        else:
+            a, d, p = acceleration[row], deceleration[row], power_kw[row]
+            key = (names[row], tags[row], a if a == a else None, d if d == d else None, p if p == p else None,
+                   method_names[methods[row]], descriptions[row], [])
+        digests.append((key[0], _digest(repr(key).encode())))
+    return digests
+
+
+def _keyed(items, name_of):
+    # 名前と、同じ名前の中で何番目か
+    seen = {}
+    for item in items:
+        name = name_of(item)
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        yield (name, count), item
+
+
+def _label(key):
+    name, count = key
+    return str(name) if count == 0 else f"{name} ({count + 1})"
+
+
+class Leaf:
+    # 車両・廃車
+    __slots__ = ("digest", "value")
+
+    def __init__(self, digest, value):
+        self.digest = digest
+        self.value = value
+
+
+class FormationNode:
+    __slots__ = ("formation", "meta", "digest", "cars")
+
+    def __init__(self, formation):
+        self.formation = formation
+        self.meta = _meta_digest(formation, "cars")
+        cars = formation.get("cars", [])
+        self.cars = {}   # (車両名, 何番目) -> Leaf (並び順)
+        seen = {}
+        for car, (name, digest) in zip(cars, _car_digests(cars)):
+            name = name or ""
+            count = seen.get(name, 0)
+            seen[name] = count + 1
+            self.cars[(name, count)] = Leaf(digest, car)
+        self.digest = _digest(self.meta + b"".join(leaf.digest for leaf in self.cars.values()))
+
+
+class SeriesNode:
+    __slots__ = ("series", "meta", "digest", "formations")
+
+    def __init__(self, series):
+        self.series = series
+        self.meta = _meta_digest(series, "formations")
+        self.formations = {key: FormationNode(formation) for key, formation
+                           in _keyed(series.get("formations", []), lambda formation: formation.get("name", ""))}
+        self.digest = _digest(self.meta + b"".join(node.digest for node in self.formations.values()))
+
+
+class ProjectTree:
+    def __init__(self, series_data, retired_data):
+        self.series = {(name, 0): SeriesNode(series) for name, series in series_data.items()}
+        self.retired = {}
+        for key, entry in _keyed(retired_data, lambda entry: entry.get("name", "")):
+            data = json.dumps(entry, sort_keys=True, ensure_ascii=False, default=str).encode()
+            self.retired[key] = Leaf(_digest(data), entry)
+        # 系列名はハッシュに含める (系列の並び順だけの違いは無視する)
+        series_digest = _digest(b"".join(sorted(_digest(repr(key).encode()) + node.digest
+                                                for key, node in self.series.items())))
+        self.digest = _digest(series_digest + b"".join(leaf.digest for leaf in self.retired.values()))
+
+
+def hash_project(series_data, retired_data):
+    return ProjectTree(series_data, retired_data)
+
+
+# ---- 比較 ----
+
+def diff(old, new):
+    # old から new への違い (ProjectTree どうし)
+    differences = []
+    if old.digest != new.digest:
+        _diff_nodes(differences, "series", (), old.series, new.series, _diff_series)
+        _diff_nodes(differences, "retired", (), old.retired, new.retired)
+    return differences
+
+
+def _diff_nodes(differences, kind, where, old, new, inner=None):
+    for key, node in old.items():
+        other = new.get(key)
+        if other is None:
+            differences.append(Difference("removed", kind, where + (_label(key),), ""))
+        elif other.digest != node.digest:
+            if inner is None:
+                differences.append(Difference("changed", kind, where + (_label(key),), ""))
+            else:
+                inner(differences, where + (_label(key),), node, other)
+    for key in new:
+        if key not in old:
+            differences.append(Difference("added", kind, where + (_label(key),), ""))
+
+
+def _diff_series(differences, where, old, new):
+    count = len(differences)
+    if old.meta != new.meta:
+        differences.append(Difference("changed", "series", where, "解説・写真"))
+    _diff_nodes(differences, "formation", where, old.formations, new.formations, _diff_formation)
+    if len(differences) == count:
+        differences.append(Difference("changed", "series", where, "編成の並び順"))
+
+
+def _diff_formation(differences, where, old, new):
+    count = len(differences)
+    if old.meta != new.meta:
+        differences.append(Difference("changed", "formation", where, "解説・写真"))
+    _diff_nodes(differences, "car", where, old.cars, new.cars)
+    if len(differences) == count:
+        differences.append(Difference("changed", "formation", where, "車両の並び順"))
+
+
+def format_difference(difference):
+    text = f"{ACTION_LABELS.get(difference.action, difference.action)} {KIND_LABELS[difference.kind]}: " \
+           f"{' / '.join(difference.where)}"
+    return f"{text} ({difference.detail})" if difference.detail else text
+
+
+# ---- 3方向の結合 ----
+
+class ThreeWayMerge:
+    def __init__(self, changes, series_data, retired_data):
+        self.changes = changes
+        self.series_data = series_data
+        self.retired_data = retired_data
+        self.applied = []     # 当てはめた相手の変更 (Difference)
+        self.conflicts = []   # 競合 (Difference、detail に理由)
+
+    def run(self, base, theirs, ours=None):
+        # base・theirs は ProjectTree。ours を省けばこちらのデータから作る。ours を
+        # 渡すときは、作るところから結合が終わるまで pinned() の中で呼ぶ (遅延読み込みの
+        # 系列が外されると、ours の木が指す dict への変更が保存されない)
+        if ours is None:
+            with pinned(self.series_data):
+                return self.run(base, theirs, hash_project(self.series_data, self.retired_data))
+        if theirs.digest in (base.digest, ours.digest):
+            return self
+        self._merge_nodes("series", (), base.series, ours.series, theirs.series,
+                          self._add_series, self._remove_series, self._merge_series, inner=True)
+        self._merge_nodes("retired", (), base.retired, ours.retired, theirs.retired,
+                          self._add_retired, self._remove_retired, self._replace_retired)
+        return self
+
+    def _merge_nodes(self, kind, where, base, ours, theirs, add, remove, merge, inner=False):
+        # inner が True なら、両方で変えたものは中に入って結合する
+        keys = list(theirs)
+        keys.extend(key for key in base if key not in theirs)
+        for key in keys:
+            b, o, t = base.get(key), ours.get(key), theirs.get(key)
+            bd, od, td = (node.digest if node is not None else None for node in (b, o, t))
+            if td == bd or td == od:
+                continue
+            at = where + (_label(key),)
+            if od == bd:
+                # こちらは変えていないので、相手の変更をそのまま当てる
+                if t is None:
+                    remove(key, o)
+                    self.applied.append(Difference("removed", kind, at, ""))
+                elif o is None:
+                    add(key, t)
+                    self.applied.append(Difference("added", kind, at, ""))
+                else:
+                    merge(key, at, b, o, t)
+            elif t is None:
+                self.conflicts.append(Difference("removed", kind, at, "相手が削除し、こちらで変更しました (こちらを残しました)"))
+            elif o is None:
+                self.conflicts.append(Difference("changed", kind, at, "こちらで削除し、相手が変更しました (削除したままにしました)"))
+            elif inner:
+                merge(key, at, b, o, t)
+            else:
+                self.conflicts.append(Difference("changed", kind, at, "両方で違うように変更しました (こちらを残しました)"))
+
+    def _merge_value(self, kind, where, base, ours, theirs, apply):
+        # 解説などの1つの値
+        if theirs == base or theirs == ours:
+            return
+        if ours == base:
+            apply(theirs)
+            self.applied.append(Difference("changed", kind, where, "解説"))
+        else:
+            self.conflicts.append(Difference("changed", kind, where, "解説を両方で変更しました (こちらを残しました)"))
+
+    def _merge_photos(self, kind, where, base, ours, theirs, add, remove):
+        # 写真はパスの集合として、相手が加えたものを加え、相手が外したものを外す
+        base_paths = {model._photo_path(photo) for photo in base}
+        theirs_paths = {model._photo_path(photo) for photo in theirs}
+        ours_paths = [model._photo_path(photo) for photo in ours]
+        for path in [path for path in ours_paths if path in base_paths and path not in theirs_paths]:
+            remove(ours_paths.index(path))
+            ours_paths.remove(path)
+            self.applied.append(Difference("removed", kind, where, f"写真 {path}"))
+        for path in [model._photo_path(photo) for photo in theirs]:
+            if path in base_paths or path in ours_paths:
+                continue
+            add(path)
+            ours_paths.append(path)
+            self.applied.append(Difference("added", kind, where, f"写真 {path}"))
+
+    # 系列
+
+    def _add_series(self, key, node):
+        model.add_series(self.series_data, self.changes, key[0], node.series)
+
+    def _remove_series(self, key, node):
+        model.remove_series(self.series_data, self.changes, key[0], list(self.series_data).index(key[0]))
+
+    def _merge_series(self, key, where, b, o, t):
+        name = key[0]
+        series = o.series
+        base_series = b.series if b is not None else {}
+        self._merge_value("series", where, base_series.get("description", ""), series.get("description", ""),
+                          t.series.get("description", ""),
+                          lambda text: model.set_series_description(self.changes, name, series, text))
+        self._merge_photos("series", where, base_series.get("photos", []), series.get("photos", []),
+                           t.series.get("photos", []),
+                           lambda path: model.add_series_photo(self.changes, name, series, path),
+                           lambda index: model.remove_series_photo(self.changes, name, series, index))
+
+        def add(key, node):
+            formation = model.add_formation(self.changes, name, series, key[0], node.formation.get("cars", []))
+            self._copy_formation_details(name, formation, node.formation)
+
+        def remove(key, node):
+            index = _index_of(series["formations"], node.formation)
+            model.remove_formation(self.changes, name, series, index)
+
+        def merge(key, at, fb, fo, ft):
+            self._merge_formation(name, at, fb, fo, ft)
+
+        self._merge_nodes("formation", where, b.formations if b is not None else {}, o.formations,
+                          t.formations, add, remove, merge, inner=True)
+
+    # 編成
+
+    def _copy_formation_details(self, series_name, formation, source):
+        model.set_formation_description(self.changes, series_name, formation, source.get("description", ""))
+        for photo in source.get("photos", []):
+            model.add_formation_photo(self.changes, series_name, formation, model._photo_path(photo))
+
+    def _merge_formation(self, series_name, where, b, o, t):
+        formation = o.formation
+        base_formation = b.formation if b is not None else {}
+        self._merge_value("formation", where, base_formation.get("description", ""),
+                          formation.get("description", ""), t.formation.get("description", ""),
+                          lambda text: model.set_formation_description(self.changes, series_name, formation, text))
+        self._merge_photos("formation", where, base_formation.get("photos", []), formation.get("photos", []),
+                           t.formation.get("photos", []),
+                           lambda path: model.add_formation_photo(self.changes, series_name, formation, path),
+                           lambda index: model.remove_formation_photo(self.changes, series_name, formation, index))
+
+        def add(key, leaf):
+            model.put_car(self.changes, series_name, formation, leaf.value)
+
+        def remove(key, leaf):
+            model.remove_car(self.changes, series_name, formation, _index_of(formation["cars"], leaf.value))
+
+        def replace(key, at, lb, lo, lt):
+            index = _index_of(formation["cars"], lo.value)
+            model.put_car(self.changes, series_name, formation, lt.value, index)
+            self.applied.append(Difference("changed", "car", at, ""))
+
+        self._merge_nodes("car", where, b.cars if b is not None else {}, o.cars, t.cars, add, remove, replace)
+
+    # 廃車
+
+    def _add_retired(self, key, leaf):
+        entry = leaf.value
+        model.add_retired(self.changes, self.retired_data, entry.get("name", ""), entry.get("series"),
+                          entry.get("formation"), entry.get("date"), entry.get("car"))
+
+    def _remove_retired(self, key, leaf):
+        model.remove_retired(self.changes, self.retired_data, _index_of(self.retired_data, leaf.value))
+
+    def _replace_retired(self, key, at, lb, lo, lt):
+        self._remove_retired(None, lo)
+        self._add_retired(None, lt)
+        self.applied.append(Difference("changed", "retired", at, ""))
+
+
+def _index_of(items, item):
+    # 中身が同じ別のものと取り違えないように、同じオブジェクトを探す
+    for index, other in enumerate(items):
+        if other is item:
+            return index
+    raise ValueError("対象が見つかりません")
+
+
+def merge3(changes, series_data, retired_data, base, theirs, ours=None):
+    # base から theirs への変更をこちらのデータへ当てはめ、(当てはめた変更, 競合) を返す
+    merger = ThreeWayMerge(changes, series_data, retired_data).run(base, theirs, ours)
+    return merger.applied, merger.conflicts
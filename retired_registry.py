@@ -0,0 +1,119 @@
+import bisect
+import re
+
+# 廃車リストの索引
+# retired_data (廃車の dict のリスト) はそのまま保存・ジャーナルに使い、
+# ここでは名前と番号からの辞書と、廃車日で並べたリストを持つ。廃車かどうかの
+# 確認と重複の防止は辞書を1回引くだけで、廃車日の範囲は二分探索で取り出す。
+# ChangeBus の "retired" イベントで差分を反映する。
+#
+# 廃車の形: {"name": 車両名, "number": 番号, "series": 系列名, "formation": 編成名,
+#           "date": "YYYY-MM-DD", "car": 車両の内容}  (name 以外は無いこともある)
+
+_NUMBER = re.compile(r"[0-9０-９][0-9０-９\-－ ]*$")
+
+
+def car_number(name):
+    # 「クハ205-1」の「205-1」の部分 (無ければ空文字列)
+    match = _NUMBER.search(name.strip())
+    return match.group().strip() if match else ""
+
+
+def normalize_name(name):
+    return " ".join(name.split())
+
+
+class RetiredIndex:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.by_name = {}     # 車両名 -> 廃車
+        self.by_number = {}   # 番号 -> {id(廃車): 廃車}
+        self.dates = []       # (廃車日, 通し番号) の昇順
+        self.dated = []       # dates と同じ並びの廃車
+        self.keys = {}        # id(廃車) -> (廃車日, 通し番号)
+        self.sequence = 0
+
+    def reset(self, retired_data):
+        # 日付のリストは最後にまとめて並べる
+        self.clear()
+        dated = []
+        for entry in retired_data:
+            self._add_names(entry)
+            if entry.get("date"):
+                key = (entry["date"], self.sequence)
+                self.sequence += 1
+                self.keys[id(entry)] = key
+                dated.append((key, entry))
+        dated.sort(key=lambda item: item[0])
+        self.dates = [key for key, entry in dated]
+        self.dated = [entry for key, entry in dated]
+
+    def _add_names(self, entry):
+        name = normalize_name(entry.get("name", ""))
+        # 同じ名前が重なっている古いデータは最初のものを引けるようにする
+        self.by_name.setdefault(name, entry)
+        number = entry.get("number") or car_number(name)
+        if number:
+            self.by_number.setdefault(number, {})[id(entry)] = entry
+
+    def add(self, entry):
+        self._add_names(entry)
+        date = entry.get("date")
+        if date:
+            key = (date, self.sequence)
+            self.sequence += 1
+            position = bisect.bisect_right(self.dates, key)
+            self.dates.insert(position, key)
+            self.dated.insert(position, entry)
+            self.keys[id(entry)] = key
+
+    def remove(self, entry):
+        name = normalize_name(entry.get("name", ""))
+        if self.by_name.get(name) is entry:
+            del self.by_name[name]
+        number = entry.get("number") or car_number(name)
+        same_number = self.by_number.get(number)
+        if same_number is not None:
+            same_number.pop(id(entry), None)
+            if not same_number:
+                del self.by_number[number]
+        key = self.keys.pop(id(entry), None)
+        if key is not None:
+            position = bisect.bisect_left(self.dates, key)
+            del self.dates[position]
+            del self.dated[position]
+
+    def apply_change(self, event):
+        if event.kind != "retired":
+            return
+        if event.action == "insert":
+            self.add(event.value)
+        elif event.action == "remove":
+            self.remove(event.value)
+
+    # ---- 問い合わせ ----
+
+    def contains(self, name):
+        return normalize_name(name) in self.by_name
+
+    def get(self, name):
+        return self.by_name.get(normalize_name(name))
+
+    def lookup(self, text):
+        # 車両名か番号が一致する廃車
+        text = normalize_name(text)
+        found = {}
+        entry = self.by_name.get(text)
+        if entry is not None:
+            found[id(entry)] = entry
+        found.update(self.by_number.get(text, {}))
+        found.update(self.by_number.get(car_number(text), {}))
+        return list(found.values())
+
+    def between(self, start=None, end=None):
+        # 廃車日が start 以上 end 以下の廃車を日付順に (どちらも "YYYY-MM-DD" か None)
+        low = 0 if start is None else bisect.bisect_left(self.dates, (start,))
+        high = len(self.dates) if end is None else bisect.bisect_right(self.dates, (end, float("inf")))
+        return self.dated[low:high]
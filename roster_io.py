@@ -0,0 +1,338 @@
+import csv
+import os
+import re
+from operator import itemgetter
+
+import train_model as model
+from car_tags import CAR_TYPES, TAG_BITS, mask_to_tags
+from lazy_project import LazySeriesData
+
+# 車両名簿 (CSV / Parquet) の取り込みと書き出し
+# 1行が車両1両で、系列・編成・車両名・タイプ・性能の列を持つ。ファイルは
+# 先頭から1行ずつ読み、同じ編成の行がまとまっている間だけ車両をためて、
+# 編成ごとに1回のイベントで加える。ファイル全体をメモリに読むことはない。
+# 数値の確かめ方は CarWindow と同じ (model.make_car) で、誤りのある行は
+# 飛ばして行番号と内容を記録する。Parquet は pyarrow があるときだけ使える。
+
+FIELDS = ("series", "formation", "name", "tags", "acceleration", "deceleration", "power_kw",
+          "control_method", "description")
+# 性能の数値は車両ごとに必要なので (model.make_car)、列が無ければ読み始める前に知らせる
+REQUIRED_FIELDS = ("series", "formation", "name", "tags", "acceleration", "deceleration", "power_kw")
+
+# 書き出すときの見出しと、取り込むときに受け付ける見出し
+HEADERS = {
+    "series": "系列",
+    "formation": "編成",
+    "name": "車両名",
+    "tags": "タイプ",
+    "acceleration": "加速度",
+    "deceleration": "減速度",
+    "power_kw": "出力",
+    "control_method": "制御方式",
+    "description": "解説",
+}
+HEADER_ALIASES = {
+    "series": ("系列", "series"),
+    "formation": ("編成", "編成名", "formation"),
+    "name": ("車両名", "車両", "name", "car"),
+    "tags": ("タイプ", "車両タイプ", "形式", "tags", "type"),
+    "acceleration": ("加速度", "acceleration"),
+    "deceleration": ("減速度", "deceleration"),
+    "power_kw": ("出力", "出力(kw)", "power_kw", "power"),
+    "control_method": ("制御方式", "control_method", "control"),
+    "description": ("解説", "説明", "description"),
+}
+
+TAG_SEPARATORS = re.compile(r"[\s/,、・|;]+")
+TAG_SEPARATOR = "/"
+
+BATCH_ROWS = 5000         # step() 1回で読む行数
+MAX_PENDING_CARS = 1000   # これより長い編成は途中で分けて加える
+MAX_ERRORS = 1000         # 記録する誤りの数 (数えるのは全部)
+
+
+def _normalize(header):
+    return header.strip().lower().replace(" ", "")
+
+
+def map_columns(header, mapping=None):
+    # 見出しの並びから {項目: 列番号} を作る。mapping は {項目: 見出し} で上書き
+    positions = {_normalize(name): i for i, name in enumerate(header)}
+    columns = {}
+    for field in FIELDS:
+        names = (mapping[field],) if mapping and field in mapping else HEADER_ALIASES[field]
+        for name in names:
+            if _normalize(name) in positions:
+                columns[field] = positions[_normalize(name)]
+                break
+    missing = [HEADERS[f] for f in REQUIRED_FIELDS if f not in columns]
+    if missing:
+        raise model.ModelError(f"名簿に必要な列がありません: {', '.join(missing)}")
+    return columns
+
+
+def parse_tags(text):
+    # 「制御車/電動車」のようなタイプ名の並び、または「クモハ」のような記号
+    mask = 0
+    for token in TAG_SEPARATORS.split(text.strip()):
+        if not token:
+            continue
+        bit = TAG_BITS.get(token)
+        if bit is not None:
+            mask |= bit
+        elif all(c in CAR_TYPES for c in token):
+            for c in token:
+                mask |= TAG_BITS[CAR_TYPES[c]]
+        else:
+            raise model.ModelError(f"車両タイプが分かりません: {token}")
+    return mask
+
+
+def format_tags(mask):
+    return TAG_SEPARATOR.join(mask_to_tags(mask))
+
+
+def _is_parquet(path):
+    return path.lower().endswith(".parquet")
+
+
+# ---- 読み出し ----
+
+def _csv_rows(path, position):
+    # 見出しの行と、それに続く行を1行ずつ返す。position[0] に読んだバイト数を入れる
+    with open(path, "rb") as file:
+        def lines():
+            for line in file:
+                position[0] += len(line)
+                yield line.decode("utf-8-sig")
+        yield from csv.reader(lines())
+
+
+def _parquet_rows(path, position):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise model.ModelError("Parquet を読むには pyarrow をインストールしてください。")
+    parquet = pq.ParquetFile(path)
+    yield parquet.schema_arrow.names
+    for batch in parquet.iter_batches(batch_size=BATCH_ROWS):
+        columns = [column.to_pylist() for column in batch.columns]
+        for row in zip(*columns):
+            position[0] += 1
+            yield ["" if value is None else str(value) for value in row]
+
+
+def _parquet_row_count(path):
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+class RosterImport:
+    # step() を繰り返し呼んで少しずつ取り込む (GUI では after() から呼ぶ)
+    def __init__(self, path, series_data, changes, mapping=None):
+        self.series_data = series_data
+        self.changes = changes
+        self.position = [0]
+        if _is_parquet(path):
+            self.rows_iter = _parquet_rows(path, self.position)
+            self.size = _parquet_row_count(path)
+        else:
+            self.rows_iter = _csv_rows(path, self.position)
+            self.size = os.path.getsize(path)
+        header = next(self.rows_iter, None)
+        if header is None:
+            raise model.ModelError("名簿が空です。")
+        self.columns = map_columns(header, mapping)
+        # 無い列は空文字列として読む
+        self.fields = tuple(self.columns)
+        self.width = max(self.columns.values()) + 1
+        self.getter = itemgetter(*self.columns.values())
+        self.tag_masks = {}    # タイプの文字列 -> ビットマスク (同じ書き方が何度も出てくるので)
+        self.line = 1
+        self.rows = 0
+        self.cars = 0
+        self.new_series = 0
+        self.new_formations = 0
+        self.error_count = 0
+        self.errors = []       # (行番号, 内容)
+        self.done = False
+        self.formation_names = {}   # 系列名 -> (系列, {編成名: 編成})
+        self.pending_key = None
+        self.pending_cars = []
+        if isinstance(series_data, LazySeriesData):
+            series_data.listeners.append(self.on_series_loaded)
+
+    def progress(self):
+        # (読んだ量, 全体)。CSV はバイト数、Parquet は行数
+        return self.position[0], self.size
+
+    def step(self, limit=BATCH_ROWS):
+        # limit 行まで取り込み、まだ残っていれば True
+        if self.done:
+            return False
+        fields, width, getter, tag_masks = self.fields, self.width, self.getter, self.tag_masks
+        for row in self.rows_iter:
+            self.line += 1
+            if not any(row):
+                continue
+            self.rows += 1
+            if len(row) < width:
+                row = row + [""] * (width - len(row))
+            values = dict(zip(fields, getter(row)))
+            try:
+                key = (values["series"].strip(), values["formation"].strip())
+                if not key[0] or not key[1]:
+                    raise model.ModelError("系列と編成を入力してください。")
+                mask = tag_masks.get(values["tags"])
+                if mask is None:
+                    mask = tag_masks[values["tags"]] = parse_tags(values["tags"])
+                car = model.make_car(values["name"], mask, values.get("acceleration", ""),
+                                     values.get("deceleration", ""), values.get("power_kw", ""),
+                                     values.get("control_method", ""), values.get("description", ""))
+            except model.ModelError as e:
+                self.error_count += 1
+                if len(self.errors) < MAX_ERRORS:
+                    self.errors.append((self.line, str(e)))
+                continue
+            if key != self.pending_key or len(self.pending_cars) >= MAX_PENDING_CARS:
+                self._flush()
+                self.pending_key = key
+            self.pending_cars.append(car)
+            if self.rows % limit == 0:
+                return True
+        self._flush()
+        self.done = True
+        self.close()
+        return False
+
+    def close(self):
+        # 取り込みを終えたとき・中止したときに呼ぶ
+        if isinstance(self.series_data, LazySeriesData) and self.on_series_loaded in self.series_data.listeners:
+            self.series_data.listeners.remove(self.on_series_loaded)
+        self.formation_names.clear()
+
+    def on_series_loaded(self, action, name, series):
+        # メモリから外された系列の編成は覚えておかない (次に使うときに読み直す)
+        if action == "evict":
+            self.formation_names.pop(name, None)
+
+    def _formations(self, series_name):
+        # 系列は毎回引き直す (遅延読み込みでは取り込みの間に外されて読み直されることがあり、
+        # 外された系列の dict への変更はデータベースに書かれない)
+        series = self.series_data.get(series_name)
+        if series is None:
+            model.add_series(self.series_data, self.changes, series_name)
+            self.new_series += 1
+            series = self.series_data[series_name]
+        cached = self.formation_names.get(series_name)
+        if cached is None or cached[0] is not series:
+            names = {f.get("name"): f for f in series.get("formations", [])}
+            cached = self.formation_names[series_name] = (series, names)
+        return cached
+
+    def _flush(self):
+        if not self.pending_cars:
+            return
+        series_name, formation_name = self.pending_key
+        cars, self.pending_cars = self.pending_cars, []
+        series, formations = self._formations(series_name)
+        formation = formations.get(formation_name)
+        if formation is None:
+            # 新しい編成は車両を入れてから1回で加える
+            formations[formation_name] = model.add_formation(self.changes, series_name, series, formation_name, cars)
+            self.new_formations += 1
+        else:
+            for car in cars:
+                model.put_car(self.changes, series_name, formation, car)
+        self.cars += len(cars)
+
+
+def import_roster(path, series_data, changes, mapping=None, progress=None):
+    importer = RosterImport(path, series_data, changes, mapping)
+    try:
+        while importer.step():
+            if progress is not None:
+                progress(*importer.progress())
+    finally:
+        importer.close()
+    return importer
+
+
+# ---- 書き出し ----
+
+def roster_rows(series_data):
+    for series_name, series in series_data.items():
+        for formation in series.get("formations", []):
+            formation_name = formation.get("name", "")
+            for car in formation.get("cars", []):
+                yield (series_name, formation_name, car.get("name", ""), format_tags(car.get("tags", 0)),
+                       car.get("acceleration", ""), car.get("deceleration", ""), car.get("power_kw", ""),
+                       car.get("control_method", ""), car.get("description", ""))
+
+
+def export_roster(path, series_data, progress=None, cancelled=None):
+    # 書き出した両数を返す。progress(済んだ系列数, 系列数)
+    total = len(series_data)
+    header = [HEADERS[f] for f in FIELDS]
+    if _is_parquet(path):
+        return _export_parquet(path, series_data, header, progress, cancelled)
+    count = 0
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for done, (series_name, series) in enumerate(series_data.items(), 1):
+            if cancelled is not None and cancelled():
+                break
+            rows = list(roster_rows({series_name: series}))
+            writer.writerows(rows)
+            count += len(rows)
+            if progress is not None:
+                progress(done, total)
+    if cancelled is not None and cancelled():
+        os.remove(tmp_path)
+        return count
+    os.replace(tmp_path, path)
+    return count
+
+
+def _export_parquet(path, series_data, header, progress, cancelled):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise model.ModelError("Parquet で書き出すには pyarrow をインストールしてください。")
+    schema = pa.schema([(name, pa.float64() if field in model.NUMERIC_FIELDS else pa.string())
+                        for name, field in zip(header, FIELDS)])
+    total = len(series_data)
+    count = 0
+    batch = []
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    def write(writer, rows):
+        columns = list(zip(*rows))
+        arrays = [pa.array([v if isinstance(v, (int, float)) else None for v in column], type=pa.float64())
+                  if field in model.NUMERIC_FIELDS else pa.array([str(v) for v in column], type=pa.string())
+                  for field, column in zip(FIELDS, columns)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for done, (series_name, series) in enumerate(series_data.items(), 1):
+            if cancelled is not None and cancelled():
+                break
+            for row in roster_rows({series_name: series}):
+                batch.append(row)
+                if len(batch) >= BATCH_ROWS * 10:
+                    write(writer, batch)
+                    count += len(batch)
+                    batch = []
+            if progress is not None:
+                progress(done, total)
+        if batch:
+            write(writer, batch)
+            count += len(batch)
+    if cancelled is not None and cancelled():
+        os.remove(tmp_path)
+        return count
+    os.replace(tmp_path, path)
+    return count
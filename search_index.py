@@ -0,0 +1,342 @@
+import heapq
+import unicodedata
+from functools import lru_cache
+from itertools import islice
+
+# 全文検索の索引
+# 系列・編成・車両の名前と解説 (車両は制御方式も) を1文字・2文字の n-gram に
+# 分けた転置索引で持つ。日本語は単語に区切らずに部分一致させたいので、
+# 「クハ205」なら「クハ」「ハ2」「20」「05」をすべて含む文書を候補にする。
+# 索引はプロジェクトを開いたあと最初の検索で一度だけ作り、その後は
+# ChangeBus の変更イベントで該当する文書だけを入れ替える。
+#
+# 並び順は「名前が完全に一致」「名前に含む」「解説・制御方式に含む」の順で、
+# 同じ段の中はおおむねデータの並び順。候補の絞り込みは集合の積で行い、
+# 空白で区切った語はそれぞれ名前か解説・制御方式のどちらかに含まれればよい。
+
+
+def normalize(text):
+    # 全角英数字・半角カナの揺れをなくして小文字にそろえる
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+@lru_cache(maxsize=65536)
+def text_grams(text):
+    grams = set()
+    for token in normalize(text).split():
+        grams.update(token)
+        grams.update(token[i:i + 2] for i in range(len(token) - 1))
+    return frozenset(grams)
+
+
+def query_grams(query):
+    # 空白で区切った語ごとの n-gram の集合
+    tokens = []
+    for token in normalize(query).split():
+        if len(token) == 1:
+            tokens.append({token})
+        else:
+            tokens.append({token[i:i + 2] for i in range(len(token) - 1)})
+    return tokens
+
+
+class SearchResult:
+    __slots__ = ("kind", "series", "formation", "car")
+
+    def __init__(self, kind, series, formation, car):
+        self.kind = kind            # "series" / "formation" / "car"
+        self.series = series        # 系列名
+        self.formation = formation  # 編成 (dict)
+        self.car = car              # 車両 (dict)
+
+    def label(self):
+        if self.kind == "series":
+            return self.series
+        if self.kind == "formation":
+            return f"{self.series} / {self.formation['name']}"
+        return f"{self.series} / {self.formation['name']} / {self.car['name']}"
+
+
+class SearchIndex:
+    def __init__(self):
+        self.source = None
+        self.clear()
+
+    def clear(self):
+        self.built = False
+        self.name_postings = {}   # n-gram -> 文書番号の集合 (名前)
+        self.text_postings = {}   # n-gram -> 本文番号の集合 (解説・制御方式)
+        self.exact_names = {}     # 正規化した名前 -> 文書番号の集合
+        self.texts = {}           # (解説, 制御方式...) -> 本文番号
+        self.text_docs = {}       # 本文番号 -> {文書番号: None} (文書番号の順)
+        self.unsorted_texts = set()  # 文書を入れ直して順が崩れた本文番号 (検索の前に並べ直す)
+        self.text_keys = {}       # 本文番号 -> (解説, 制御方式...)
+        self.docs = {}            # 文書番号 -> [種類, 系列名, 編成, 車両, 名前, 名前の n-gram, 本文番号]
+        self.next_id = 0
+        self.next_text_id = 0
+        self.series_docs = {}     # 系列名 -> 文書番号
+        self.formation_docs = {}  # id(編成) -> 文書番号
+        self.car_docs = {}        # id(編成) -> 車両の並びと同じ順の文書番号
+
+    def reset(self, series_data):
+        # 索引は最初の検索まで作らない。series_data の値が None の系列は名前だけを入れる。
+        # 作るまでの系列の出し入れは写しの source に記録する
+        self.clear()
+        self.source = dict(series_data)
+
+    def ensure_built(self):
+        if self.built:
+            return
+        self.clear()
+        self.built = True
+        if self.source is not None:
+            for name, series in self.source.items():
+                self.add_series(name, series)
+            self.source = None
+
+    # ---- 文書の出し入れ ----
+    # 解説や制御方式は同じ文章を多くの車両が共有しているので、文章の組ごとに
+    # 「本文」として一度だけ n-gram に分け、文書は本文番号で参照する。
+
+    def _text_id(self, others):
+        key = tuple(others)
+        text_id = self.texts.get(key)
+        if text_id is None:
+            grams = frozenset().union(*(text_grams(text) for text in others))
+            if not grams:
+                return None
+            text_id = self.next_text_id
+            self.next_text_id += 1
+            self.texts[key] = text_id
+            self.text_keys[text_id] = key
+            self.text_docs[text_id] = {}
+            postings = self.text_postings
+            for gram in grams:
+                posting = postings.get(gram)
+                if posting is None:
+                    postings[gram] = {text_id}
+                else:
+                    posting.add(text_id)
+        return text_id
+
+    def _release_text(self, text_id):
+        key = self.text_keys.pop(text_id)
+        del self.texts[key]
+        del self.text_docs[text_id]
+        self.unsorted_texts.discard(text_id)
+        for gram in frozenset().union(*(text_grams(text) for text in key)):
+            posting = self.text_postings[gram]
+            posting.discard(text_id)
+            if not posting:
+                del self.text_postings[gram]
+
+    def _add_doc(self, kind, series_name, formation, car, name, others):
+        doc_id = self.next_id
+        self.next_id += 1
+        self._set_doc(doc_id, [kind, series_name, formation, car], name, others)
+        return doc_id
+
+    def _set_doc(self, doc_id, head, name, others):
+        name_grams = text_grams(name)
+        normalized = " ".join(normalize(name).split())
+        text_id = self._text_id(others)
+        self.docs[doc_id] = head + [normalized, name_grams, text_id]
+        postings = self.name_postings
+        for gram in name_grams:
+            posting = postings.get(gram)
+            if posting is None:
+                postings[gram] = {doc_id}
+            else:
+                posting.add(doc_id)
+        names = self.exact_names.get(normalized)
+        if names is None:
+            self.exact_names[normalized] = {doc_id}
+        else:
+            names.add(doc_id)
+        if text_id is not None:
+            docs = self.text_docs[text_id]
+            if docs and doc_id < next(reversed(docs)):
+                # 更新した文書は番号が小さいまま末尾に入る
+                self.unsorted_texts.add(text_id)
+            docs[doc_id] = None
+
+    def _unset_doc(self, doc_id, doc):
+        for gram in doc[5]:
+            posting = self.name_postings[gram]
+            posting.discard(doc_id)
+            if not posting:
+                del self.name_postings[gram]
+        names = self.exact_names[doc[4]]
+        names.discard(doc_id)
+        if not names:
+            del self.exact_names[doc[4]]
+        text_id = doc[6]
+        if text_id is not None:
+            docs = self.text_docs[text_id]
+            del docs[doc_id]
+            if not docs:
+                self._release_text(text_id)
+
+    def _remove_doc(self, doc_id):
+        doc = self.docs.pop(doc_id, None)
+        if doc is not None:
+            self._unset_doc(doc_id, doc)
+
+    def _reindex(self, doc_id, car, name, others):
+        doc = self.docs[doc_id]
+        self._unset_doc(doc_id, doc)
+        self._set_doc(doc_id, [doc[0], doc[1], doc[2], car], name, others)
+
+    @staticmethod
+    def _car_texts(car):
+        return car.get("name", ""), (car.get("control_method", ""), car.get("description", ""))
+
+    def add_series(self, name, series):
+        description = series.get("description", "") if series else ""
+        doc_id = self.series_docs.get(name)
+        if doc_id is None:
+            self.series_docs[name] = self._add_doc("series", name, None, None, name, (description,))
+        else:
+            self._reindex(doc_id, None, name, (description,))
+        if series is not None:
+            for formation in series.get("formations", []):
+                self.add_formation(name, formation)
+
+    def remove_series(self, name, series, keep_name=False):
+        if series is not None:
+            for formation in series.get("formations", []):
+                self.remove_formation(formation)
+        if not keep_name:
+            self._remove_doc(self.series_docs.pop(name, None))
+
+    def add_formation(self, series_name, formation):
+        self.formation_docs[id(formation)] = self._add_doc(
+            "formation", series_name, formation, None,
+            formation.get("name", ""), (formation.get("description", ""),))
+        car_docs = []
+        for car in formation.get("cars", []):
+            name, others = self._car_texts(car)
+            car_docs.append(self._add_doc("car", series_name, formation, car, name, others))
+        self.car_docs[id(formation)] = car_docs
+
+    def remove_formation(self, formation):
+        self._remove_doc(self.formation_docs.pop(id(formation), None))
+        for doc_id in self.car_docs.pop(id(formation), []):
+            self._remove_doc(doc_id)
+
+    # ---- 変更イベント ----
+
+    def apply_change(self, event):
+        if not self.built:
+            # 系列の中身の変更は source の系列を読むときに入るので、出し入れだけを記録する
+            if event.kind == "series" and self.source is not None:
+                if event.action == "insert":
+                    self.source[event.series] = event.value
+                elif event.action == "remove":
+                    self.source.pop(event.series, None)
+            return
+        if event.kind == "series":
+            if event.action == "insert":
+                self.add_series(event.series, event.value)
+            elif event.action == "remove":
+                self.remove_series(event.series, event.value)
+            else:
+                self._reindex(self.series_docs[event.series], None, event.series,
+                              (event.value.get("description", ""),))
+        elif event.kind == "formation":
+            if event.action == "insert":
+                self.add_formation(event.series, event.value)
+            elif event.action == "remove":
+                self.remove_formation(event.value)
+            elif id(event.value) in self.formation_docs:
+                self._reindex(self.formation_docs[id(event.value)], None,
+                              event.value.get("name", ""), (event.value.get("description", ""),))
+        elif event.kind == "car":
+            car_docs = self.car_docs.get(id(event.formation))
+            if car_docs is None:
+                return
+            if event.action == "insert":
+                name, others = self._car_texts(event.value)
+                car_docs.insert(event.index, self._add_doc(
+                    "car", event.series, event.formation, event.value, name, others))
+            elif event.action == "remove":
+                self._remove_doc(car_docs.pop(event.index))
+            else:
+                name, others = self._car_texts(event.value)
+                self._reindex(car_docs[event.index], event.value, name, others)
+
+    def on_series_loaded(self, action, name, series):
+        # 遅延読み込みの系列が読み込まれた / メモリから外されたとき
+        if not self.built:
+            if self.source is not None and name in self.source:
+                self.source[name] = series if action == "load" else None
+            return
+        if action == "load":
+            self.add_series(name, series)
+        else:
+            self.remove_series(name, series, keep_name=True)
+
+    # ---- 検索 ----
+
+    def _intersect(self, postings, grams):
+        sets = []
+        for gram in grams:
+            posting = postings.get(gram)
+            if posting is None:
+                return set()
+            sets.append(posting)
+        if len(sets) == 1:
+            return sets[0]  # 呼び出し側は書き換えない
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def _sorted_docs(self, text_id):
+        docs = self.text_docs[text_id]
+        if text_id in self.unsorted_texts:
+            self.unsorted_texts.discard(text_id)
+            docs = self.text_docs[text_id] = dict.fromkeys(sorted(docs))
+        return docs
+
+    def _match(self, grams):
+        # (名前に含む文書, 本文に含む本文番号)
+        return self._intersect(self.name_postings, grams), self._intersect(self.text_postings, grams)
+
+    def search(self, query, limit=100):
+        # (上位 limit 件の SearchResult, 一致した件数) を返す
+        self.ensure_built()
+        tokens = query_grams(query)
+        if not tokens:
+            return [], 0
+
+        exact = self.exact_names.get(" ".join(normalize(query).split()), set())
+        if len(tokens) == 1:
+            # 語が一つなら本文側の一致は本文番号のまま数え、必要な件数だけ取り出す
+            in_name, text_ids = self._match(tokens[0])
+            # heapq.merge は文書番号の順 (データの順) に並んだ本文ごとの文書を前提にする
+            text_docs = [self._sorted_docs(text_id) for text_id in sorted(text_ids)]
+            total = len(in_name) + sum(len(docs) - len(docs.keys() & in_name) for docs in text_docs)
+            others = (doc_id for doc_id in heapq.merge(*text_docs) if doc_id not in in_name)
+        else:
+            # 語ごとに名前か本文のどちらかに含まれていればよい
+            hits = in_name = None
+            for grams in tokens:
+                names, text_ids = self._match(grams)
+                docs = set(names)
+                for text_id in text_ids:
+                    docs.update(self.text_docs[text_id])
+                hits = docs if hits is None else hits & docs
+                in_name = names if in_name is None else in_name & names
+            total = len(hits)
+            others = iter(sorted(hits - in_name))
+
+        ranked = sorted(exact)
+        if len(ranked) < limit:
+            ranked.extend(heapq.nsmallest(limit - len(ranked), in_name - exact))
+        if len(ranked) < limit:
+            ranked.extend(islice(others, limit - len(ranked)))
+
+        results = []
+        for doc_id in ranked:
+            kind, series_name, formation, car = self.docs[doc_id][:4]
+            results.append(SearchResult(kind, series_name, formation, car))
+        return results, total
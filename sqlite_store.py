@@ -0,0 +1,401 @@
+import json
+import sqlite3
+
+from car_store import new_car
+from car_tags import UNKNOWN_TAGS, car_tag_names, mask_color
+
+# SQLite形式のプロジェクトファイル
+# 系列・編成・車両・写真・廃車をそれぞれ索引付きのテーブルに保持し、
+# ChangeBus から届いた変更を行単位で書き込む。JSON形式との相互変換は
+# import_data() / load_data() で行う。車両タイプはメモリ上のビットマスクを
+# 名前のリストと色に戻して書き込む。
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    position INTEGER NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_series_position ON series(position);
+
+CREATE TABLE IF NOT EXISTS formations (
+    id INTEGER PRIMARY KEY,
+    series_id INTEGER NOT NULL REFERENCES series(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_formations_series ON formations(series_id, position);
+
+CREATE TABLE IF NOT EXISTS cars (
+    id INTEGER PRIMARY KEY,
+    formation_id INTEGER NOT NULL REFERENCES formations(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT '[]',
+    color TEXT,
+    acceleration REAL,
+    deceleration REAL,
+    power_kw REAL,
+    control_method TEXT,
+    description TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_cars_formation ON cars(formation_id, position);
+CREATE INDEX IF NOT EXISTS idx_cars_name ON cars(name);
+
+CREATE TABLE IF NOT EXISTS photos (
+    id INTEGER PRIMARY KEY,
+    series_id INTEGER REFERENCES series(id) ON DELETE CASCADE,
+    formation_id INTEGER REFERENCES formations(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_photos_series ON photos(series_id, position);
+CREATE INDEX IF NOT EXISTS idx_photos_formation ON photos(formation_id, position);
+
+CREATE TABLE IF NOT EXISTS retired (
+    id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_retired_position ON retired(position);
+CREATE INDEX IF NOT EXISTS idx_retired_name ON retired(name);
+"""
+
+SERIES_FIELDS = ("formations", "description", "photos")
+FORMATION_FIELDS = ("name", "cars", "photos", "description")
+CAR_FIELDS = ("name", "tags", "color", "acceleration", "deceleration", "power_kw", "control_method", "description",
+              UNKNOWN_TAGS)
+RETIRED_FIELDS = ("name",)
+
+
+def _extra(obj, known):
+    # テーブルの列に無いキーはJSONとしてまとめて保持する
+    rest = {k: v for k, v in obj.items() if k not in known and k != "image"}
+    return json.dumps(rest, ensure_ascii=False) if rest else None
+
+
+def _merge_extra(obj, extra):
+    if extra:
+        obj.update(json.loads(extra))
+    return obj
+
+
+def _photo_path(photo):
+    return photo["path"] if isinstance(photo, dict) else photo
+
+
+def _car_row(formation_id, position, car):
+    return (
+        formation_id,
+        position,
+        car.get("name", ""),
+        json.dumps(car_tag_names(car), ensure_ascii=False),
+        mask_color(car.get("tags", 0)),
+        car.get("acceleration"),
+        car.get("deceleration"),
+        car.get("power_kw"),
+        car.get("control_method"),
+        car.get("description"),
+        _extra(car, CAR_FIELDS),
+    )
+
+
+def _car_from_row(row):
+    name, tags, color, acceleration, deceleration, power_kw, control_method, description, extra = row
+    car = new_car({"name": name, "tags": json.loads(tags)})
+    for key, value in (
+        ("acceleration", acceleration),
+        ("deceleration", deceleration),
+        ("power_kw", power_kw),
+        ("control_method", control_method),
+        ("description", description),
+    ):
+        if value is not None:
+            car[key] = value
+    return _merge_extra(car, extra)
+
+
+class SQLiteStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._series_ids = {}       # 系列名 -> 行ID
+        self._formation_ids = {}    # id(編成) -> (編成, 行ID)
+
+    def close(self):
+        self.conn.close()
+
+    # ---- JSON形式との変換 ----
+
+    def import_data(self, series_data, retired_data):
+        with self.conn:
+            for table in ("retired", "photos", "cars", "formations", "series"):
+                self.conn.execute(f"DELETE FROM {table}")
+            self._series_ids.clear()
+            self._formation_ids.clear()
+            for position, (name, series) in enumerate(series_data.items()):
+                self._write_series(name, series, position)
+            self.conn.executemany(
+                "INSERT INTO retired (position, name, extra) VALUES (?, ?, ?)",
+                [(i, r.get("name", ""), _extra(r, RETIRED_FIELDS)) for i, r in enumerate(retired_data)],
+            )
+
+    def load_data(self):
+        self._series_ids.clear()
+        self._formation_ids.clear()
+        series_data = {}
+        series_by_id = {}
+        for sid, name, description, extra in self.conn.execute(
+                "SELECT id, name, description, extra FROM series ORDER BY position"):
+            series = _merge_extra({"formations": [], "description": description, "photos": []}, extra)
+            series_data[name] = series
+            series_by_id[sid] = series
+            self._series_ids[name] = sid
+        self._fill_series(series_by_id)
+        return series_data, self.load_retired()
+
+    def load_retired(self):
+        return [
+            _merge_extra({"name": name}, extra)
+            for name, extra in self.conn.execute("SELECT name, extra FROM retired ORDER BY position")
+        ]
+
+    # ---- 遅延読み込み ----
+
+    def load_series_index(self):
+        # 系列名と編成数だけを読む (編成・車両は load_series() で読む)
+        self._series_ids.clear()
+        self._formation_ids.clear()
+        index = []
+        for sid, name, formation_count in self.conn.execute(
+                "SELECT s.id, s.name, COUNT(f.id) FROM series s LEFT JOIN formations f ON f.series_id = s.id"
+                " GROUP BY s.id ORDER BY s.position"):
+            self._series_ids[name] = sid
+            index.append((name, formation_count))
+        return index
+
+    def load_series(self, name):
+        sid = self._series_ids[name]
+        description, extra = self.conn.execute(
+            "SELECT description, extra FROM series WHERE id = ?", (sid,)).fetchone()
+        series = _merge_extra({"formations": [], "description": description, "photos": []}, extra)
+        self._fill_series({sid: series}, sid)
+        return series
+
+    def forget_series(self, series):
+        self._forget_formations(series.get("formations", []))
+
+    def _fill_series(self, series_by_id, series_id=None):
+        # series_id が None のときは全系列をまとめて読む
+        if series_id is None:
+            formation_where, car_where, photo_where, args = "", "", "", ()
+        else:
+            formation_where = " WHERE series_id = ?"
+            car_where = " WHERE formation_id IN (SELECT id FROM formations WHERE series_id = ?)"
+            photo_where = " WHERE series_id = ? OR formation_id IN (SELECT id FROM formations WHERE series_id = ?)"
+            args = (series_id,)
+
+        formations_by_id = {}
+        for fid, sid, name, description, extra in self.conn.execute(
+                "SELECT id, series_id, name, description, extra FROM formations"
+                + formation_where + " ORDER BY series_id, position", args):
+            formation = _merge_extra({"name": name, "cars": [], "photos": [], "description": description}, extra)
+            series_by_id[sid]["formations"].append(formation)
+            formations_by_id[fid] = formation
+            self._formation_ids[id(formation)] = (formation, fid)
+
+        for row in self.conn.execute(
+                "SELECT formation_id, name, tags, color, acceleration, deceleration, power_kw,"
+                " control_method, description, extra FROM cars" + car_where + " ORDER BY formation_id, position",
+                args):
+            formations_by_id[row[0]]["cars"].append(_car_from_row(row[1:]))
+
+        for sid, fid, path in self.conn.execute(
+                "SELECT series_id, formation_id, path FROM photos" + photo_where + " ORDER BY position", args * 2):
+            if fid is not None:
+                formations_by_id[fid]["photos"].append({"path": path})
+            else:
+                series_by_id[sid]["photos"].append(path)
+
+    # ---- 行単位の書き込み ----
+
+    def apply_change(self, event):
+        # 削除済みの系列・編成への変更 (開いたままのフォームからの保存など) は書かない
+        if not self._known(event):
+            return
+        handler = getattr(self, f"_{event.action}_{event.kind}")
+        with self.conn:
+            handler(event)
+
+    def _known(self, event):
+        kind, action = event.kind, event.action
+        if kind == "retired" or (kind == "series" and action == "insert"):
+            return True
+        if kind in ("car", "formation_photo") or (kind == "formation" and action != "insert"):
+            formation = event.formation or event.value
+            entry = self._formation_ids.get(id(formation))
+            return entry is not None and entry[0] is formation
+        return event.series in self._series_ids
+
+    def _write_series(self, name, series, position):
+        cur = self.conn.execute(
+            "INSERT INTO series (name, position, description, extra) VALUES (?, ?, ?, ?)",
+            (name, position, series.get("description", ""), _extra(series, SERIES_FIELDS)),
+        )
+        sid = cur.lastrowid
+        self._series_ids[name] = sid
+        for i, formation in enumerate(series.get("formations", [])):
+            self._write_formation(sid, i, formation)
+        self.conn.executemany(
+            "INSERT INTO photos (series_id, position, path) VALUES (?, ?, ?)",
+            [(sid, i, _photo_path(p)) for i, p in enumerate(series.get("photos", []))],
+        )
+
+    def _write_formation(self, series_id, position, formation):
+        cur = self.conn.execute(
+            "INSERT INTO formations (series_id, position, name, description, extra) VALUES (?, ?, ?, ?, ?)",
+            (series_id, position, formation.get("name", ""), formation.get("description", ""),
+             _extra(formation, FORMATION_FIELDS)),
+        )
+        fid = cur.lastrowid
+        self._formation_ids[id(formation)] = (formation, fid)
+        self.conn.executemany(
+            "INSERT INTO cars (formation_id, position, name, tags, color, acceleration, deceleration,"
+            " power_kw, control_method, description, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [_car_row(fid, i, car) for i, car in enumerate(formation.get("cars", []))],
+        )
+        self.conn.executemany(
+            "INSERT INTO photos (formation_id, position, path) VALUES (?, ?, ?)",
+            [(fid, i, _photo_path(p)) for i, p in enumerate(formation.get("photos", []))],
+        )
+
+    def _formation_id(self, formation):
+        return self._formation_ids[id(formation)][1]
+
+    def _forget_formations(self, formations):
+        for formation in formations:
+            self._formation_ids.pop(id(formation), None)
+
+    def _shift(self, table, column, owner_id, index, delta):
+        # 挿入・削除位置より後ろの行の position をずらす
+        self.conn.execute(
+            f"UPDATE {table} SET position = position + ? WHERE {column} = ? AND position >= ?",
+            (delta, owner_id, index),
+        )
+
+    # 系列
+    def _insert_series(self, event):
+        row = self.conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM series").fetchone()
+        self._write_series(event.series, event.value, row[0])
+
+    def _remove_series(self, event):
+        sid = self._series_ids.pop(event.series)
+        self.conn.execute("DELETE FROM series WHERE id = ?", (sid,))
+        if event.value is not None:
+            self._forget_formations(event.value.get("formations", []))
+
+    def _update_series(self, event):
+        self.conn.execute(
+            "UPDATE series SET description = ?, extra = ? WHERE id = ?",
+            (event.value.get("description", ""), _extra(event.value, SERIES_FIELDS), self._series_ids[event.series]),
+        )
+
+    # 編成
+    def _insert_formation(self, event):
+        sid = self._series_ids[event.series]
+        self._shift("formations", "series_id", sid, event.index, 1)
+        self._write_formation(sid, event.index, event.value)
+
+    def _remove_formation(self, event):
+        sid = self._series_ids[event.series]
+        fid = self._formation_id(event.value)
+        self.conn.execute("DELETE FROM formations WHERE id = ?", (fid,))
+        self._shift("formations", "series_id", sid, event.index + 1, -1)
+        self._forget_formations([event.value])
+
+    def _update_formation(self, event):
+        formation = event.value
+        self.conn.execute(
+            "UPDATE formations SET name = ?, description = ?, extra = ? WHERE id = ?",
+            (formation.get("name", ""), formation.get("description", ""),
+             _extra(formation, FORMATION_FIELDS), self._formation_id(formation)),
+        )
+
+    # 車両
+    def _insert_car(self, event):
+        fid = self._formation_id(event.formation)
+        self._shift("cars", "formation_id", fid, event.index, 1)
+        self.conn.execute(
+            "INSERT INTO cars (formation_id, position, name, tags, color, acceleration, deceleration,"
+            " power_kw, control_method, description, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            _car_row(fid, event.index, event.value),
+        )
+
+    def _remove_car(self, event):
+        fid = self._formation_id(event.formation)
+        self.conn.execute("DELETE FROM cars WHERE formation_id = ? AND position = ?", (fid, event.index))
+        self._shift("cars", "formation_id", fid, event.index + 1, -1)
+
+    def _update_car(self, event):
+        fid = self._formation_id(event.formation)
+        row = _car_row(fid, event.index, event.value)
+        self.conn.execute(
+            "UPDATE cars SET name = ?, tags = ?, color = ?, acceleration = ?, deceleration = ?, power_kw = ?,"
+            " control_method = ?, description = ?, extra = ? WHERE formation_id = ? AND position = ?",
+            row[2:] + row[:2],
+        )
+
+    # 写真
+    def _insert_series_photo(self, event):
+        sid = self._series_ids[event.series]
+        self._shift("photos", "series_id", sid, event.index, 1)
+        self.conn.execute(
+            "INSERT INTO photos (series_id, position, path) VALUES (?, ?, ?)",
+            (sid, event.index, _photo_path(event.value)),
+        )
+
+    def _remove_series_photo(self, event):
+        sid = self._series_ids[event.series]
+        self.conn.execute("DELETE FROM photos WHERE series_id = ? AND position = ?", (sid, event.index))
+        self._shift("photos", "series_id", sid, event.index + 1, -1)
+
+    def _insert_formation_photo(self, event):
+        fid = self._formation_id(event.formation)
+        self._shift("photos", "formation_id", fid, event.index, 1)
+        self.conn.execute(
+            "INSERT INTO photos (formation_id, position, path) VALUES (?, ?, ?)",
+            (fid, event.index, _photo_path(event.value)),
+        )
+
+    def _remove_formation_photo(self, event):
+        fid = self._formation_id(event.formation)
+        self.conn.execute("DELETE FROM photos WHERE formation_id = ? AND position = ?", (fid, event.index))
+        self._shift("photos", "formation_id", fid, event.index + 1, -1)
+
+    # 廃車
+    def _insert_retired(self, event):
+        self.conn.execute("UPDATE retired SET position = position + 1 WHERE position >= ?", (event.index,))
+        self.conn.execute(
+            "INSERT INTO retired (position, name, extra) VALUES (?, ?, ?)",
+            (event.index, event.value.get("name", ""), _extra(event.value, RETIRED_FIELDS)),
+        )
+
+    def _remove_retired(self, event):
+        self.conn.execute("DELETE FROM retired WHERE position = ?", (event.index,))
+        self.conn.execute("UPDATE retired SET position = position - 1 WHERE position > ?", (event.index,))
+
+    def _update_retired(self, event):
+        self.conn.execute(
+            "UPDATE retired SET name = ?, extra = ? WHERE position = ?",
+            (event.value.get("name", ""), _extra(event.value, RETIRED_FIELDS), event.index),
+        )
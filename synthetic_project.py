@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+from car_tags import TAG_BITS, infer_mask, mask_color, mask_to_tags
+
+# ベンチマーク用の架空のプロジェクト
+# 系列 N × 編成 M × 車両 K の大きさで、保存ファイルと同じ {"series", "retired"}
+# の形のデータを作る。車両名は「クハ205-1」のような形式記号付きで、タイプは
+# 名前から推定したものと同じにする (読み込み時の照合で引っかからないように)。
+# photo_dir を渡すと、最初の photo_files 枚の写真は実際の JPEG も書き出す
+# (PIL が必要)。残りのパスはファイルの無い写真になる。
+#   python synthetic_project.py out.json --series 200 --formations 50 --cars 10
+
+# 編成の並び (両端は制御車、中ほどに電動車・グリーン車・食堂車などを混ぜる)
+MIDDLE_CODES = ("モハ", "モハ", "サハ", "モハ", "サロ", "サハ", "モハ", "サシ", "モハネ", "サハ")
+END_CODES = ("クハ", "クモハ", "クハ")
+CONTROL_METHODS = ("VVVF", "GTO-VVVF", "IGBT-VVVF", "抵抗制御", "界磁チョッパ", "電機子チョッパ")
+DESCRIPTIONS = ("通勤形電車。", "近郊形電車。都市近郊の輸送に使われた。", "特急形電車。", "")
+
+
+def _car_code(position, count, rng):
+    if position == 0 or position == count - 1:
+        return rng.choice(END_CODES)
+    return MIDDLE_CODES[(position - 1) % len(MIDDLE_CODES)]
+
+
+def _car(code, number, rng, performance):
+    mask = infer_mask(code)
+    acceleration, power_kw, control_method = performance
+    motor = mask & TAG_BITS["電動車"]
+    return {
+        "name": f"{code}{number}",
+        "tags": list(mask_to_tags(mask)),
+        "acceleration": acceleration,
+        "deceleration": round(rng.uniform(3.5, 5.0), 1),
+        "power_kw": power_kw * 4 if motor else 0.0,
+        "control_method": control_method,
+        "description": rng.choice(DESCRIPTIONS),
+        "color": mask_color(mask),
+    }
+
+
+def generate_project(series=200, formations=50, cars=10, series_photos=2, formation_photos=1, retired=100,
+                     seed=0, photo_dir=None, photo_files=20):
+    rng = random.Random(seed)
+    photo_paths = []
+    next_photo = 0
+
+    def photo_path():
+        nonlocal next_photo
+        next_photo += 1
+        path = os.path.join(photo_dir or "photos", f"photo_{next_photo:06d}.jpg")
+        photo_paths.append(path)
+        return path
+
+    series_data = {}
+    for s in range(series):
+        type_number = 100 + s
+        performance = (round(rng.uniform(1.6, 3.5), 1), rng.choice((95.0, 120.0, 140.0, 190.0)),
+                       rng.choice(CONTROL_METHODS))
+        formation_list = []
+        for f in range(formations):
+            car_list = [
+                _car(_car_code(c, cars, rng), f"{type_number}-{f * cars + c + 1}", rng, performance)
+                for c in range(cars)
+            ]
+            formation_list.append({
+                "name": f"{type_number}系 {f + 1}編成",
+                "cars": car_list,
+                "photos": [{"path": photo_path()} for _ in range(formation_photos)],
+                "description": f"{f + 1}番目の編成。" if f % 3 == 0 else "",
+            })
+        series_data[f"{type_number}系"] = {
+            "formations": formation_list,
+            "description": f"{type_number}系の解説。",
+            "photos": [photo_path() for _ in range(series_photos)],
+        }
+    retired_data = [{"name": f"{rng.choice(END_CODES)}{i + 1}"} for i in range(retired)]
+    if photo_dir is not None:
+        write_photos(photo_paths[:photo_files], seed)
+    return {"series": series_data, "retired": retired_data}
+
+
+def write_photos(paths, seed=0, size=(1600, 1200)):
+    # 写真の読み込みを測るための、色の違う JPEG
+    from PIL import Image
+    rng = random.Random(seed)
+    for path in paths:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        Image.new("RGB", size, color).save(path, quality=85)
+
+
+def write_project(path, project):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(project, file, ensure_ascii=False, indent=4)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="synthetic_project", description="ベンチマーク用のプロジェクトを作る")
+    parser.add_argument("output")
+    parser.add_argument("--series", type=int, default=200)
+    parser.add_argument("--formations", type=int, default=50)
+    parser.add_argument("--cars", type=int, default=10)
+    parser.add_argument("--series-photos", type=int, default=2)
+    parser.add_argument("--formation-photos", type=int, default=1)
+    parser.add_argument("--retired", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--photo-dir", help="写真のファイルも書き出すフォルダ")
+    args = parser.parse_args(argv)
+    project = generate_project(args.series, args.formations, args.cars, args.series_photos, args.formation_photos,
+                               args.retired, args.seed, args.photo_dir)
+    write_project(args.output, project)
+    print(f"{args.output} に書き出しました。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+import copy
+import gc
+import pickle
+
+import pytest
+
+from car_store import Car, CarStore, car_rows, decode_series_data, new_car
+from car_tags import TAG_BITS, UNKNOWN_TAGS
+
+
+def test_columns_and_extras():
+    store = CarStore()
+    values = {"name": "クハ1", "tags": 1, "acceleration": "2.5km/h/s", "deceleration": 3.5, "power_kw": None,
+              "control_method": "VVVF", "description": "", "note": ["予備"]}
+    car = store.new_car(values)
+    assert dict(car) == values
+    assert car["acceleration"] == "2.5km/h/s" and car["deceleration"] == 3.5 and car["power_kw"] is None
+    # 列に入らなかった値だけが予備の dict にある
+    assert store.extras[car.row] == {"acceleration": "2.5km/h/s", "power_kw": None, "note": ["予備"]}
+
+    car["acceleration"] = 2.5
+    car["deceleration"] = "速い"
+    assert (car["acceleration"], car["deceleration"]) == (2.5, "速い")
+    assert store.acceleration[car.row] == 2.5 and store.deceleration[car.row] != store.deceleration[car.row]
+    assert store.extras[car.row] == {"deceleration": "速い", "power_kw": None, "note": ["予備"]}
+
+
+def test_missing_keys():
+    store = CarStore()
+    car = store.new_car({"name": "サハ1"})
+    assert list(car) == ["name", "tags"]
+    assert car.get("power_kw") is None and "power_kw" not in car
+    with pytest.raises(KeyError):
+        car["control_method"]
+
+
+def test_delete():
+    store = CarStore()
+    car = store.new_car({"name": "モハ1", "tags": 2, "power_kw": 480.0, "note": "x"})
+    del car["power_kw"]
+    del car["note"]
+    assert dict(car) == {"name": "モハ1", "tags": 2}
+    assert car.row not in store.extras
+    with pytest.raises(KeyError):
+        del car["power_kw"]
+    with pytest.raises(KeyError):
+        del car["note"]
+
+
+def test_rows_are_reused_after_gc():
+    store = CarStore()
+    car = store.new_car({"name": "クハ1", "tags": 1, "power_kw": 0.0, "note": "x"})
+    row = car.row
+    del car
+    gc.collect()
+    assert len(store) == 0 and store.free_rows == [row]
+
+    # 再利用した行に前の車両の値が残らない
+    car = store.new_car({"name": "サハ2"})
+    assert car.row == row
+    assert dict(car) == {"name": "サハ2", "tags": 0}
+    assert len(store) == 1
+
+
+def test_copy_and_pickle():
+    store = CarStore()
+    car = store.new_car({"name": "クハ1", "tags": 1, "acceleration": 2.5, "note": ["予備"]})
+    for other in (car.copy(), copy.copy(car), copy.deepcopy(car)):
+        assert other.__class__ is Car and other.row != car.row and other == car
+    other = car.copy()
+    other["name"] = "クハ2"
+    other["acceleration"] = "不明"
+    assert car["name"] == "クハ1" and car["acceleration"] == 2.5
+
+    restored = pickle.loads(pickle.dumps(car))
+    assert restored.__class__ is dict and restored == dict(car)
+
+
+def test_decode_series_data():
+    series_data = {"A": {"formations": [{"name": "F1", "cars": [
+        {"name": "クハ1", "tags": 1, "color": "red", "power_kw": 0.0},
+        {"name": "モハ2", "tags": ["電動車", "試験車"]},
+    ]}]}}
+    cars = decode_series_data(series_data)["A"]["formations"][0]["cars"]
+    assert all(car.__class__ is Car for car in cars)
+    assert dict(cars[0]) == {"name": "クハ1", "tags": 1, "power_kw": 0.0}
+    assert cars[1]["tags"] == TAG_BITS["電動車"] and cars[1][UNKNOWN_TAGS] == ["試験車"]
+    assert list(car_rows(cars)) == [car.row for car in cars]
+    assert car_rows([new_car(), {"name": "クハ1"}]) is None
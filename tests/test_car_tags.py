@@ -0,0 +1,61 @@
+import json
+
+import train_model as model
+from car_store import new_car
+from car_tags import TAG_BITS, UNKNOWN_TAGS, encode_car, infer_mask, mask_to_tags, split_tags
+from sqlite_store import SQLiteStore
+
+
+def project_with_tags(tags):
+    series = model.new_series()
+    formation = model.new_formation("F1")
+    formation["cars"].append(new_car({"name": "モハ1", "tags": tags}))
+    series["formations"].append(formation)
+    return {"A": series}
+
+
+def first_car(series_data):
+    return series_data["A"]["formations"][0]["cars"][0]
+
+
+def test_mask_round_trip():
+    mask, unknown = split_tags(["制御車", "電動車", "旧型車"])
+    assert mask == TAG_BITS["制御車"] | TAG_BITS["電動車"]
+    assert unknown == ["旧型車"]
+    assert mask_to_tags(mask) == ("制御車", "電動車")
+
+
+def test_infer_mask():
+    assert infer_mask("クモハ205-1") == TAG_BITS["制御車"] | TAG_BITS["電動車"] | TAG_BITS["普通車"]
+    assert infer_mask("ハイブリッド") is None
+
+
+def test_unknown_tags_survive_json_round_trip(tmp_path):
+    path = str(tmp_path / "project.json")
+    model.save_json(path, project_with_tags(["電動車", "旧型車"]), [])
+    series_data, retired_data = model.load_json(path)
+    model.save_json(path, series_data, retired_data)
+    with open(path, encoding="utf-8") as file:
+        car = json.load(file)["series"]["A"]["formations"][0]["cars"][0]
+    assert car["tags"] == ["電動車", "旧型車"]
+    assert UNKNOWN_TAGS not in car
+
+
+def test_unknown_tags_survive_sqlite_round_trip(tmp_path):
+    store = SQLiteStore(str(tmp_path / "project.db"))
+    store.import_data(project_with_tags(["電動車", "旧型車"]), [])
+    series_data, retired_data = store.load_data()
+    store.close()
+    assert encode_car(first_car(series_data))["tags"] == ["電動車", "旧型車"]
+
+
+def test_assigning_tag_names_replaces_unknown_tags():
+    car = new_car({"name": "モハ1", "tags": ["電動車", "旧型車"]})
+    car["tags"] = ["電動車"]
+    assert UNKNOWN_TAGS not in car
+    assert encode_car(car)["tags"] == ["電動車"]
+
+
+def test_validate_reports_unknown_tags():
+    problems = model.validate(project_with_tags(["電動車", "旧型車"]), [], check_files=False)
+    assert any("旧型車" in message for where, message in problems)
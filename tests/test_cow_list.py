@@ -0,0 +1,74 @@
+import train_model as model
+from car_store import new_car
+from change_events import ChangeBus
+from cow_list import CowList, own, release, share
+
+
+def make_series():
+    series = model.new_series()
+    formation = model.new_formation("F1")
+    formation["cars"].extend([new_car({"name": "クハ1", "tags": 1}), new_car({"name": "モハ2", "tags": 2})])
+    formation["photos"].append({"path": "F1.jpg"})
+    series["formations"].append(formation)
+    return series
+
+
+def names(formation):
+    return [car["name"] for car in formation["cars"]]
+
+
+def test_share_and_own():
+    container = {"items": [1, 2]}
+    shared = share(container, "items")
+    assert shared.__class__ is CowList and container["items"] is shared
+    assert shared.owners == 2
+
+    copy = {"items": shared}
+    mine = own(copy, "items")
+    mine.append(3)
+    assert mine is not shared and copy["items"] is mine
+    assert container["items"] == [1, 2]
+    assert shared.owners == 1 and mine.owners == 1
+    # もう共有していなければ複製しない
+    assert own(container, "items") is shared
+
+
+def test_own_missing_list():
+    container = {}
+    assert own(container, "items") == [] and container["items"].__class__ is CowList
+
+
+def test_copy_formation_shares_until_write():
+    changes = ChangeBus()
+    series = make_series()
+    original = series["formations"][0]
+    copy = model.copy_formation(changes, "A", series, 0)
+    assert copy["cars"] is original["cars"] and copy["photos"] is original["photos"]
+
+    model.put_car(changes, "A", copy, new_car({"name": "サハ3", "tags": 4}))
+    model.add_formation_photo(changes, "A", original, "F1b.jpg")
+    assert names(original) == ["クハ1", "モハ2"]
+    assert names(copy) == ["クハ1", "モハ2", "サハ3"]
+    assert original["photos"] == [{"path": "F1.jpg"}, {"path": "F1b.jpg"}]
+    assert copy["photos"] == [{"path": "F1.jpg"}]
+    # 複製したあとはそれぞれが唯一の持ち主
+    assert original["cars"].owners == copy["cars"].owners == 1
+
+
+def test_remove_formation_releases_shared_lists():
+    changes = ChangeBus()
+    series = make_series()
+    copy = model.copy_formation(changes, "A", series, 0)
+    cars = copy["cars"]
+    model.remove_formation(changes, "A", series, 0)
+    assert cars.owners == 1
+
+    # 残った編成は複製せずにそのまま書き換える
+    model.remove_car(changes, "A", copy, 0)
+    assert copy["cars"] is cars and names(copy) == ["モハ2"]
+
+
+def test_release_plain_list():
+    container = {"items": [1]}
+    release(container, "items")
+    assert container["items"] == [1]
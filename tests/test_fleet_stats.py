@@ -0,0 +1,64 @@
+import pytest
+
+import train_model as model
+from car_store import new_car
+from change_events import ChangeBus
+
+np = pytest.importorskip("numpy")
+from fleet_stats import FleetStats  # noqa: E402
+
+
+def make_project():
+    series_data = {}
+    for s in range(3):
+        series = model.new_series()
+        for f in range(4):
+            formation = model.new_formation(f"F{f}")
+            formation["cars"].extend(
+                new_car({"name": f"モハ{s}{f}-{c}", "tags": 2 if c % 2 else 1, "acceleration": 2.0 + c,
+                         "deceleration": 3.5, "power_kw": 120.0 * c})
+                for c in range(4))
+            series["formations"].append(formation)
+        series_data[f"{s}系"] = series
+    return series_data
+
+
+def summaries(stats, series_data):
+    result = [stats.fleet_summary()]
+    for name, series in series_data.items():
+        result.append(stats.series_summary(name))
+        result.extend(stats.formation_summary(formation) for formation in series["formations"])
+    return repr(result)
+
+
+def fresh(series_data):
+    stats = FleetStats()
+    stats.reset(series_data)
+    return stats
+
+
+def test_update_is_spliced_in_place():
+    series_data = make_project()
+    stats = fresh(series_data)
+    changes = ChangeBus()
+    changes.subscribe(stats.apply_change)
+    stats.ensure_built()
+    acceleration = stats.acceleration
+    formation = series_data["1系"]["formations"][2]
+    model.put_car(changes, "1系", formation, new_car({"name": "モハX", "tags": 2, "acceleration": 9.0,
+                                                      "power_kw": 999.0}), 1)
+    assert stats.acceleration is acceleration
+    assert summaries(stats, series_data) == summaries(fresh(series_data), series_data)
+
+
+def test_insert_and_remove_change_offsets():
+    series_data = make_project()
+    stats = fresh(series_data)
+    changes = ChangeBus()
+    changes.subscribe(stats.apply_change)
+    stats.ensure_built()
+    formation = series_data["0系"]["formations"][1]
+    model.put_car(changes, "0系", formation, new_car({"name": "サハY", "tags": 4, "acceleration": 1.0}))
+    model.remove_car(changes, "0系", series_data["2系"]["formations"][3], 0)
+    assert not stats.dirty
+    assert summaries(stats, series_data) == summaries(fresh(series_data), series_data)
@@ -0,0 +1,120 @@
+import os
+
+import train_model as model
+from car_store import new_car
+from car_tags import encode_series_data
+from change_events import ChangeBus
+from journal import Journal, read_journal, replay
+
+
+def make_project():
+    series = model.new_series("近郊形")
+    for name in ("F1", "F2"):
+        formation = model.new_formation(name)
+        formation["cars"].extend([new_car({"name": f"クハ{name}-1", "tags": 1}),
+                                  new_car({"name": f"モハ{name}-2", "tags": 2})])
+        series["formations"].append(formation)
+    return {"A": series}, [{"name": "クハ1", "date": "2001-02-03"}]
+
+
+def open_journal(tmp_path, generation=0):
+    series_data, retired_data = make_project()
+    journal = Journal(str(tmp_path / "project.json.journal"), series_data, retired_data, generation)
+    changes = ChangeBus()
+    changes.subscribe(journal.apply_change)
+    return journal, series_data, retired_data, changes
+
+
+def replayed(journal, generation):
+    series_data, retired_data = make_project()
+    replay(series_data, retired_data, read_journal(journal.path, generation))
+    return series_data, retired_data
+
+
+def same(left, right):
+    return encode_series_data(left[0].items()) == encode_series_data(right[0].items()) and left[1] == right[1]
+
+
+def test_replay_round_trip(tmp_path):
+    journal, series_data, retired_data, changes = open_journal(tmp_path)
+    series = series_data["A"]
+    model.put_car(changes, "A", series["formations"][0], new_car({"name": "サハF1-3", "tags": 4}))
+    model.copy_formation(changes, "A", series, 0)
+    model.put_car(changes, "A", series["formations"][2], new_car({"name": "クモハ", "tags": 3}), 0)
+    model.add_formation_photo(changes, "A", series["formations"][1], "F2.jpg")
+    model.retire_car(changes, retired_data, "A", series["formations"][1], 1, "2020-01-01")
+    model.remove_formation(changes, "A", series, 0)
+    model.remove_retired(changes, retired_data, 0)
+    model.add_series(series_data, changes, "B")
+    model.set_series_description(changes, "B", series_data["B"], "通勤形")
+    journal.close()
+
+    result = replayed(journal, 0)
+    assert same(result, (series_data, retired_data))
+    # コピー元の車両は書き換わらない
+    assert [car["name"] for car in result[0]["A"]["formations"][1]["cars"]] == ["クモハ", "モハF1-2", "サハF1-3"]
+
+
+def test_removed_formation_photo(tmp_path):
+    journal, series_data, retired_data, changes = open_journal(tmp_path)
+    formation = series_data["A"]["formations"][0]
+    model.add_formation_photo(changes, "A", formation, "a.jpg")
+    model.add_formation_photo(changes, "A", formation, "b.jpg")
+    model.remove_formation_photo(changes, "A", formation, 0)
+    journal.close()
+
+    result = replayed(journal, 0)
+    assert result[0]["A"]["formations"][0]["photos"] == [{"path": "b.jpg"}]
+
+
+def test_other_generation_is_ignored(tmp_path):
+    journal, series_data, retired_data, changes = open_journal(tmp_path, generation=3)
+    model.remove_car(changes, "A", series_data["A"]["formations"][0], 0)
+    journal.close()
+
+    assert len(read_journal(journal.path, 3)) == 1
+    assert read_journal(journal.path, 2) == []
+    assert read_journal(journal.path, 4) == []
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    journal, series_data, retired_data, changes = open_journal(tmp_path)
+    model.remove_car(changes, "A", series_data["A"]["formations"][0], 0)
+    journal.close()
+    with open(journal.path, "a", encoding="utf-8") as file:
+        file.write('{"a": "remove", "k": "car"')
+
+    assert len(read_journal(journal.path, 0)) == 1
+
+
+def test_rotate_keeps_previous_generation(tmp_path):
+    journal, series_data, retired_data, changes = open_journal(tmp_path)
+    formations = series_data["A"]["formations"]
+    model.remove_car(changes, "A", formations[0], 0)
+    journal.rotate(1)
+    model.remove_car(changes, "A", formations[1], 1)
+    journal.close()
+
+    # 本体の書き直しが終わる前に落ちた: 世代 0 の本体に .prev と新しい世代の両方を当てはめる
+    assert os.path.exists(journal.path + ".prev")
+    assert same(replayed(journal, 0), (series_data, retired_data))
+
+    # 書き直しが終わった: 世代 1 の本体には新しい世代の記録だけ
+    journal.remove_previous()
+    assert len(read_journal(journal.path, 1)) == 1
+    assert read_journal(journal.path, 0) == []
+
+
+def test_rollback(tmp_path):
+    journal, series_data, retired_data, changes = open_journal(tmp_path)
+    formations = series_data["A"]["formations"]
+    model.remove_car(changes, "A", formations[0], 0)
+    journal.rotate(1)
+    model.remove_car(changes, "A", formations[1], 1)
+    journal.rollback(0)
+    model.set_formation_description(changes, "A", formations[0], "廃車予定")
+    journal.close()
+
+    assert not os.path.exists(journal.path + ".prev")
+    assert len(read_journal(journal.path, 0)) == 3
+    assert same(replayed(journal, 0), (series_data, retired_data))
@@ -0,0 +1,148 @@
+import train_model as model
+from car_store import new_car
+from change_events import ChangeBus
+from lazy_project import LazySeriesData
+from project_diff import diff, hash_project, merge3
+from sqlite_store import SQLiteStore
+
+
+def make_project():
+    series_data = {}
+    for series_name in ("A", "B"):
+        series = model.new_series(f"{series_name}系")
+        for name in ("F1", "F2"):
+            formation = model.new_formation(name)
+            formation["cars"].extend([new_car({"name": f"クハ{name}-1", "tags": 1}),
+                                      new_car({"name": f"モハ{name}-2", "tags": 2})])
+            formation["photos"].append({"path": f"{series_name}{name}.jpg"})
+            series["formations"].append(formation)
+        series_data[series_name] = series
+    return series_data, [{"name": "クハ1", "date": "2001-02-03"}]
+
+
+def edited(change):
+    # make_project() の写しに change(changes, series_data, retired_data) を当てたもの
+    series_data, retired_data = make_project()
+    change(ChangeBus(), series_data, retired_data)
+    return series_data, retired_data
+
+
+def summary(differences):
+    return sorted((d.action, d.kind, d.where) for d in differences)
+
+
+def names(formation):
+    return [car["name"] for car in formation["cars"]]
+
+
+def test_no_differences():
+    assert diff(hash_project(*make_project()), hash_project(*make_project())) == []
+
+
+def test_diff():
+    def change(changes, series_data, retired_data):
+        formations = series_data["A"]["formations"]
+        car = formations[0]["cars"][1].copy()
+        car["tags"] = 6
+        model.put_car(changes, "A", formations[0], car, 1)
+        model.remove_formation(changes, "A", series_data["A"], 1)
+        model.add_formation(changes, "B", series_data["B"], "F3")
+        model.add_series(series_data, changes, "C")
+        model.add_retired(changes, retired_data, "モハ9")
+
+    differences = diff(hash_project(*make_project()), hash_project(*edited(change)))
+    assert summary(differences) == [
+        ("added", "formation", ("B", "F3")),
+        ("added", "retired", ("モハ9",)),
+        ("added", "series", ("C",)),
+        ("changed", "car", ("A", "F1", "モハF1-2")),
+        ("removed", "formation", ("A", "F2")),
+    ]
+
+
+def test_merge3_applies_their_changes():
+    def theirs_change(changes, series_data, retired_data):
+        formation = series_data["A"]["formations"][0]
+        model.put_car(changes, "A", formation, new_car({"name": "サハF1-3", "tags": 4}))
+        model.remove_formation_photo(changes, "A", formation, 0)
+        model.remove_retired(changes, retired_data, 0)
+
+    base = hash_project(*make_project())
+    theirs = hash_project(*edited(theirs_change))
+    series_data, retired_data = make_project()
+    changes = ChangeBus()
+    events = []
+    changes.subscribe(events.append)
+    # こちらは別の編成を変えている
+    model.remove_car(changes, "B", series_data["B"]["formations"][1], 0)
+    del events[:]
+
+    applied, conflicts = merge3(changes, series_data, retired_data, base, theirs)
+    assert conflicts == []
+    assert names(series_data["A"]["formations"][0]) == ["クハF1-1", "モハF1-2", "サハF1-3"]
+    assert series_data["A"]["formations"][0]["photos"] == []
+    assert names(series_data["B"]["formations"][1]) == ["モハF2-2"]
+    assert retired_data == []
+    assert {(event.action, event.kind) for event in events} == {
+        ("insert", "car"), ("remove", "formation_photo"), ("remove", "retired")}
+    assert len(applied) == 3
+
+
+def test_merge3_conflict_keeps_ours():
+    def rename(name):
+        def change(changes, series_data, retired_data):
+            formation = series_data["A"]["formations"][0]
+            car = formation["cars"][0].copy()
+            car["description"] = name
+            model.put_car(changes, "A", formation, car, 0)
+        return change
+
+    base = hash_project(*make_project())
+    theirs = hash_project(*edited(rename("相手")))
+    series_data, retired_data = edited(rename("こちら"))
+
+    applied, conflicts = merge3(ChangeBus(), series_data, retired_data, base, theirs)
+    assert applied == []
+    assert [(d.action, d.kind, d.where) for d in conflicts] == [("changed", "car", ("A", "F1", "クハF1-1"))]
+    assert series_data["A"]["formations"][0]["cars"][0]["description"] == "こちら"
+
+
+def test_merge3_same_change_on_both_sides():
+    def change(changes, series_data, retired_data):
+        model.set_series_description(changes, "B", series_data["B"], "通勤形")
+
+    base = hash_project(*make_project())
+    theirs = hash_project(*edited(change))
+    series_data, retired_data = edited(change)
+    assert merge3(ChangeBus(), series_data, retired_data, base, theirs) == ([], [])
+
+
+def test_merge3_into_lazy_database(tmp_path):
+    # 読み込み済みの系列を 1 つだけ持つ遅延読み込みでも、結合した変更が保存される
+    path = str(tmp_path / "project.db")
+    store = SQLiteStore(path)
+    store.import_data(*make_project())
+    series_data = LazySeriesData(store, max_loaded=1)
+    retired_data = store.load_retired()
+    changes = ChangeBus()
+    changes.subscribe(store.apply_change)
+
+    def theirs_change(changes, series_data, retired_data):
+        for series_name in ("A", "B"):
+            formation = series_data[series_name]["formations"][0]
+            car = formation["cars"][1].copy()
+            car["power_kw"] = 480.0
+            model.put_car(changes, series_name, formation, car, 1)
+
+    base = hash_project(*make_project())
+    theirs = hash_project(*edited(theirs_change))
+    applied, conflicts = merge3(changes, series_data, retired_data, base, theirs)
+    assert len(applied) == 2 and conflicts == []
+    store.close()
+
+    fresh = SQLiteStore(path)
+    try:
+        saved, _ = fresh.load_data()
+    finally:
+        fresh.close()
+    assert [saved[name]["formations"][0]["cars"][1].get("power_kw") for name in ("A", "B")] == [480.0, 480.0]
@@ -0,0 +1,132 @@
+import csv
+
+import pytest
+
+import train_model as model
+import roster_io
+from change_events import ChangeBus
+from lazy_project import LazySeriesData
+from roster_io import RosterImport, export_roster, import_roster, map_columns, parse_tags
+from sqlite_store import SQLiteStore
+
+HEADER = ["系列", "編成", "車両名", "タイプ", "加速度", "減速度", "出力", "制御方式", "解説"]
+
+
+def make_project():
+    series_data = {}
+    for series_name in ("A", "B", "C"):
+        series = model.new_series()
+        formation = model.new_formation("F1")
+        formation["cars"].append(model.make_car(f"クハ{series_name}1", 1, "2.5", "3.5", "0", "VVVF"))
+        series["formations"].append(formation)
+        series_data[series_name] = series
+    return series_data
+
+
+def write_csv(path, rows, header=HEADER):
+    with open(path, "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def car_names(series_data):
+    return {name: {f["name"]: [car["name"] for car in f["cars"]] for f in series["formations"]}
+            for name, series in series_data.items()}
+
+
+def test_parse_tags():
+    assert parse_tags("制御車/電動車") == parse_tags("クモ") == parse_tags("電動車・制御車")
+
+
+def test_missing_columns():
+    assert map_columns(["series", "formation", "car", "type", "acceleration", "deceleration", "power"]) == {
+        "series": 0, "formation": 1, "name": 2, "tags": 3, "acceleration": 4, "deceleration": 5, "power_kw": 6}
+    with pytest.raises(model.ModelError, match="減速度, 出力"):
+        map_columns(["系列", "編成", "車両名", "タイプ", "加速度"])
+
+
+def test_export_and_import(tmp_path):
+    path = str(tmp_path / "roster.csv")
+    series_data = make_project()
+    assert export_roster(path, series_data) == 3
+
+    imported = {}
+    importer = import_roster(path, imported, ChangeBus())
+    assert (importer.cars, importer.new_series, importer.new_formations, importer.error_count) == (3, 3, 3, 0)
+    assert car_names(imported) == car_names(series_data)
+    car = imported["A"]["formations"][0]["cars"][0]
+    assert (car["tags"], car["acceleration"], car["control_method"]) == (1, 2.5, "VVVF")
+
+
+def test_import_into_existing_formation(tmp_path):
+    path = str(tmp_path / "roster.csv")
+    write_csv(path, [
+        ["A", "F1", "モハA2", "電動車", "2.5", "3.5", "480", "", ""],
+        ["A", "F2", "クハA3", "制御車", "2.5", "3.5", "0", "", ""],
+        ["A", "F2", "", "制御車", "2.5", "3.5", "0", "", ""],
+        ["A", "F2", "サハA4", "付随車", "速い", "3.5", "0", "", ""],
+        ["D", "F1", "クモハD1", "クモ", "2.5", "3.5", "480", "", ""],
+    ])
+    series_data = make_project()
+    changes = ChangeBus()
+    events = []
+    changes.subscribe(events.append)
+    importer = import_roster(path, series_data, changes)
+
+    assert car_names(series_data)["A"] == {"F1": ["クハA1", "モハA2"], "F2": ["クハA3"]}
+    assert car_names(series_data)["D"] == {"F1": ["クモハD1"]}
+    assert (importer.cars, importer.new_series, importer.new_formations) == (3, 1, 2)
+    assert importer.error_count == 2 and [line for line, message in importer.errors] == [4, 5]
+    # 新しい編成は車両を入れて1回で加える
+    assert [(event.action, event.kind) for event in events] == [
+        ("insert", "car"), ("insert", "formation"), ("insert", "series"), ("insert", "formation")]
+
+
+def test_step_reads_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(roster_io, "MAX_PENDING_CARS", 3)
+    path = str(tmp_path / "roster.csv")
+    write_csv(path, [["A", "F9", f"モハ{i}", "電動車", "2.5", "3.5", "480", "", ""] for i in range(10)])
+    series_data = make_project()
+    changes = ChangeBus()
+    events = []
+    changes.subscribe(events.append)
+    importer = RosterImport(path, series_data, changes)
+
+    steps = 1
+    while importer.step(limit=4):
+        steps += 1
+        done, total = importer.progress()
+        assert 0 < done < total
+    assert steps == 3
+    assert importer.progress()[0] == importer.progress()[1]
+    assert car_names(series_data)["A"]["F9"] == [f"モハ{i}" for i in range(10)]
+    # 長い編成は MAX_PENDING_CARS 両ごとに分けて加える
+    assert [event.kind for event in events] == ["formation", "car", "car", "car", "car", "car", "car", "car"]
+
+
+def test_import_into_lazy_database(tmp_path):
+    # 読み込み済みの系列を 1 つだけ持つ遅延読み込みでも、すべての車両が保存される
+    db_path = str(tmp_path / "project.db")
+    store = SQLiteStore(db_path)
+    store.import_data(make_project(), [])
+    series_data = LazySeriesData(store, max_loaded=1)
+    changes = ChangeBus()
+    changes.subscribe(store.apply_change)
+
+    path = str(tmp_path / "roster.csv")
+    write_csv(path, [[name, "F1", f"モハ{i}", "電動車", "2.5", "3.5", "480", "", ""]
+                     for i, name in enumerate("ABCAB", 101)])
+    importer = import_roster(path, series_data, changes)
+    assert importer.cars == 5
+    assert importer.on_series_loaded not in series_data.listeners
+    store.close()
+
+    fresh = SQLiteStore(db_path)
+    try:
+        saved, _ = fresh.load_data()
+    finally:
+        fresh.close()
+    assert car_names(saved) == {"A": {"F1": ["クハA1", "モハ101", "モハ104"]},
+                                "B": {"F1": ["クハB1", "モハ102", "モハ105"]},
+                                "C": {"F1": ["クハC1", "モハ103"]}}
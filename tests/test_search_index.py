@@ -0,0 +1,108 @@
+import train_model as model
+from car_store import new_car
+from change_events import ChangeBus
+from search_index import SearchIndex
+
+
+def make_series(car_name="クモハ123-1"):
+    series = model.new_series("通勤形")
+    formation = model.new_formation("F1")
+    formation["cars"].append(new_car({"name": car_name, "tags": 1, "control_method": "VVVF"}))
+    series["formations"].append(formation)
+    return series
+
+
+def names(results):
+    return [result.car["name"] if result.car is not None else None for result in results]
+
+
+def test_search_finds_cars():
+    index = SearchIndex()
+    index.reset({"A": make_series()})
+    results, total = index.search("クモハ123")
+    assert total == 1
+    assert names(results) == ["クモハ123-1"]
+
+
+def test_series_loaded_before_first_search_is_indexed():
+    # 遅延読み込みで、最初の検索より前に読み込まれた系列
+    index = SearchIndex()
+    index.reset({"A": None})
+    series = make_series()
+    index.on_series_loaded("load", "A", series)
+    results, total = index.search("クモハ123")
+    assert names(results) == ["クモハ123-1"]
+
+    # 索引を作ったあとの車両の変更も入る
+    changes = ChangeBus()
+    changes.subscribe(index.apply_change)
+    formation = series["formations"][0]
+    model.put_car(changes, "A", formation, new_car({"name": "サハ456-1", "tags": 2}))
+    assert names(index.search("サハ456")[0]) == ["サハ456-1"]
+
+
+def test_series_unloaded_before_first_search_keeps_name_only():
+    index = SearchIndex()
+    index.reset({"A": None})
+    series = make_series()
+    index.on_series_loaded("load", "A", series)
+    index.on_series_loaded("unload", "A", series)
+    assert index.search("クモハ123") == ([], 0)
+    assert index.search("A")[1] == 1
+
+
+def test_series_added_and_removed_before_first_search():
+    index = SearchIndex()
+    series_data = {"A": make_series()}
+    index.reset(series_data)
+    changes = ChangeBus()
+    changes.subscribe(index.apply_change)
+    model.add_series(series_data, changes, "B", make_series("モハ789-1"))
+    model.remove_series(series_data, changes, "A", 0)
+    assert index.search("クモハ123") == ([], 0)
+    assert names(index.search("モハ789")[0]) == ["モハ789-1"]
+
+
+def test_incremental_updates_after_build():
+    index = SearchIndex()
+    series_data = {"A": make_series()}
+    index.reset(series_data)
+    index.search("A")
+    changes = ChangeBus()
+    changes.subscribe(index.apply_change)
+    formation = series_data["A"]["formations"][0]
+
+    model.put_car(changes, "A", formation, new_car({"name": "クハ200-1", "tags": 1}), 0)
+    assert index.search("クモハ123") == ([], 0)
+    assert names(index.search("クハ200")[0]) == ["クハ200-1"]
+
+    model.remove_car(changes, "A", formation, 0)
+    assert index.search("クハ200") == ([], 0)
+
+    model.set_formation_description(changes, "A", formation, "山手線")
+    results, total = index.search("山手")
+    assert total == 1 and results[0].formation is formation
+
+    model.remove_formation(changes, "A", series_data["A"], 0)
+    assert index.search("山手") == ([], 0)
+
+
+def test_text_matches_stay_in_data_order_after_edits():
+    series = model.new_series()
+    formation = model.new_formation("F1")
+    formation["cars"].extend(new_car({"name": f"モハ{i}", "tags": 2, "description": "増結用"}) for i in range(4))
+    series["formations"].append(formation)
+    index = SearchIndex()
+    index.reset({"A": series})
+    index.search("A")
+    changes = ChangeBus()
+    changes.subscribe(index.apply_change)
+
+    # 先頭の車両を入れ直しても、本文での一致はデータの順に並ぶ
+    car = formation["cars"][0].copy()
+    car["name"] = "クモハ0"
+    model.put_car(changes, "A", formation, car, 0)
+    results, total = index.search("増結")
+    assert total == 4
+    assert names(results) == ["クモハ0", "モハ1", "モハ2", "モハ3"]
+    assert names(index.search("増結", limit=2)[0]) == ["クモハ0", "モハ1"]
@@ -0,0 +1,93 @@
+import train_model as model
+from car_store import new_car
+from change_events import ChangeBus
+from sqlite_store import SQLiteStore
+
+
+def make_project():
+    series = model.new_series("近郊形")
+    for name in ("F1", "F2"):
+        formation = model.new_formation(name)
+        formation["cars"].extend([new_car({"name": f"クハ{name}-1", "tags": 1, "power_kw": 0.0}),
+                                  new_car({"name": f"モハ{name}-2", "tags": 2, "power_kw": 480.0})])
+        formation["photos"].append({"path": f"{name}.jpg"})
+        series["formations"].append(formation)
+    series["photos"].append("series.jpg")
+    return {"A": series}, [{"name": "クハ1", "date": "2001-02-03"}]
+
+
+def open_store(tmp_path):
+    store = SQLiteStore(str(tmp_path / "project.db"))
+    store.import_data(*make_project())
+    series_data, retired_data = store.load_data()
+    changes = ChangeBus()
+    changes.subscribe(store.apply_change)
+    return store, series_data, retired_data, changes
+
+
+def reload(store):
+    fresh = SQLiteStore(store.path)
+    try:
+        return fresh.load_data()
+    finally:
+        fresh.close()
+
+
+def car_names(series):
+    return [[car["name"] for car in formation["cars"]] for formation in series["formations"]]
+
+
+def test_round_trip(tmp_path):
+    store, series_data, retired_data, changes = open_store(tmp_path)
+    assert car_names(series_data["A"]) == [["クハF1-1", "モハF1-2"], ["クハF2-1", "モハF2-2"]]
+    assert series_data["A"]["photos"] == ["series.jpg"]
+    assert series_data["A"]["formations"][1]["photos"] == [{"path": "F2.jpg"}]
+    assert retired_data == [{"name": "クハ1", "date": "2001-02-03"}]
+    store.close()
+
+
+def test_row_writes(tmp_path):
+    store, series_data, retired_data, changes = open_store(tmp_path)
+    series = series_data["A"]
+    first, second = series["formations"]
+    model.put_car(changes, "A", first, new_car({"name": "サハF1-3", "tags": 4}))
+    model.put_car(changes, "A", first, new_car({"name": "クハF1-9", "tags": 1}), 0)
+    model.remove_car(changes, "A", second, 0)
+    model.set_formation_description(changes, "A", second, "6両")
+    model.add_formation_photo(changes, "A", second, "extra.jpg")
+    model.remove_formation_photo(changes, "A", second, 0)
+    model.remove_series_photo(changes, "A", series, 0)
+    model.add_retired(changes, retired_data, "モハ2")
+    model.remove_retired(changes, retired_data, 0)
+    model.add_formation(changes, "A", series, "F3", [new_car({"name": "クモハF3-1", "tags": 3})])
+    model.add_series(series_data, changes, "B")
+
+    loaded, retired = reload(store)
+    assert car_names(loaded["A"]) == car_names(series)
+    assert loaded["A"]["formations"][1]["description"] == "6両"
+    assert loaded["A"]["formations"][1]["photos"] == [{"path": "extra.jpg"}]
+    assert loaded["A"]["photos"] == []
+    assert [entry["name"] for entry in retired] == ["モハ2"]
+    assert list(loaded) == ["A", "B"]
+    store.close()
+
+
+def test_events_for_removed_formation_are_skipped(tmp_path):
+    # 削除した編成を開いたままのフォームから保存しても、ほかの購読者には届く
+    store, series_data, retired_data, changes = open_store(tmp_path)
+    series = series_data["A"]
+    received = []
+    changes.subscribe(received.append)
+    formation = series["formations"][0]
+    model.remove_formation(changes, "A", series, 0)
+    model.put_car(changes, "A", formation, new_car({"name": "サハ9", "tags": 4}))
+    model.put_car(changes, "A", formation, new_car({"name": "サハ8", "tags": 4}), 0)
+    model.add_formation_photo(changes, "A", formation, "late.jpg")
+    assert [event.kind for event in received] == ["formation", "car", "car", "formation_photo"]
+
+    removed = model.remove_series(series_data, changes, "A", 0)
+    model.set_series_description(changes, "A", removed, "削除後")
+    model.put_car(changes, "A", removed["formations"][0], new_car({"name": "サハ7", "tags": 4}))
+    loaded, retired = reload(store)
+    assert loaded == {}
+    store.close()
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from image_memory import DEFAULT_BUDGET, ImageMemory
+from photo_bundle import current_bundle, is_bundle_ref, ref_digest, resolve_photo
+
+# サムネイルのキャッシュ
+# 元画像の内容のハッシュと表示サイズをキーに、縮小済みの画像をディスクへ保存する。
+# ハッシュはパス・更新時刻・ファイルサイズが変わらない限り索引から引くので、
+# 元画像を読み直すのはファイルが変わったときだけになる。表示用の PhotoImage は
+# image_memory の上限の範囲でメモリにも保持する。PIL は起動を速くするため
+# 実際に画像を扱うときに読み込む。
+# バンドルの写真 ("bundle:<ハッシュ>/...") はハッシュが参照に入っているので
+# 読み直さず、サムネイルもキャッシュのフォルダではなく blob の隣に置く。
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".train_manager", "thumbnails")
+
+# 一覧・編成写真用とプレビュー用の大きさ
+FORMATION_PHOTO_SIZE = (400, 300)
+PREVIEW_SIZE = (600, 600)
+
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ThumbnailCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, memory_budget=DEFAULT_BUDGET):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index = sqlite3.connect(os.path.join(cache_dir, "index.db"), check_same_thread=False)
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, digest TEXT NOT NULL)"
+        )
+        self.memory = ImageMemory(memory_budget)  # (ハッシュ, サイズ) -> PhotoImage
+
+    def digest(self, path):
+        # 更新時刻かサイズが索引と違えば読み直してハッシュを取り直す
+        if is_bundle_ref(path):
+            return ref_digest(path)
+        st = os.stat(path)
+        with self._lock:
+            row = self._index.execute(
+                "SELECT mtime_ns, size, digest FROM files WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_mtime_ns and row[1] == st.st_size:
+            return row[2]
+        digest = file_digest(path)
+        with self._lock, self._index:
+            self._index.execute(
+                "INSERT OR REPLACE INTO files (path, mtime_ns, size, digest) VALUES (?, ?, ?, ?)",
+                (path, st.st_mtime_ns, st.st_size, digest),
+            )
+        return digest
+
+    def thumbnail_path(self, digest, size):
+        bundle = current_bundle()
+        if bundle is not None and bundle.has(digest):
+            return bundle.thumbnail_path(digest, size)
+        return os.path.join(self.cache_dir, digest[:2], f"{digest}_{size[0]}x{size[1]}.png")
+
+    def get_image(self, path, size):
+        return self._thumbnail(self.digest(path), path, size)
+
+    def _thumbnail(self, digest, path, size):
+        from PIL import Image
+        thumb_path = self.thumbnail_path(digest, size)
+        if os.path.exists(thumb_path):
+            img = Image.open(thumb_path)
+            img.load()
+            return img
+
+        img = Image.open(resolve_photo(path))
+        if img.format == "JPEG":
+            # JPEG は復号の段階で 1/2〜1/8 に縮小して読む
+            img.draft(img.mode, size)
+        img.thumbnail(size)
+        if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+            img = img.convert("RGB")
+        os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+        tmp_path = f"{thumb_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        img.save(tmp_path, "PNG")
+        os.replace(tmp_path, thumb_path)
+        return img
+
+    def load(self, path, size):
+        # 別スレッドから呼べる。PhotoImage がメモリに残っていれば画像は読まない
+        key = (self.digest(path), tuple(size))
+        if key in self.memory:
+            return key, None
+        return key, self._thumbnail(key[0], path, size)
+
+    def photo_for(self, path, key, image):
+        # PhotoImage は Tk のスレッドからだけ作る。使い終わったら handle.release()
+        handle = self.memory.acquire(key)
+        if handle is not None:
+            return handle
+        if image is None:
+            image = self._thumbnail(key[0], path, key[1])
+        from PIL import ImageTk
+        return self.memory.add(key, ImageTk.PhotoImage(image))
+
+    def get_photo(self, path, size):
+        # ImageHandle を返す
+        key, image = self.load(path, size)
+        return self.photo_for(path, key, image)
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def shared_cache():
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = ThumbnailCache()
+        return _shared_cache
@@ -0,0 +1,207 @@
+import argparse
+import os
+import sys
+
+import train_model
+from photo_bundle import PhotoBundle, bundle_paths, find_bundle, import_paths, rebase_photos, set_current_bundle
+
+# コマンドラインから使うための入口 (画面は出さない)
+#   python train_cli.py validate project.json
+#   python train_cli.py stats project.db
+#   python train_cli.py export project.json project.db
+#   python train_cli.py merge base.json other.json -o merged.json
+#   python train_cli.py diff old.json new.json
+#   python train_cli.py merge3 base.json ours.json theirs.json -o merged.json
+#   python train_cli.py import-roster project.json roster.csv -o project.json
+#   python train_cli.py export-roster project.json roster.csv
+#   python train_cli.py bundle project.json project.trainbundle
+# ファイルの形式は拡張子 (.json / .db) で決まる。バンドルはフォルダで指定する。
+
+
+def _project_file(path):
+    return PhotoBundle(path).project_path if os.path.isdir(path) else path
+
+
+def cmd_validate(args):
+    series_data, retired_data = train_model.load_project(args.project)
+    set_current_bundle(find_bundle(_project_file(args.project)))
+    problems = train_model.validate(series_data, retired_data, check_files=not args.no_files)
+    for where, message in problems:
+        print(f"{where}: {message}")
+    print(f"{len(problems)} 件の問題があります。" if problems else "問題はありません。")
+    return 1 if problems else 0
+
+
+def cmd_stats(args):
+    series_data, retired_data = train_model.load_project(args.project)
+    counts = train_model.project_counts(series_data)
+    total_formations = sum(c[0] for c in counts.values())
+    total_cars = sum(c[1] for c in counts.values())
+    print(f"系列 {len(counts)}  編成 {total_formations}  車両 {total_cars}  廃車 {len(retired_data)}")
+    if args.series:
+        for name, (formations, cars, types) in counts.items():
+            type_text = " ".join(f"{tag}{n}" for tag, n in types.items())
+            print(f"  {name}: {formations}編成 {cars}両  {type_text}")
+    try:
+        from fleet_stats import FleetStats, format_fleet_summary
+    except ImportError:
+        print("(NumPy が無いため性能の統計は省略しました)")
+        return 0
+    stats = FleetStats()
+    stats.reset(series_data)
+    print(format_fleet_summary(stats.fleet_summary()))
+    return 0
+
+
+def cmd_export(args):
+    series_data, retired_data = train_model.load_project(args.project)
+    train_model.save_project(args.output, series_data, retired_data)
+    print(f"{args.output} に書き出しました。")
+    return 0
+
+
+def cmd_merge(args):
+    series_data, retired_data = train_model.load_project(args.base)
+    for path in args.others:
+        other_series, other_retired = train_model.load_project(path)
+        conflicts = train_model.merge(series_data, retired_data, other_series, other_retired)
+        for series_name, formation_name in conflicts:
+            print(f"競合 ({path}): {series_name} / {formation_name} は {args.base} の内容を残しました。")
+    train_model.save_project(args.output, series_data, retired_data)
+    print(f"{args.output} に書き出しました。")
+    return 0
+
+
+def cmd_diff(args):
+    from project_diff import diff, format_difference, hash_project
+    old = hash_project(*train_model.load_project(args.old))
+    new = hash_project(*train_model.load_project(args.new))
+    differences = diff(old, new)
+    for difference in differences:
+        print(format_difference(difference))
+    print(f"{len(differences)} 件の違いがあります。" if differences else "違いはありません。")
+    return 1 if differences else 0
+
+
+def cmd_merge3(args):
+    # base から theirs への変更を ours に当てはめる
+    from change_events import ChangeBus
+    from project_diff import format_difference, hash_project, merge3
+    base = hash_project(*train_model.load_project(args.base))
+    theirs = hash_project(*train_model.load_project(args.theirs))
+    series_data, retired_data = train_model.load_project(args.ours)
+    applied, conflicts = merge3(ChangeBus(), series_data, retired_data, base, theirs)
+    if args.verbose:
+        for difference in applied:
+            print(format_difference(difference))
+    for difference in conflicts:
+        print(f"競合: {format_difference(difference)}")
+    train_model.save_project(args.output, series_data, retired_data)
+    print(f"{args.output} に書き出しました (変更 {len(applied)} 件、競合 {len(conflicts)} 件)。")
+    return 1 if conflicts else 0
+
+
+def cmd_import_roster(args):
+    from change_events import ChangeBus
+    from roster_io import import_roster
+    series_data, retired_data = train_model.load_project(args.project)
+    result = import_roster(args.roster, series_data, ChangeBus())
+    for line, message in result.errors:
+        print(f"{args.roster}:{line}: {message}")
+    print(f"{result.cars} 両を取り込みました (新しい系列 {result.new_series}, 新しい編成 {result.new_formations},"
+          f" 誤り {result.error_count} 行)。")
+    train_model.save_project(args.output, series_data, retired_data)
+    print(f"{args.output} に書き出しました。")
+    return 1 if result.error_count else 0
+
+
+def cmd_export_roster(args):
+    from roster_io import export_roster
+    series_data, retired_data = train_model.load_project(args.project)
+    count = export_roster(args.output, series_data)
+    print(f"{count} 両を {args.output} に書き出しました。")
+    return 0
+
+
+def cmd_bundle(args):
+    # 写真をバンドルに取り込み、参照をバンドルのものに置き換えて書き出す
+    series_data, retired_data = train_model.load_project(args.project)
+    set_current_bundle(find_bundle(_project_file(args.project)))
+    bundle = PhotoBundle.create(args.output)
+    paths = bundle_paths(series_data)
+    mapping, missing = import_paths(
+        bundle, paths, progress=lambda done, total: print(f"\r写真 {done} / {total}", end="", file=sys.stderr))
+    if paths:
+        print(file=sys.stderr)
+    rebase_photos(series_data, mapping)
+    train_model.save_json(bundle.project_path, series_data, retired_data)
+    for path in missing:
+        print(f"見つかりません: {path}")
+    print(f"{args.output} に書き出しました (写真 {len(mapping)} 枚)。")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="train_cli", description="鉄道車両編成管理データの操作")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("validate", help="データの誤りを調べる")
+    p.add_argument("project")
+    p.add_argument("--no-files", action="store_true", help="写真ファイルの有無を調べない")
+    p.set_defaults(func=cmd_validate)
+
+    p = commands.add_parser("stats", help="系列・編成・車両の数と性能の統計を表示する")
+    p.add_argument("project")
+    p.add_argument("--series", action="store_true", help="系列ごとの内訳も表示する")
+    p.set_defaults(func=cmd_stats)
+
+    p = commands.add_parser("export", help="別の形式 (.json / .db) で書き出す")
+    p.add_argument("project")
+    p.add_argument("output")
+    p.set_defaults(func=cmd_export)
+
+    p = commands.add_parser("merge", help="複数のプロジェクトを1つにまとめる")
+    p.add_argument("base")
+    p.add_argument("others", nargs="+")
+    p.add_argument("-o", "--output", required=True)
+    p.set_defaults(func=cmd_merge)
+
+    p = commands.add_parser("diff", help="2つのプロジェクトの違いを表示する")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.set_defaults(func=cmd_diff)
+
+    p = commands.add_parser("merge3", help="共通の元から相手への変更をこちらに当てはめる (3方向の結合)")
+    p.add_argument("base")
+    p.add_argument("ours")
+    p.add_argument("theirs")
+    p.add_argument("-o", "--output", required=True)
+    p.add_argument("-v", "--verbose", action="store_true", help="当てはめた変更も表示する")
+    p.set_defaults(func=cmd_merge3)
+
+    p = commands.add_parser("import-roster", help="車両名簿 (.csv / .parquet) を取り込む")
+    p.add_argument("project")
+    p.add_argument("roster")
+    p.add_argument("-o", "--output", required=True)
+    p.set_defaults(func=cmd_import_roster)
+
+    p = commands.add_parser("export-roster", help="車両名簿 (.csv / .parquet) を書き出す")
+    p.add_argument("project")
+    p.add_argument("output")
+    p.set_defaults(func=cmd_export_roster)
+
+    p = commands.add_parser("bundle", help="写真を中に持つバンドル (フォルダ) として書き出す")
+    p.add_argument("project")
+    p.add_argument("output")
+    p.set_defaults(func=cmd_bundle)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (OSError, ValueError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
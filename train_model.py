@@ -0,0 +1,429 @@
+import json
+import os
+from datetime import date
+
+from car_store import car_rows, decode_series_data, new_full_car, shared_store
+from car_tags import UNKNOWN_TAGS, TagIndex, car_mask, encode_car, encode_series, infer_mask, mask_color, mask_to_tags
+from cow_list import CowList, own, release, share
+from photo_bundle import PROJECT_FILE, resolve_photo
+from sqlite_store import SQLiteStore
+
+# 系列・編成・車両・廃車のデータモデル
+# GUI を使わずに読み書き・検証・集計・結合ができるように、データの形と
+# 変更操作をここにまとめる。変更操作はリストを書き換えたあと ChangeBus に
+# イベントを送るので、GUI の各ウィンドウも CLI も同じ関数を使う。
+# tkinter・PIL・NumPy はここからは読み込まない。
+
+MAX_CAR_TAGS = 6
+NUMERIC_FIELDS = ("acceleration", "deceleration", "power_kw")
+
+
+class ModelError(ValueError):
+    # 入力の誤り (メッセージはそのまま利用者に見せる)
+    pass
+
+
+def new_series(description=""):
+    return {"formations": [], "description": description, "photos": []}
+
+
+def new_formation(name):
+    return {"name": name, "cars": CowList(), "photos": CowList(), "description": ""}
+
+
+def make_car(name, tags, acceleration, deceleration, power_kw, control_method="", description=""):
+    # CarWindow の入力から車両を作る。tags はビットマスク
+    name = name.strip()
+    if not name:
+        raise ModelError("車両名を入力してください。")
+    if tags == 0:
+        raise ModelError("少なくとも1つの車両タイプを選択してください。")
+    if tags.bit_count() > MAX_CAR_TAGS:
+        raise ModelError(f"車両タイプは最大{MAX_CAR_TAGS}個まで選択できます。")
+    try:
+        acceleration = float(acceleration)
+        deceleration = float(deceleration)
+        power_kw = float(power_kw)
+    except ValueError:
+        raise ModelError("ステータス項目には数値を入力してください。")
+    return new_full_car(name, tags, acceleration, deceleration, power_kw, control_method.strip(), description.strip())
+
+
+# ---- 読み書き ----
+
+def load_json_document(path):
+    # (系列データ, 廃車データ, ジャーナルの世代番号)
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    return decode_series_data(data.get("series", {})), data.get("retired", []), data.get("journal_generation", 0)
+
+
+def load_json(path):
+    series_data, retired_data, generation = load_json_document(path)
+    return series_data, retired_data
+
+
+def snapshot(series_data, retired_data):
+    # 保存用の写し。系列・編成の dict とリストだけを写し、車両・写真・廃車の
+    # 要素は共有する (これらは書き換えずに置き換える決まりなので)
+    series_copy = {}
+    for name, series in series_data.items():
+        series = dict(series)
+        series["photos"] = list(series.get("photos", []))
+        series["formations"] = [
+            dict(formation, cars=list(formation.get("cars", [])), photos=list(formation.get("photos", [])))
+            for formation in series.get("formations", [])
+        ]
+        series_copy[name] = series
+    return series_copy, list(retired_data)
+
+
+def save_json(path, series_data, retired_data, generation=None, progress=None):
+    # 書きかけのファイルが残らないように一時ファイルに書いてから置き換える。
+    # progress(済んだ系列数, 系列数) はワーカースレッドから呼ばれることがある
+    encoded = {}
+    total = len(series_data)
+    for name, series in series_data.items():
+        encoded[name] = encode_series(series)
+        if progress is not None:
+            progress(len(encoded), total + 1)
+    data = {"series": encoded, "retired": retired_data}
+    if generation is not None:
+        data["journal_generation"] = generation
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    if progress is not None:
+        progress(total + 1, total + 1)
+
+
+def load_project(path):
+    # 拡張子で JSON か SQLite かを決め、(系列データ, 廃車データ) を全部読む。
+    # フォルダならバンドルの project.json を読む
+    if os.path.isdir(path):
+        path = os.path.join(path, PROJECT_FILE)
+    if path.lower().endswith(".db"):
+        store = SQLiteStore(path)
+        try:
+            return store.load_data()
+        finally:
+            store.close()
+    return load_json(path)
+
+
+def save_project(path, series_data, retired_data):
+    if path.lower().endswith(".db"):
+        store = SQLiteStore(path)
+        try:
+            store.import_data(series_data, retired_data)
+        finally:
+            store.close()
+    else:
+        save_json(path, series_data, retired_data)
+
+
+# ---- 変更操作 (書き換えてからイベントを送る) ----
+
+def add_series(series_data, changes, name, series=None):
+    # series を渡せば中身の入った系列を1回のイベントで加える (結合など)
+    if not name or name in series_data:
+        return None
+    series_data[name] = series if series is not None else new_series()
+    changes.emit("insert", "series", series=name, index=len(series_data) - 1, value=series_data[name])
+    return series_data[name]
+
+
+def remove_series(series_data, changes, name, index):
+    series = series_data.pop(name)
+    changes.emit("remove", "series", series=name, index=index, value=series)
+    return series
+
+
+def set_series_description(changes, series_name, series, description):
+    if description != series.get("description", ""):
+        series["description"] = description
+        changes.emit("update", "series", series=series_name, value=series)
+
+
+def add_formation(changes, series_name, series, name, cars=()):
+    # cars を入れた編成を1回のイベントで加える (名簿の取り込みなど)
+    formations = series["formations"]
+    formations.append(new_formation(name))
+    formations[-1]["cars"].extend(cars)
+    changes.emit("insert", "formation", series=series_name, index=len(formations) - 1, value=formations[-1])
+    return formations[-1]
+
+
+def remove_formation(changes, series_name, series, index):
+    formation = series["formations"].pop(index)
+    release(formation, "cars")
+    release(formation, "photos")
+    changes.emit("remove", "formation", series=series_name, index=index, value=formation)
+    return formation
+
+
+def copy_formation(changes, series_name, series, index):
+    # 車両と写真のリストは共有し、どちらかを書き換えるときに複製する
+    formations = series["formations"]
+    original = formations[index]
+    new = dict(original, cars=share(original, "cars"), photos=share(original, "photos"))
+    new["name"] += " (コピー)"
+    formations.append(new)
+    changes.emit("insert", "formation", series=series_name, index=len(formations) - 1, value=new)
+    return new
+
+
+def set_formation_description(changes, series_name, formation, description):
+    if description != formation.get("description", ""):
+        formation["description"] = description
+        changes.emit("update", "formation", series=series_name, formation=formation, value=formation)
+
+
+def put_car(changes, series_name, formation, car, index=None):
+    # index が None なら末尾に追加、そうでなければ置き換え
+    cars = own(formation, "cars")
+    if index is None:
+        cars.append(car)
+        changes.emit("insert", "car", series=series_name, formation=formation, index=len(cars) - 1, value=car)
+    else:
+        cars[index] = car
+        changes.emit("update", "car", series=series_name, formation=formation, index=index, value=car)
+    return car
+
+
+def remove_car(changes, series_name, formation, index):
+    car = own(formation, "cars").pop(index)
+    changes.emit("remove", "car", series=series_name, formation=formation, index=index, value=car)
+    return car
+
+
+def copy_car(changes, series_name, formation, index):
+    new = formation["cars"][index].copy()
+    new["name"] += " (コピー)"
+    return put_car(changes, series_name, formation, new)
+
+
+def add_series_photo(changes, series_name, series, path):
+    photos = series["photos"]
+    photos.append(path)
+    changes.emit("insert", "series_photo", series=series_name, index=len(photos) - 1, value=path)
+
+
+def remove_series_photo(changes, series_name, series, index):
+    photo = series["photos"].pop(index)
+    changes.emit("remove", "series_photo", series=series_name, index=index, value=photo)
+    return photo
+
+
+def add_formation_photo(changes, series_name, formation, path):
+    photos = own(formation, "photos")
+    photos.append({"path": path})
+    changes.emit("insert", "formation_photo", series=series_name, formation=formation,
+                 index=len(photos) - 1, value=photos[-1])
+    return photos[-1]
+
+
+def remove_formation_photo(changes, series_name, formation, index):
+    photo = own(formation, "photos").pop(index)
+    changes.emit("remove", "formation_photo", series=series_name, formation=formation, index=index, value=photo)
+    return photo
+
+
+def retired_date(text):
+    # 廃車日の入力 ("YYYY-MM-DD") を確かめて同じ形で返す
+    try:
+        return date.fromisoformat(text.strip()).isoformat()
+    except ValueError:
+        raise ModelError("廃車日は YYYY-MM-DD の形で入力してください。")
+
+
+def add_retired(changes, retired_data, name, series=None, formation=None, retired_on=None, car=None):
+    # series・formation は元の系列名・編成名、car は廃車にした車両の内容
+    entry = {"name": name}
+    for key, value in (("series", series), ("formation", formation), ("date", retired_on), ("car", car)):
+        if value is not None:
+            entry[key] = value
+    retired_data.append(entry)
+    changes.emit("insert", "retired", index=len(retired_data) - 1, value=entry)
+    return entry
+
+
+def remove_retired(changes, retired_data, index):
+    entry = retired_data.pop(index)
+    changes.emit("remove", "retired", index=index, value=entry)
+    return entry
+
+
+def retire_car(changes, retired_data, series_name, formation, index, retired_on):
+    # 編成から車両を外し、元の系列・編成と廃車日を付けて廃車リストへ移す
+    car = encode_car(formation["cars"][index])
+    del car["color"]
+    remove_car(changes, series_name, formation, index)
+    return add_retired(changes, retired_data, car.get("name", ""), series_name, formation.get("name", ""),
+                       retired_on, car)
+
+
+# ---- 検証 ----
+
+def _photo_path(photo):
+    return photo["path"] if isinstance(photo, dict) else photo
+
+
+def _photo_exists(photo):
+    return os.path.exists(resolve_photo(_photo_path(photo)))
+
+
+def validate(series_data, retired_data, check_files=True):
+    # 問題ごとに (場所, 内容) を返す
+    problems = []
+    for series_name, series in series_data.items():
+        if not series_name.strip():
+            problems.append(("(名前のない系列)", "系列名が空です。"))
+        seen = set()
+        for f_index, formation in enumerate(series.get("formations", [])):
+            name = formation.get("name", "")
+            where = f"{series_name} / {name or f'編成 {f_index + 1}'}"
+            if not name.strip():
+                problems.append((where, "編成名が空です。"))
+            elif name in seen:
+                problems.append((where, "同じ名前の編成があります。"))
+            seen.add(name)
+            for c_index, car in enumerate(formation.get("cars", [])):
+                car_where = f"{where} / {car.get('name') or f'車両 {c_index + 1}'}"
+                if not str(car.get("name", "")).strip():
+                    problems.append((car_where, "車両名が空です。"))
+                count = car_mask(car).bit_count()
+                inferred = infer_mask(str(car.get("name", "")))
+                if inferred is not None and count and inferred != car_mask(car):
+                    problems.append((car_where, f"車両名から推定したタイプ ({'・'.join(mask_to_tags(inferred))}) と違います。"))
+                if car.get(UNKNOWN_TAGS):
+                    problems.append((car_where, f"知らない車両タイプがあります (そのまま保存します): "
+                                                f"{'・'.join(map(str, car[UNKNOWN_TAGS]))}"))
+                if count == 0:
+                    problems.append((car_where, "車両タイプがありません。"))
+                elif count > MAX_CAR_TAGS:
+                    problems.append((car_where, f"車両タイプが{MAX_CAR_TAGS}個を超えています。"))
+                for field in NUMERIC_FIELDS:
+                    if field in car and not isinstance(car[field], (int, float)):
+                        problems.append((car_where, f"{field} が数値ではありません: {car[field]!r}"))
+            if check_files:
+                for photo in formation.get("photos", []):
+                    if not _photo_exists(photo):
+                        problems.append((where, f"写真が見つかりません: {_photo_path(photo)}"))
+        if check_files:
+            for photo in series.get("photos", []):
+                if not _photo_exists(photo):
+                    problems.append((series_name, f"写真が見つかりません: {_photo_path(photo)}"))
+    retired_names = set()
+    for index, retired in enumerate(retired_data):
+        name = str(retired.get("name", "")).strip()
+        where = f"廃車 {index + 1}"
+        if not name:
+            problems.append((where, "廃車車両名が空です。"))
+        elif name in retired_names:
+            problems.append((where, f"同じ車両名の廃車があります: {name}"))
+        retired_names.add(name)
+        if "date" in retired:
+            try:
+                retired_date(str(retired["date"]))
+            except ModelError as e:
+                problems.append((where, str(e)))
+    return problems
+
+
+# ---- 車両名とタイプの照合 ----
+
+def tag_mismatches(series_data):
+    # 車両名から推定したタイプと違うタイプを持つ車両の (系列名, 編成, 位置, 推定したマスク)
+    mismatches = []
+    store = shared_store()
+    for series_name, series in series_data.items():
+        for formation in series.get("formations", []):
+            cars = formation.get("cars", [])
+            rows = car_rows(cars)
+            if rows is not None:
+                # 共有ストアの車両なら列を直接読む
+                names, tags = store.names, store.tags
+                pairs = ((names[row], tags[row]) for row in rows)
+            else:
+                pairs = ((car.get("name"), car_mask(car)) for car in cars)
+            for index, (name, mask) in enumerate(pairs):
+                if name:
+                    inferred = infer_mask(name)
+                    if inferred is not None and inferred != mask:
+                        mismatches.append((series_name, formation, index, inferred))
+    return mismatches
+
+
+def fix_tags(changes, mismatches):
+    # tag_mismatches() の結果どおりにタイプを直す
+    for series_name, formation, index, inferred in mismatches:
+        car = formation["cars"][index].copy()
+        car["tags"] = inferred
+        put_car(changes, series_name, formation, car, index)
+
+
+# ---- 集計 ----
+
+def project_counts(series_data):
+    # 系列ごとの (編成数, 両数, {タイプ名: 両数})
+    tag_index = TagIndex()
+    tag_index.reset(series_data)
+    counts = {}
+    for name, series in series_data.items():
+        formations = series.get("formations", [])
+        counts[name] = (len(formations), sum(len(f.get("cars", [])) for f in formations), tag_index.counts(name))
+    return counts
+
+
+# ---- 一覧の行 ----
+# 一覧 (VirtualListbox) の 1 行分の (文字列, 色)。色が None なら既定の色
+
+def series_row(series_name, formation_count):
+    return f"{series_name} ({formation_count}編成)", None
+
+
+def formation_row(formation):
+    return formation["name"], None
+
+
+def car_row(car):
+    mask = car_mask(car)
+    return f"{car['name']} ({', '.join(mask_to_tags(mask))})", mask_color(mask)
+
+
+# ---- 結合 ----
+
+def merge(series_data, retired_data, other_series, other_retired):
+    # other の系列・編成・廃車のうち、こちらに無いものを加える。
+    # 同じ名前の編成で中身が違うものは加えずに (系列名, 編成名) を返す
+    conflicts = []
+    for name, other in other_series.items():
+        series = series_data.get(name)
+        if series is None:
+            series_data[name] = other
+            continue
+        formations = {f.get("name"): f for f in series.get("formations", [])}
+        for formation in other.get("formations", []):
+            existing = formations.get(formation.get("name"))
+            if existing is None:
+                series.setdefault("formations", []).append(formation)
+            elif _formation_key(existing) != _formation_key(formation):
+                conflicts.append((name, formation.get("name")))
+        photos = series.setdefault("photos", [])
+        photos.extend(p for p in other.get("photos", []) if p not in photos)
+        if not series.get("description"):
+            series["description"] = other.get("description", "")
+    names = {r.get("name") for r in retired_data}
+    retired_data.extend(r for r in other_retired if r.get("name") not in names)
+    return conflicts
+
+
+def _formation_key(formation):
+    cars = [(car.get("name"), tuple(mask_to_tags(car_mask(car))), car.get("acceleration"), car.get("deceleration"),
+             car.get("power_kw"), car.get("control_method"), car.get("description"))
+            for car in formation.get("cars", [])]
+    return formation.get("description", ""), cars
@@ -0,0 +1,186 @@
+import tkinter as tk
+from tkinter import font as tkfont
+
+# 仮想化リスト
+# 見えている行だけをキャンバス上のテキストとして描画する。行の内容は
+# row_count() と row_data(index) -> (表示文字列, 文字色) から都度取り出すので、
+# 数百万行あっても作成・着色するのは画面に入る数十行だけで済む。
+# tk.Listbox と同じ curselection() / get() / see() / bind() で使える。
+
+SELECT_COLOR = "#cce4ff"
+
+
+class VirtualListbox(tk.Frame):
+    def __init__(self, master, row_count, row_data, height=20, width=40, font=("Helvetica", 12)):
+        super().__init__(master)
+        self.row_count = row_count
+        self.row_data = row_data
+        self.font = tkfont.Font(self, font=font)
+        self.row_height = self.font.metrics("linespace") + 4
+        self.first = 0          # 先頭に表示している行
+        self.selected = None    # 選択中の行
+        self.items = []         # 表示枠ごとのテキスト項目 (使い回す)
+
+        self.canvas = tk.Canvas(self, width=self.font.measure("0") * width, height=self.row_height * height,
+                                bg="white", highlightthickness=1)
+        self.scrollbar = tk.Scrollbar(self, orient=tk.VERTICAL, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.highlight = self.canvas.create_rectangle(0, 0, 0, 0, fill=SELECT_COLOR, outline="", state=tk.HIDDEN)
+
+        self.canvas.bind("<Configure>", self._on_configure)
+        self.canvas.bind("<Button-1>", self._on_click)
+        self.canvas.bind("<MouseWheel>", self._on_wheel)
+        self.canvas.bind("<Button-4>", lambda event: self.yview_scroll(-3, "units"))
+        self.canvas.bind("<Button-5>", lambda event: self.yview_scroll(3, "units"))
+        self.canvas.bind("<Up>", lambda event: self._move_selection(-1))
+        self.canvas.bind("<Down>", lambda event: self._move_selection(1))
+        self.canvas.bind("<Prior>", lambda event: self._move_selection(-self.visible_rows()))
+        self.canvas.bind("<Next>", lambda event: self._move_selection(self.visible_rows()))
+
+    # ---- tk.Listbox 互換 ----
+
+    def bind(self, sequence=None, func=None, add=None):
+        return self.canvas.bind(sequence, func, add)
+
+    def size(self):
+        return self.row_count()
+
+    def get(self, index):
+        return self.row_data(index)[0]
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def selection_set(self, index):
+        self.selected = index
+        self._place_highlight()
+
+    def selection_clear(self, *args):
+        self.selected = None
+        self._place_highlight()
+
+    def see(self, index):
+        rows = self.visible_rows()
+        if index < self.first:
+            self.first = index
+        elif index >= self.first + rows:
+            self.first = index - rows + 1
+        self.refresh()
+
+    def yview(self, *args):
+        count = self.row_count()
+        if args[0] == "moveto":
+            self.first = int(float(args[1]) * count)
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            if args[2] == "pages":
+                amount *= self.visible_rows()
+            self.first += amount
+        self.refresh()
+
+    def yview_scroll(self, number, what):
+        self.yview("scroll", number, what)
+
+    # ---- 差分の反映 ----
+    # 挿入・削除位置が画面外なら表示中の行は描き直さず、選択行と
+    # スクロール位置が同じ行を指し続けるように番号だけずらす。
+
+    def apply_change(self, action, index):
+        if action == "insert":
+            self.row_inserted(index)
+        elif action == "remove":
+            self.row_removed(index)
+        elif action == "update":
+            self.row_updated(index)
+
+    def row_inserted(self, index):
+        if self.selected is not None and self.selected >= index:
+            self.selected += 1
+        if index < self.first:
+            self.first += 1
+        self._after_shift(index)
+
+    def row_removed(self, index):
+        if self.selected is not None:
+            if self.selected == index:
+                self.selected = None
+            elif self.selected > index:
+                self.selected -= 1
+        if index < self.first:
+            self.first -= 1
+        self._after_shift(index)
+
+    def row_updated(self, index):
+        slot = index - self.first
+        if 0 <= slot < len(self.items) and index < self.row_count():
+            text, color = self.row_data(index)
+            self.canvas.itemconfigure(self.items[slot], text=text, fill=color or "black", state=tk.NORMAL)
+
+    def _after_shift(self, index):
+        if self.first <= index < self.first + len(self.items):
+            self.refresh()
+        else:
+            self._place_highlight()
+            self._update_scrollbar(self.row_count())
+
+    # ---- 描画 ----
+
+    def visible_rows(self):
+        return max(1, self.canvas.winfo_height() // self.row_height)
+
+    def refresh(self):
+        count = self.row_count()
+        self.first = max(0, min(self.first, count - self.visible_rows()))
+        if self.selected is not None and self.selected >= count:
+            self.selected = None
+        for slot, item in enumerate(self.items):
+            index = self.first + slot
+            if index < count:
+                text, color = self.row_data(index)
+                self.canvas.itemconfigure(item, text=text, fill=color or "black", state=tk.NORMAL)
+            else:
+                self.canvas.itemconfigure(item, state=tk.HIDDEN)
+        self._place_highlight()
+        self._update_scrollbar(count)
+
+    def _update_scrollbar(self, count):
+        if count == 0:
+            self.scrollbar.set(0, 1)
+        else:
+            self.scrollbar.set(self.first / count, min(1.0, (self.first + self.visible_rows()) / count))
+
+    def _place_highlight(self):
+        slot = None if self.selected is None else self.selected - self.first
+        if slot is None or not 0 <= slot < len(self.items):
+            self.canvas.itemconfigure(self.highlight, state=tk.HIDDEN)
+            return
+        y = slot * self.row_height
+        self.canvas.coords(self.highlight, 0, y, self.canvas.winfo_width(), y + self.row_height)
+        self.canvas.itemconfigure(self.highlight, state=tk.NORMAL)
+        self.canvas.tag_lower(self.highlight)
+
+    def _on_configure(self, event):
+        # 高さが増えたときだけ表示枠を足す (減ったときは余りを隠すだけ)
+        slots = event.height // self.row_height + 1
+        while len(self.items) < slots:
+            y = len(self.items) * self.row_height + 2
+            self.items.append(self.canvas.create_text(4, y, anchor="nw", font=self.font, text=""))
+        self.refresh()
+
+    def _on_click(self, event):
+        self.canvas.focus_set()
+        index = self.first + event.y // self.row_height
+        if index < self.row_count():
+            self.selection_set(index)
+
+    def _on_wheel(self, event):
+        self.yview_scroll(-3 if event.delta > 0 else 3, "units")
+
+    def _move_selection(self, step):
+        count = self.row_count()
+        if count == 0:
+            return
+        index = 0 if self.selected is None else max(0, min(count - 1, self.selected + step))
+        self.selected = index
+        self.see(index)
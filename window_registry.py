@@ -0,0 +1,80 @@
+import tkinter as tk
+
+# 開いているウィンドウの登録簿
+# 同じ系列・編成を何度ダブルクリックしても新しい Toplevel は作らず、開いている
+# ウィンドウを前に出す。key は ("series", 系列名) のようなタプルで、target には
+# そのウィンドウが表示しているデータ (系列・編成の dict) を渡す。同じ key でも
+# target が別のもの (削除して作り直した系列など) なら古いウィンドウを閉じて
+# 作り直す。ウィンドウが閉じられると登録は自動で外れる。
+# 登録するオブジェクトは window 属性に Toplevel を持つこと。
+
+
+class WindowRegistry:
+    def __init__(self):
+        self.windows = {}   # key -> (ウィンドウのオブジェクト, target)
+
+    def show(self, key, create, target=None):
+        # key のウィンドウを前に出して返す。無ければ create() で作って登録する
+        owner = self.find(key, target)
+        if owner is not None:
+            raise_window(owner.window)
+            return owner
+        owner = create()
+        self.register(key, owner, target)
+        return owner
+
+    def find(self, key, target=None):
+        entry = self.windows.get(key)
+        if entry is None:
+            return None
+        owner, shown = entry
+        if shown is not target or not window_exists(owner.window):
+            del self.windows[key]
+            if window_exists(owner.window):
+                owner.window.destroy()
+            return None
+        return owner
+
+    def register(self, key, owner, target=None):
+        self.windows[key] = (owner, target)
+
+        def forget(event):
+            if event.widget is owner.window and self.windows.get(key, (None,))[0] is owner:
+                del self.windows[key]
+        owner.window.bind("<Destroy>", forget, add="+")
+
+    def close(self, key):
+        # 表示しているデータが消えたとき (系列・編成の削除) に呼ぶ
+        entry = self.windows.pop(key, None)
+        if entry is not None and window_exists(entry[0].window):
+            entry[0].window.destroy()
+
+    def close_all(self):
+        # プロジェクトを閉じるときに呼ぶ (古いデータを表示したままにしない)
+        for owner, target in list(self.windows.values()):
+            if window_exists(owner.window):
+                owner.window.destroy()
+        self.windows.clear()
+
+
+def window_exists(window):
+    try:
+        return bool(window.winfo_exists())
+    except tk.TclError:
+        return False
+
+
+def raise_window(window):
+    window.deiconify()
+    window.lift()
+    window.focus_set()
+
+
+_shared_windows = None
+
+
+def shared_windows():
+    global _shared_windows
+    if _shared_windows is None:
+        _shared_windows = WindowRegistry()
+    return _shared_windows